@@ -1,13 +1,16 @@
 import os
 import secrets
-from typing import Dict
+import time
+from itertools import groupby
+from typing import Dict, Optional
 from fastapi import FastAPI, Request, Form, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from starlette.middleware.sessions import SessionMiddleware
 
 from ah_client import AHClient, AHClientError
+from fragment_cache import FragmentCache, LRUCache, content_hash
 
 # Config
 APP_SECRET = os.getenv("APP_SECRET", secrets.token_hex(16))
@@ -16,13 +19,23 @@ BASE_DIR = os.path.dirname(__file__)
 templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "templates"))
 
 app = FastAPI(title="AH Receipts Viewer")
-app.add_middleware(SessionMiddleware, secret_key=APP_SECRET, https_only=False)
 app.mount("/static", StaticFiles(directory=os.path.join(BASE_DIR, "static")), name="static")
 
 # Simple per-session in-memory token store
 # DO NOT USE in production. Replace with DB/redis.
 SESSION_TOKENS: Dict[str, Dict] = {}
 
+# Receipts list per session: refetched from AH once older than this many seconds.
+RECEIPTS_TTL = float(os.getenv("RECEIPTS_TTL", "60"))
+# session_id -> (fetched_at, receipts, content hash)
+RECEIPT_LISTS: Dict[str, tuple] = {}
+# (session_id, transaction_id) -> content hash of that receipt. Receipts are immutable, so
+# once a session has seen one it never needs to fetch it again.
+RECEIPT_HASHES = LRUCache(max_entries=5000)
+# Rendered HTML keyed by template + content hash; shared between sessions, since a hash
+# is only known to sessions that fetched that content themselves.
+FRAGMENTS = FragmentCache(max_entries=int(os.getenv("FRAGMENT_CACHE_SIZE", "2000")))
+
 
 def _get_client_for_session(session_id: str) -> AHClient:
     tokens = SESSION_TOKENS.get(session_id)
@@ -41,25 +54,79 @@ async def ensure_session(request: Request, call_next):
     return response
 
 
+# Added after ensure_session so it wraps it: the last middleware added runs first, and the
+# session must be loaded before ensure_session reads it.
+app.add_middleware(SessionMiddleware, secret_key=APP_SECRET, https_only=False)
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = [c.strip().removeprefix("W/") for c in header.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+def _not_modified(request: Request, etag: str) -> Optional[Response]:
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=_cache_headers(etag))
+    return None
+
+
+def _cache_headers(etag: str) -> Dict[str, str]:
+    # Pages show one user's receipts: browsers may keep them but must revalidate.
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+
+def _receipts_for_session(session_id: str, client: AHClient, refresh: bool = False):
+    """(receipts, content hash) from the per-session list cache, fetched when stale."""
+    cached = RECEIPT_LISTS.get(session_id)
+    if cached and not refresh and time.time() - cached[0] < RECEIPTS_TTL:
+        return cached[1], cached[2]
+    receipts = client.list_receipts()
+    _save_client_tokens(session_id, client)
+    RECEIPT_LISTS[session_id] = (time.time(), receipts, content_hash(receipts))
+    return receipts, RECEIPT_LISTS[session_id][2]
+
+
+def _month_rows(receipts):
+    """Rendered <tbody> per month, newest first. A new receipt only re-renders its month."""
+    rows_template = templates.get_template("receipt_rows.html")
+    for _month, group in groupby(receipts, key=lambda r: (r.get("transactionMoment") or "")[:7]):
+        group = list(group)
+        yield FRAGMENTS.render("receipt_rows.html", content_hash(group),
+                               lambda: rows_template.render(receipts=group))
+
+
 @app.get("/", response_class=HTMLResponse)
-async def home(request: Request):
+async def home(request: Request, refresh: bool = False):
     session_id = request.session["session_id"]
     client = _get_client_for_session(session_id)
     logged_in = client.has_tokens()
-    receipts = None
-    error = None
-    if logged_in:
-        try:
-            receipts = client.list_receipts()
-            _save_client_tokens(session_id, client)
-        except AHClientError as e:
-            error = str(e)
-    return templates.TemplateResponse("home.html", {
-        "request": request,
-        "logged_in": logged_in,
-        "receipts": receipts,
-        "error": error,
-    })
+    if not logged_in:
+        return templates.TemplateResponse("home.html", {"request": request, "logged_in": False})
+    try:
+        receipts, digest = _receipts_for_session(session_id, client, refresh)
+    except AHClientError as e:
+        return templates.TemplateResponse("home.html", {
+            "request": request,
+            "logged_in": True,
+            "receipt_count": 0,
+            "error": str(e),
+        })
+    etag = f'"home-{digest}"'
+    not_modified = _not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    # Stream the page: the table's month fragments are rendered (or taken from the
+    # cache) one by one as the response is written, instead of building it all first.
+    page = templates.get_template("home.html").generate(
+        request=request,
+        logged_in=True,
+        receipt_count=len(receipts or []),
+        receipt_rows=_month_rows(receipts or []),
+    )
+    return StreamingResponse(page, media_type="text/html", headers=_cache_headers(etag))
 
 
 @app.get("/login", response_class=HTMLResponse)
@@ -83,6 +150,7 @@ async def login_with_code(request: Request, code: str = Form(...)):
 async def logout(request: Request):
     session_id = request.session["session_id"]
     SESSION_TOKENS.pop(session_id, None)
+    RECEIPT_LISTS.pop(session_id, None)
     request.session.clear()
     return RedirectResponse("/", status_code=303)
 
@@ -93,12 +161,34 @@ async def receipt_detail(request: Request, transaction_id: str):
     client = _get_client_for_session(session_id)
     if not client.has_tokens():
         return RedirectResponse("/login", status_code=303)
-    try:
-        data = client.get_receipt(transaction_id)
-        _save_client_tokens(session_id, client)
-    except AHClientError as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    return templates.TemplateResponse("receipt.html", {"request": request, "data": data})
+    digest = RECEIPT_HASHES.get((session_id, transaction_id))
+    if digest is not None:
+        not_modified = _not_modified(request, f'"receipt-{digest}"')
+        if not_modified is not None:
+            return not_modified
+    items_html = FRAGMENTS.lookup("receipt_items.html", digest) if digest else None
+    if items_html is None:
+        try:
+            data = client.get_receipt(transaction_id)
+            _save_client_tokens(session_id, client)
+        except AHClientError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        digest = content_hash(data)
+        RECEIPT_HASHES.put((session_id, transaction_id), digest)
+        items_html = FRAGMENTS.render("receipt_items.html", digest,
+                                      lambda: templates.get_template("receipt_items.html").render(data=data))
+    response = templates.TemplateResponse("receipt.html", {
+        "request": request,
+        "logged_in": True,
+        "items_html": items_html,
+    })
+    response.headers.update(_cache_headers(f'"receipt-{digest}"'))
+    return response
+
+
+@app.get("/cache-stats")
+async def cache_stats():
+    return {"fragments": FRAGMENTS.stats(), "receipts": len(RECEIPT_HASHES), "lists": len(RECEIPT_LISTS)}
 
 
 # Helpful link target to open authorize URL in a new tab
@@ -0,0 +1,76 @@
+"""In-memory caches for rendered HTML.
+
+A receipt never changes once it is issued, so HTML rendered from receipt data is cached
+under a hash of that data: the same content always maps to the same fragment, and new
+content gets a new key instead of invalidating anything. The hash also makes a natural
+ETag.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+
+def content_hash(data: Any) -> str:
+    """Stable hash of JSON-like data (key order does not matter)."""
+    encoded = json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:32]
+
+
+class LRUCache:
+    """A bounded dict that evicts the least recently used entry."""
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Any, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any) -> Optional[Any]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Any, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: Any) -> Optional[Any]:
+        with self._lock:
+            return self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class FragmentCache(LRUCache):
+    """Rendered fragments keyed by (template name, content hash)."""
+
+    def __init__(self, max_entries: int = 1000):
+        super().__init__(max_entries)
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, template: str, digest: str) -> Optional[str]:
+        html = self.get((template, digest))
+        if html is not None:
+            self.hits += 1
+        return html
+
+    def render(self, template: str, digest: str, render: Callable[[], str]) -> str:
+        html = self.lookup(template, digest)
+        if html is not None:
+            return html
+        self.misses += 1
+        key = (template, digest)
+        html = render()
+        self.put(key, html)
+        return html
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self), "hits": self.hits, "misses": self.misses}
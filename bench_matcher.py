@@ -0,0 +1,286 @@
+"""Benchmark and parity check for matcher.BatchMatcher.
+
+Candidates are generated from the products in appie!/search.json, with titles, brands,
+subcategories and prices varied from small word pools so every scoring rule fires;
+receipt lines are generated the same way. `score_reference` is a line-by-line port of
+`scoreProduct` + `PriceDifference` from script.js, used as the timing baseline.
+
+`--check` compares the batch scores with script.js itself: `PriceDifference`, the
+per-line setup of `enrichProductsWithDetails` and `scoreProduct` are cut out of
+script.js and run under node on the same lines and candidates. The per-feature scores
+are also compared with the port. Without node only the port is checked (and the check
+says so).
+
+    python bench_matcher.py                   # time reference vs batch scoring
+    python bench_matcher.py --check           # parity on generated lines, exit 1 on mismatch
+    python bench_matcher.py --lines 200 --candidates 2000
+"""
+import argparse
+import json
+import random
+import re
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from matcher import EXCLUDE_WORDS, FEATURES, STOP_WORDS, BatchMatcher, search_query
+
+FIXTURE = Path(__file__).parent / "appie!" / "search.json"
+SCRIPT = Path(__file__).parent / "script.js"
+
+WORDS = ["melk", "halfvolle", "volle", "kaas", "jong", "belegen", "brood", "volkoren", "tarwe", "appels",
+         "elstar", "pasta", "penne", "tortelloni", "ricotta", "spinazie", "yoghurt", "griekse", "tomaten",
+         "cherry", "ice", "tea", "green", "bananen", "boter", "roomboter", "koffie", "bonen", "pizza",
+         "deeg", "mix", "kruiden", "basis", "extra", "verse", "van", "met", "de"]
+BRANDS = ["AH", "AH Biologisch", "AH Terra", "AH Excellent", "Lipton", "Campina", "Zaanlander", "Barilla", None]
+SUBCATEGORIES = ["Melk", "Kaas jong belegen", "Brood volkoren", "Pasta", "Verse pasta", "Yoghurt",
+                 "Ice tea koolzuurvrij (pakken)", "Appels", "Koffiebonen", None]
+PREFIXES = ["", "", "AH ", "AH BIO ", "AH BIOLOGISCH ", "AH TERRA ", "2 X ", "BONUS "]
+
+
+def load_products():
+    try:
+        return json.loads(FIXTURE.read_text(encoding="utf-8")).get("products") or []
+    except (OSError, ValueError):
+        return []
+
+
+def make_candidates(count, rng):
+    base = load_products() or [{"title": "Lipton Ice tea green", "brand": "Lipton"}]
+    candidates = []
+    for i in range(count):
+        product = dict(base[i % len(base)])
+        brand = rng.choice(BRANDS)
+        words = rng.sample(WORDS, rng.randint(1, 4))
+        product.update(
+            webshopId=100000 + i,
+            title=" ".join(([brand] if brand else []) + words) + rng.choice(["", "", " 1,5 l", " (4-pack)"]),
+            brand=brand,
+            subCategory=rng.choice(SUBCATEGORIES),
+            currentPrice=rng.choice([None, round(rng.uniform(0.3, 6), 2)]),
+            priceBeforeBonus=rng.choice([None, round(rng.uniform(0.3, 6), 2)]),
+        )
+        candidates.append(product)
+    return candidates
+
+
+def make_lines(count, candidates, rng):
+    lines = []
+    for _ in range(count):
+        words = [w.upper() for w in rng.sample(WORDS, rng.randint(1, 3))]
+        quantity = rng.choice(["1", "1", "2", "3", "", "x"])
+        if rng.random() < 0.5:
+            # Price near a real candidate so the price tiers are exercised.
+            price = candidates[rng.randrange(len(candidates))].get("currentPrice") or 1.0
+            unit = price + rng.choice([0, 0.01, 0.05, 0.15, 0.25, 0.45, 0.8])
+        else:
+            unit = rng.uniform(0.3, 6)
+        try:
+            amount = unit * (float(quantity) if quantity else 1)
+        except ValueError:
+            amount = unit
+        lines.append({
+            "description": rng.choice(PREFIXES) + " ".join(words),
+            "quantity": quantity,
+            "amount": f"{amount:.2f}".replace(".", ","),
+            "indicator": rng.choice(["", "B", "BONUS", "bonus"]),
+        })
+    return lines
+
+
+# -- reference: direct port of script.js -------------------------------------
+
+def _js_float(text):
+    # parseFloat: longest numeric prefix, NaN when there is none.
+    match = re.match(r"\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?", text)
+    return float(match.group(0)) if match else float("nan")
+
+
+def price_difference(product_price, compare_price, indicator):
+    if compare_price is None or product_price is None:
+        return 0
+    diff = abs(product_price - compare_price)
+    if indicator and "BONUS" in indicator.upper():
+        if diff < 0.10:
+            return 500
+        if diff < 0.20:
+            return 400
+        if diff < 0.30:
+            return 300
+        if diff < 0.50:
+            return 200
+        return 0
+    return 500 if diff < 0.02 else 0
+
+
+def score_reference(line, product):
+    description = line.get("description") or ""
+    price = _js_float(str(line.get("amount") or "").replace(",", ".", 1))
+    quantity = _js_float(str(line.get("quantity") or "1").replace(",", ".", 1))
+    quantity = quantity if quantity == quantity and quantity != 0 else 1
+    receipt_price = price if price == price else None
+    compare = receipt_price / quantity if receipt_price is not None and quantity > 0 else receipt_price
+
+    product_price = product.get("currentPrice")
+    if product_price is None:
+        product_price = product.get("priceBeforeBonus")
+    parts = dict.fromkeys(FEATURES, 0)
+    parts["price"] = price_difference(product_price, compare, str(line.get("indicator") or ""))
+
+    title = product["title"].lower()
+    brand = (product.get("brand") or "").lower()
+    search_lower = search_query(description).lower()
+    desc_lower = description.lower()
+    search_words = [w for w in search_lower.split(" ") if len(w) > 2]
+    desc_words = [w for w in re.sub("bonus", "", desc_lower, flags=re.IGNORECASE).split(" ") if len(w) > 3]
+    search_set, desc_set = dict.fromkeys(search_words), dict.fromkeys(desc_words)
+    title_words = [w for w in re.split(r"\s+", re.sub(r"[^a-z0-9\s]", " ", title)) if w]
+
+    original = description.upper()
+    if original.startswith("AH BIOLOGISCH") and brand == "ah biologisch":
+        parts["brand"] = 60
+    elif original.startswith("AH BIO") and brand == "ah biologisch":
+        parts["brand"] = 60
+    elif original.startswith("AH TERRA") and brand == "ah terra":
+        parts["brand"] = 60
+    parts["search_words"] = 10 * sum(1 for w in search_set if w in title)
+    if any(w in title for w in EXCLUDE_WORDS):
+        parts["excluded"] = -80
+    parts["desc_words"] = 5 * sum(1 for w in desc_set if w in title)
+    if product.get("subCategory"):
+        sub = product["subCategory"].lower()
+        matches = sum(1 for w in search_set if w in sub)
+        parts["subcategory"] = 25 * matches - (15 if matches == 0 and len(search_words) == 1 else 0)
+    extra = [w for w in title_words if len(w) > 2 and w not in STOP_WORDS and w not in search_set and w not in desc_set]
+    parts["extra_words"] = -8 * len(extra)
+    return parts
+
+
+# -- script.js under node ---------------------------------------------------
+
+# Runs the scoring code cut out of script.js once per (line, candidate) pair, the way
+# enrichProductsWithDetails calls it; `card` stands in for the receipt card's data attributes.
+JS_DRIVER = """
+%(price_difference)s
+const data = JSON.parse(require('fs').readFileSync(0, 'utf8'));
+const totals = data.lines.map(product => {
+    const card = { getAttribute: name => ({ 'data-product-price': product.amount,
+                                            'data-product-quantity': product.quantity })[name] };
+    %(line_setup)s
+    let rawDesc = product.description || '';
+    %(search_query)s
+    %(score_product)s
+    const comparePrice = receiptUnitPrice != null ? receiptUnitPrice : receiptPrice;
+    return data.candidates.map(p => {
+        const productPrice = p.currentPrice ?? p.priceBeforeBonus ?? null;
+        const pd = PriceDifference({ productPrice, comparePrice, receiptIndicator, searchQuery });
+        return scoreProduct(p, pd.score);
+    });
+});
+process.stdout.write(JSON.stringify(totals));
+"""
+
+
+def _js_between(source, start, end):
+    """The source text from `start` up to and including `end`."""
+    i = source.index(start)
+    return source[i:source.index(end, i) + len(end)]
+
+
+def _js_block(source, start):
+    """The function starting at `start`, through the brace that closes its body."""
+    i = source.index(start)
+    depth = 0
+    # The body is the first `{` after the parameter list (which may destructure `{ ... }`).
+    for j in range(source.index("{", source.index(")", i)), len(source)):
+        depth += {"{": 1, "}": -1}.get(source[j], 0)
+        if depth == 0:
+            return source[i:j + 1]
+    raise ValueError(f"unbalanced braces after {start!r}")
+
+
+def score_js(lines, candidates):
+    """Totals from script.js's own scoring code, [line][candidate]; None without node."""
+    node = shutil.which("node")
+    if node is None:
+        return None
+    source = SCRIPT.read_text(encoding="utf-8")
+    program = JS_DRIVER % {
+        "price_difference": _js_block(source, "function PriceDifference("),
+        "line_setup": _js_between(source, "const rawPriceStr", "const expand=false;"),
+        "search_query": _js_between(source, "let searchQuery = rawDesc", ".trim();"),
+        "score_product": _js_block(source, "const scoreProduct = ") + ";",
+    }
+    out = subprocess.run([node, "-e", program], input=json.dumps({"lines": lines, "candidates": candidates}),
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out)
+
+
+def check(lines, candidates):
+    features = BatchMatcher(candidates).score(lines)
+    js_mismatches = 0
+    js_totals = score_js(lines, candidates)
+    if js_totals is None:
+        print("node not found: checking against the Python port of script.js only")
+    else:
+        for i, line in enumerate(lines):
+            for j, product in enumerate(candidates):
+                if features["total"][i, j] != js_totals[i][j]:
+                    js_mismatches += 1
+                    if js_mismatches <= 5:
+                        print(f"mismatch with script.js line={line!r} title={product['title']!r}\n"
+                              f"  script.js={js_totals[i][j]} batch={features['total'][i, j]}")
+        print(f"script.js parity: {len(lines) * len(candidates)} pairs, {js_mismatches} mismatches")
+    mismatches = 0
+    for i, line in enumerate(lines):
+        for j, product in enumerate(candidates):
+            expected = score_reference(line, product)
+            got = {name: int(features[name][i, j]) for name in FEATURES}
+            if got != expected or features["total"][i, j] != sum(expected.values()):
+                mismatches += 1
+                if mismatches <= 5:
+                    print(f"mismatch line={line!r} title={product['title']!r}\n  expected={expected}\n  got={got}")
+    print(f"port parity: {len(lines) * len(candidates)} pairs, {mismatches} mismatches")
+    return mismatches == 0 and js_mismatches == 0
+
+
+def bench(lines, candidates, repeat):
+    start = time.perf_counter()
+    for line in lines:
+        for product in candidates:
+            sum(score_reference(line, product).values())
+    reference = time.perf_counter() - start
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        BatchMatcher(candidates).rank(lines, top=5)
+        timings.append(time.perf_counter() - start)
+    batch = min(timings)
+    pairs = len(lines) * len(candidates)
+    print(f"{len(lines)} lines x {len(candidates)} candidates ({pairs} pairs)")
+    print(f"  reference: {reference * 1000:9.1f} ms  ({pairs / reference:,.0f} pairs/s)")
+    print(f"  batch:     {batch * 1000:9.1f} ms  ({pairs / batch:,.0f} pairs/s)  x{reference / batch:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=60)
+    parser.add_argument("--candidates", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--check", action="store_true", help="only run the parity check")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    candidates = make_candidates(args.candidates, rng)
+    lines = make_lines(args.lines, candidates, rng)
+    if args.check:
+        sys.exit(0 if check(lines, candidates) else 1)
+    bench(lines, candidates, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
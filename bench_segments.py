@@ -0,0 +1,126 @@
+"""Benchmark the columnar line segments against re-parsing receipt JSON.
+
+Generates receipts shaped like appie!/receipt.json (same layout rows, varied product
+lines), writes them as JSON files, converts them with line_segments, and compares file
+size and the time to answer "spend per description" from each.
+
+    python bench_segments.py                  # 500 receipts x ~25 lines
+    python bench_segments.py --receipts 5000
+"""
+import argparse
+import copy
+import json
+import random
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from line_segments import LineSegments, convert
+from receipt_lines import parse_receipt_lines
+
+FIXTURE = Path(__file__).parent / "appie!" / "receipt.json"
+PRODUCTS = ["AH HALFVOLLE MELK", "AH BIO BANANEN", "LIPTON ICE TEA GREEN", "AH JONG BELEGEN 48+", "CAMPINA VLA",
+            "AH TERRA FALAFEL", "BARILLA PENNE", "AH VOLKOREN BROOD", "ELSTAR APPELS", "GRIEKSE YOGHURT",
+            "AH ROOMBOTER", "DOUWE EGBERTS AROMA", "AH TOMATEN CHERRY", "AH KIPFILET", "HERTOG JAN 6-PACK"]
+
+
+def make_receipt(template, number, rng):
+    receipt = copy.deepcopy(template)
+    receipt["transactionId"] = f"T{number:06d}"
+    receipt["transactionMoment"] = f"20{20 + number % 5}-{1 + number % 12:02d}-{1 + number % 28:02d}T10:00:00Z"
+    items = receipt.get("receiptUiItems") or []
+    # Keep the fixture's layout rows; replace the product block with generated lines.
+    start = next((i for i, item in enumerate(items) if item.get("type") == "products-header"), 0) + 1
+    end = next((i for i, item in enumerate(items) if item.get("type") == "subtotal"), len(items))
+    products, bonuses = [], []
+    for description in rng.sample(PRODUCTS, rng.randint(5, len(PRODUCTS))) * rng.randint(1, 2):
+        quantity = rng.randint(1, 3)
+        amount = quantity * rng.randint(59, 899)
+        bonus = rng.random() < 0.2
+        products.append({"type": "product", "quantity": str(quantity), "description": description,
+                         "amount": f"{amount / 100:.2f}".replace(".", ","), "indicator": "B" if bonus else ""})
+        if bonus:
+            bonuses.append({"type": "product", "quantity": "BONUS", "description": description,
+                            "amount": f"-{amount * 0.25 / 100:.2f}".replace(".", ",")})
+    receipt["receiptUiItems"] = items[:start] + [{"type": "divider"}] + products + items[end:end + 2] + bonuses + items[end + 2:]
+    return receipt
+
+
+def spend_from_json(paths):
+    totals = {}
+    for path in paths:
+        for line in parse_receipt_lines(json.loads(path.read_text(encoding="utf-8"))):
+            key = line["description"]
+            totals[key] = totals.get(key, 0) + line["amount_cents"] - line["discount_cents"]
+    return totals
+
+
+def spend_with_numpy(segments):
+    import numpy as np
+    totals = None
+    for segment in segments.segments():
+        codes = np.frombuffer(segment.column("description"), dtype="<u4")
+        paid = np.frombuffer(segment.column("amount"), dtype="<i4").astype(np.int64) \
+            - np.frombuffer(segment.column("discount"), dtype="<i4")
+        sums = np.bincount(codes, weights=paid, minlength=len(segments.descriptions))
+        totals = sums if totals is None else totals + sums
+        del codes, paid
+        segment.close()
+    return {segments.descriptions[i]: int(v) for i, v in enumerate(totals) if v}
+
+
+def timed(fn, *args, repeat=3):
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--receipts", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    template = json.loads(FIXTURE.read_text(encoding="utf-8"))
+    workdir = Path(tempfile.mkdtemp(prefix="appie-segments-"))
+    try:
+        json_dir = workdir / "json"
+        json_dir.mkdir()
+        paths = []
+        for n in range(args.receipts):
+            path = json_dir / f"T{n:06d}.json"
+            path.write_text(json.dumps(make_receipt(template, n, rng)), encoding="utf-8")
+            paths.append(path)
+        json_size = sum(p.stat().st_size for p in paths)
+
+        start = time.perf_counter()
+        lines = convert(paths, workdir / "segments")
+        convert_time = time.perf_counter() - start
+        segments = LineSegments(workdir / "segments")
+        segments.compact()
+        segment_size = segments.size_bytes()
+
+        json_time, expected = timed(spend_from_json, paths)
+        scan_time, scanned = timed(segments.spend_by_description)
+        numpy_time, vectorized = timed(spend_with_numpy, segments)
+        assert scanned == expected == vectorized, "segment scan disagrees with the JSON"
+
+        print(f"{args.receipts} receipts, {lines} product lines (converted in {convert_time * 1000:.0f} ms)")
+        print(f"  size:  json {json_size / 1024:9.1f} KiB   segments {segment_size / 1024:8.1f} KiB"
+              f"   ({json_size / segment_size:.0f}x smaller)")
+        print(f"  spend per description:")
+        print(f"    re-parse json      {json_time * 1000:9.1f} ms")
+        print(f"    memoryview scan    {scan_time * 1000:9.1f} ms   x{json_time / scan_time:.0f}")
+        print(f"    numpy over mmap    {numpy_time * 1000:9.1f} ms   x{json_time / numpy_time:.0f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
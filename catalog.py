@@ -0,0 +1,200 @@
+"""Local catalog of every product seen in upstream search results.
+
+Each product is stored once per webshopId with the fields the UI shows in columns
+(hqId, title, brand, subCategory, salesUnitSize, thumbnail) plus the full product object,
+zlib-compressed, for the product modal. A search result that hasn't changed since it was
+last stored only bumps `last_seen`. Title tokens go into their own table, so local search
+is an index range scan per query word (prefix match) instead of a table scan.
+
+The catalog has no upstream counterpart to sync against (the API only offers search), so
+freshness is tracked per entry: `last_seen` is the last time upstream returned the
+product, and entries older than the caller's ttl count as stale. `checked_at` is the last
+time anyone looked for it upstream, found or not, so a delisted product stays stale while
+refresh attempts for it are still throttled.
+"""
+import hashlib
+import json
+import sqlite3
+import time
+import zlib
+from contextlib import closing
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from history_index import tokenize
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    webshop_id INTEGER PRIMARY KEY,
+    hq_id INTEGER,
+    title TEXT NOT NULL,
+    brand TEXT,
+    sub_category TEXT,
+    sales_unit_size TEXT,
+    image_url TEXT,
+    data BLOB NOT NULL,
+    digest TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    changed_at REAL NOT NULL,
+    checked_at REAL
+);
+CREATE INDEX IF NOT EXISTS products_by_hq_id ON products (hq_id);
+CREATE TABLE IF NOT EXISTS product_tokens (
+    token TEXT NOT NULL,
+    webshop_id INTEGER NOT NULL,
+    PRIMARY KEY (token, webshop_id)
+) WITHOUT ROWID;
+"""
+
+# Thumbnail kept in its own column, for lists that don't need the full product.
+THUMBNAIL_WIDTH = 200
+# Candidates considered per query word before ranking.
+MAX_CANDIDATES = 2000
+
+
+def _brand(product: Dict) -> Optional[str]:
+    brand = product.get("brand")
+    return brand.get("name") if isinstance(brand, dict) else brand
+
+
+def _thumbnail(product: Dict) -> Optional[str]:
+    images = [i for i in product.get("images") or [] if isinstance(i, dict) and i.get("url")]
+    if not images:
+        return None
+    return min(images, key=lambda i: abs((i.get("width") or 0) - THUMBNAIL_WIDTH))["url"]
+
+
+class ProductCatalog:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(products)")}
+            if "checked_at" not in columns:
+                try:
+                    conn.execute("ALTER TABLE products ADD COLUMN checked_at REAL")
+                except sqlite3.OperationalError:
+                    pass  # added by another process in the meantime
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path), timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    # -- writes -----------------------------------------------------------
+
+    def upsert(self, products: Iterable[Dict]) -> int:
+        """Store products from a search response; returns how many were new or changed."""
+        now = time.time()
+        encoded = {}
+        for product in products or []:
+            if not isinstance(product, dict) or product.get("webshopId") is None or not product.get("title"):
+                continue
+            blob = json.dumps(product, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+            encoded[int(product["webshopId"])] = (product, blob, hashlib.sha256(blob).hexdigest()[:32])
+        if not encoded:
+            return 0
+        changed = 0
+        with closing(self._connect()) as conn, conn:
+            known = dict(conn.execute(
+                f"SELECT webshop_id, digest FROM products WHERE webshop_id IN ({','.join('?' * len(encoded))})",
+                list(encoded)).fetchall())
+            conn.executemany("UPDATE products SET last_seen = ?, checked_at = ? WHERE webshop_id = ?",
+                             [(now, now, wid) for wid in encoded if known.get(wid) == encoded[wid][2]])
+            for webshop_id, (product, blob, digest) in encoded.items():
+                if known.get(webshop_id) == digest:
+                    continue
+                changed += 1
+                conn.execute(
+                    "INSERT INTO products (webshop_id, hq_id, title, brand, sub_category, sales_unit_size, image_url,"
+                    " data, digest, first_seen, last_seen, changed_at, checked_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT (webshop_id) DO UPDATE SET hq_id = excluded.hq_id, title = excluded.title,"
+                    " brand = excluded.brand, sub_category = excluded.sub_category,"
+                    " sales_unit_size = excluded.sales_unit_size, image_url = excluded.image_url,"
+                    " data = excluded.data, digest = excluded.digest, last_seen = excluded.last_seen,"
+                    " changed_at = excluded.changed_at, checked_at = excluded.checked_at",
+                    (webshop_id, product.get("hqId"), product["title"], _brand(product), product.get("subCategory"),
+                     product.get("salesUnitSize"), _thumbnail(product), zlib.compress(blob), digest, now, now, now, now))
+                conn.execute("DELETE FROM product_tokens WHERE webshop_id = ?", (webshop_id,))
+                conn.executemany("INSERT OR IGNORE INTO product_tokens (token, webshop_id) VALUES (?, ?)",
+                                 [(token, webshop_id) for token in set(tokenize(product["title"]))])
+        return changed
+
+    def touch(self, webshop_id: int) -> None:
+        """Mark an entry as checked (e.g. a refresh search didn't return it) without changing it.
+
+        `last_seen` is left alone, so the entry stays stale.
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.execute("UPDATE products SET checked_at = ? WHERE webshop_id = ?", (time.time(), webshop_id))
+
+    # -- reads ------------------------------------------------------------
+
+    def get(self, webshop_id: int) -> Optional[Dict]:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM products WHERE webshop_id = ?", (webshop_id,)).fetchone()
+        return _row_to_entry(row, full=True) if row else None
+
+    def by_hq_id(self, hq_id: int) -> List[Dict]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT * FROM products WHERE hq_id = ? ORDER BY last_seen DESC", (hq_id,)).fetchall()
+        return [_row_to_entry(r, full=True) for r in rows]
+
+    def search(self, query: str, limit: int = 20, full: bool = False) -> List[Dict]:
+        """Products whose title has a word starting with every query word.
+
+        Exact word matches rank above prefix matches; ties go to the most recently seen.
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        with closing(self._connect()) as conn:
+            scores: Optional[Dict[int, int]] = None
+            for token in tokens:
+                rows = conn.execute(
+                    "SELECT token, webshop_id FROM product_tokens WHERE token >= ? AND token < ? LIMIT ?",
+                    (token, token + "\uffff", MAX_CANDIDATES)).fetchall()
+                token_scores: Dict[int, int] = {}
+                for row in rows:
+                    exact = int(row["token"] == token)
+                    token_scores[row["webshop_id"]] = max(token_scores.get(row["webshop_id"], 0), exact)
+                scores = token_scores if scores is None else \
+                    {w: s + token_scores[w] for w, s in scores.items() if w in token_scores}
+                if not scores:
+                    return []
+            placeholders = ",".join("?" * len(scores))
+            rows = conn.execute(f"SELECT * FROM products WHERE webshop_id IN ({placeholders})",
+                                list(scores)).fetchall()
+        rows.sort(key=lambda r: r["last_seen"], reverse=True)
+        rows.sort(key=lambda r: scores[r["webshop_id"]], reverse=True)
+        return [_row_to_entry(r, full=full) for r in rows[:limit]]
+
+    def stats(self) -> Dict:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT COUNT(*) AS products, MIN(last_seen) AS oldest, SUM(LENGTH(data)) AS bytes"
+                               " FROM products").fetchone()
+            tokens = conn.execute("SELECT COUNT(*) FROM product_tokens").fetchone()[0]
+        return {"products": row["products"], "tokens": tokens, "dataBytes": row["bytes"] or 0,
+                "oldestSeen": row["oldest"]}
+
+
+def _row_to_entry(row: sqlite3.Row, full: bool = False) -> Dict:
+    entry = {
+        "webshopId": row["webshop_id"],
+        "hqId": row["hq_id"],
+        "title": row["title"],
+        "brand": row["brand"],
+        "subCategory": row["sub_category"],
+        "salesUnitSize": row["sales_unit_size"],
+        "imageUrl": row["image_url"],
+        "lastSeen": row["last_seen"],
+        "changedAt": row["changed_at"],
+        "checkedAt": row["checked_at"] or row["last_seen"],
+    }
+    if full:
+        entry["product"] = json.loads(zlib.decompress(row["data"]))
+    return entry
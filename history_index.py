@@ -0,0 +1,216 @@
+"""Full-text index over the stored receipt lines ("when did I last buy X").
+
+Per account, distinct line descriptions are dictionary-encoded and tokenized into an
+inverted index (term -> description ids). Query tokens match terms exactly, by prefix
+(bisect over the sorted term list) or, for typos, by trigram similarity (trigram ->
+terms). Every description keeps its purchases (date, quantity, amounts), so a search
+answers from memory without opening receipts.
+
+An account's index is built from the ReceiptStore on first search and then kept current
+by `add_lines` as new receipt details are stored. `build` reads the whole history, so the
+server runs it in a worker thread; receipts stored while it runs are queued and indexed
+when the build finishes.
+"""
+import bisect
+import re
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+from receipt_store import ReceiptStore
+
+# Weights per kind of term match; a description's score is the sum over query tokens.
+EXACT_WEIGHT = 3.0
+PREFIX_WEIGHT = 2.0
+# Minimum trigram (Jaccard) similarity for a typo-tolerant match, and its weight factor.
+FUZZY_THRESHOLD = 0.4
+FUZZY_WEIGHT = 1.5
+MIN_FUZZY_LENGTH = 3
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN.findall((text or "").lower())
+
+
+def trigrams(term: str) -> Set[str]:
+    padded = f"  {term} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class _AccountIndex:
+    def __init__(self):
+        self.descriptions: List[str] = []
+        self.description_ids: Dict[str, int] = {}
+        # description id -> [(moment, transaction_id, quantity, amount_cents, discount_cents, bonus)]
+        self.purchases: List[List[Tuple]] = []
+        self.postings: Dict[str, Set[int]] = {}
+        self.terms: List[str] = []  # sorted, for prefix scans
+        self.term_trigrams: Dict[str, Set[str]] = {}
+        self.trigram_terms: Dict[str, Set[str]] = {}
+        self.transactions: Set[str] = set()
+
+    def _add_term(self, term: str, description_id: int) -> None:
+        posting = self.postings.get(term)
+        if posting is None:
+            posting = self.postings[term] = set()
+            bisect.insort(self.terms, term)
+            grams = self.term_trigrams[term] = trigrams(term)
+            for gram in grams:
+                self.trigram_terms.setdefault(gram, set()).add(term)
+        posting.add(description_id)
+
+    def add(self, line: Dict) -> None:
+        description = line["description"]
+        description_id = self.description_ids.get(description)
+        if description_id is None:
+            description_id = self.description_ids[description] = len(self.descriptions)
+            self.descriptions.append(description)
+            self.purchases.append([])
+            for term in set(tokenize(description)):
+                self._add_term(term, description_id)
+        self.purchases[description_id].append((
+            line.get("moment"), line.get("transaction_id"), line["quantity"], line["amount_cents"],
+            line.get("discount_cents") or 0, bool(line.get("bonus")),
+        ))
+
+    def matching_terms(self, token: str) -> Dict[str, float]:
+        """term -> weight for one query token: exact, prefix and trigram-similar terms."""
+        matches: Dict[str, float] = {}
+        start = bisect.bisect_left(self.terms, token)
+        for term in self.terms[start:]:
+            if not term.startswith(token):
+                break
+            matches[term] = EXACT_WEIGHT if term == token else PREFIX_WEIGHT
+        if len(token) >= MIN_FUZZY_LENGTH:
+            grams = trigrams(token)
+            shared: Dict[str, int] = {}
+            for gram in grams:
+                for term in self.trigram_terms.get(gram, ()):
+                    shared[term] = shared.get(term, 0) + 1
+            for term, count in shared.items():
+                similarity = count / (len(grams) + len(self.term_trigrams[term]) - count)
+                if similarity >= FUZZY_THRESHOLD:
+                    matches[term] = max(matches.get(term, 0.0), FUZZY_WEIGHT * similarity)
+        return matches
+
+
+def _add_receipt(index: _AccountIndex, lines: List[Dict]) -> None:
+    transaction_id = lines[0].get("transaction_id")
+    if transaction_id in index.transactions:
+        return
+    index.transactions.add(transaction_id)
+    for line in lines:
+        index.add(line)
+
+
+class HistoryIndex:
+    def __init__(self, store: ReceiptStore):
+        self.store = store
+        self._accounts: Dict[str, _AccountIndex] = {}
+        # account -> receipts (line lists) stored while its index is being built
+        self._backlog: Dict[str, List[List[Dict]]] = {}
+        self._lock = threading.Lock()
+        self._build_locks: Dict[str, threading.Lock] = {}
+
+    def build(self, account: str) -> None:
+        """Build the account's index from the store unless it is built already (blocking)."""
+        with self._lock:
+            if account in self._accounts:
+                return
+            build_lock = self._build_locks.setdefault(account, threading.Lock())
+        with build_lock:
+            with self._lock:
+                if account in self._accounts:
+                    return
+                backlog = self._backlog[account] = []
+            index = _AccountIndex()
+            for line in self.store.iter_lines(account):
+                index.transactions.add(line["transaction_id"])
+                index.add(line)
+            with self._lock:
+                if self._backlog.get(account) is not backlog:
+                    return  # forgotten while building; the next search builds again
+                del self._backlog[account]
+                for lines in backlog:
+                    _add_receipt(index, lines)
+                self._accounts[account] = index
+
+    def _index(self, account: str) -> _AccountIndex:
+        index = self._accounts.get(account)
+        while index is None:
+            self.build(account)
+            index = self._accounts.get(account)
+        return index
+
+    def forget(self, account: str) -> None:
+        """Drop the account's in-memory state; it is rebuilt from the store on next use."""
+        with self._lock:
+            self._accounts.pop(account, None)
+            self._backlog.pop(account, None)
+
+    def add_lines(self, account: str, lines: List[Dict]) -> None:
+        """Index the lines of a newly stored receipt (no-op until the account is first searched)."""
+        if not lines:
+            return
+        with self._lock:
+            index = self._accounts.get(account)
+            if index is None:
+                if account in self._backlog:
+                    self._backlog[account].append(lines)
+                return
+            _add_receipt(index, lines)
+
+    def search(self, account: str, query: str, limit: int = 20, purchases_limit: Optional[int] = 20) -> List[Dict]:
+        """Descriptions matching every query token, best match (then most recent) first."""
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        index = self._index(account)
+        scores: Optional[Dict[int, float]] = None
+        for token in tokens:
+            token_scores: Dict[int, float] = {}
+            for term, weight in index.matching_terms(token).items():
+                for description_id in index.postings[term]:
+                    if weight > token_scores.get(description_id, 0.0):
+                        token_scores[description_id] = weight
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {d: s + token_scores[d] for d, s in scores.items() if d in token_scores}
+            if not scores:
+                return []
+
+        results = []
+        for description_id, score in scores.items():
+            purchases = sorted(index.purchases[description_id], key=lambda p: p[0] or "", reverse=True)
+            results.append({
+                "description": index.descriptions[description_id],
+                "score": round(score, 3),
+                "purchases": len(purchases),
+                "lastBought": purchases[0][0] if purchases else None,
+                "totalQuantity": sum(p[2] for p in purchases),
+                "totalSpent": round(sum(p[3] - p[4] for p in purchases) / 100, 2),
+                "lines": [
+                    {
+                        "date": moment,
+                        "transactionId": transaction_id,
+                        "quantity": quantity,
+                        "amount": round((amount - discount) / 100, 2),
+                        "discount": round(discount / 100, 2),
+                        "bonus": bonus,
+                    }
+                    for moment, transaction_id, quantity, amount, discount, bonus in purchases[:purchases_limit]
+                ],
+            })
+        # Best score first; within equal scores, most recent purchase first.
+        results.sort(key=lambda r: r["lastBought"] or "", reverse=True)
+        results.sort(key=lambda r: r["score"], reverse=True)
+        return results[:limit]
+
+    def stats(self, account: str) -> Dict:
+        index = self._accounts.get(account)
+        if index is None:
+            return {"built": False}
+        return {"built": True, "descriptions": len(index.descriptions), "terms": len(index.terms),
+                "trigrams": len(index.trigram_terms), "receipts": len(index.transactions)}
@@ -0,0 +1,290 @@
+"""Durable background jobs.
+
+Long request chains (backfilling every receipt detail, enriching receipt lines with
+product matches) don't fit in one HTTP request on serverless, so they run as jobs: the
+request only inserts a row into a SQLite queue and returns its id; an asyncio worker
+pool claims queued jobs, reports progress into the row and stores the result.
+
+- Durable: jobs live in SQLite; a job whose worker died (its lease expired) is claimed
+  again by the next worker, in this process or a later one.
+- Retries: a failing job is requeued with exponential backoff (plus jitter) until it has
+  used `max_attempts`, then marked failed with the last error.
+- Idempotency: submitting with an idempotency key that the account already used returns
+  the existing job instead of creating a new one, unless that job failed: then the key
+  moves to a new job, so a retry after a failure runs again.
+
+Handlers are registered per job kind by the application (see server.py) and receive a
+`Job`; they should be safe to re-run, since a retried job starts from the beginning.
+"""
+import asyncio
+import json
+import random
+import sqlite3
+import time
+import uuid
+from contextlib import closing
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    account TEXT NOT NULL,
+    idempotency_key TEXT,
+    params TEXT,
+    context TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    run_after REAL NOT NULL,
+    lease_until REAL,
+    progress TEXT,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_by_idempotency_key ON jobs (account, idempotency_key);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, run_after);
+CREATE INDEX IF NOT EXISTS jobs_by_account ON jobs (account, created_at);
+"""
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+TERMINAL = (SUCCEEDED, FAILED)
+
+
+class UnknownJobKind(ValueError):
+    pass
+
+
+class Job:
+    """What a handler sees: the job's parameters plus a way to report progress."""
+
+    def __init__(self, queue: "JobQueue", row: sqlite3.Row):
+        self.queue = queue
+        self.id = row["id"]
+        self.kind = row["kind"]
+        self.account = row["account"]
+        self.attempt = row["attempts"]
+        self.params: Dict = json.loads(row["params"]) if row["params"] else {}
+        # Submission-time request state (e.g. the cookies needed to call upstream).
+        self.context: Dict = json.loads(row["context"]) if row["context"] else {}
+
+    def progress(self, done: int, total: Optional[int] = None, message: Optional[str] = None) -> None:
+        self.queue._update(self.id, progress=json.dumps({"done": done, "total": total, "message": message}),
+                           lease_until=time.time() + self.queue.lease)
+
+
+Handler = Callable[[Job], Awaitable[Any]]
+
+
+class JobQueue:
+    def __init__(self, path: Path, concurrency: int = 2, max_attempts: int = 4, backoff: float = 2.0,
+                 max_backoff: float = 300.0, lease: float = 120.0, poll_interval: float = 1.0):
+        self.path = Path(path)
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # A running job must report progress (or finish) within this many seconds, or it is
+        # considered abandoned and claimed again.
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._handlers: Dict[str, Handler] = {}
+        self._workers: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path), timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def register(self, kind: str, handler: Handler) -> None:
+        self._handlers[kind] = handler
+
+    @property
+    def kinds(self) -> List[str]:
+        return sorted(self._handlers)
+
+    # -- submitting & reading ---------------------------------------------
+
+    def submit(self, kind: str, account: str, params: Optional[Dict] = None, context: Optional[Dict] = None,
+               idempotency_key: Optional[str] = None, max_attempts: Optional[int] = None) -> Dict:
+        """Queue a job and return it; with a known idempotency key, return the earlier job.
+
+        A failed earlier job gives up its key (it keeps its row and error) and a new job is queued.
+        """
+        if kind not in self._handlers:
+            raise UnknownJobKind(kind)
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        with closing(self._connect()) as conn, conn:
+            if idempotency_key:
+                row = conn.execute("SELECT * FROM jobs WHERE account = ? AND idempotency_key = ?",
+                                   (account, idempotency_key)).fetchone()
+                if row is not None and row["status"] != FAILED:
+                    return _row_to_job(row)
+                if row is not None:
+                    conn.execute("UPDATE jobs SET idempotency_key = NULL WHERE id = ? AND status = ?",
+                                 (row["id"], FAILED))
+            try:
+                conn.execute(
+                    "INSERT INTO jobs (id, kind, account, idempotency_key, params, context, status, max_attempts,"
+                    " run_after, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, kind, account, idempotency_key, json.dumps(params or {}),
+                     json.dumps(context) if context else None, QUEUED, max_attempts or self.max_attempts,
+                     now, now, now))
+            except sqlite3.IntegrityError:
+                # Another process submitted the same idempotency key in the meantime.
+                row = conn.execute("SELECT * FROM jobs WHERE account = ? AND idempotency_key = ?",
+                                   (account, idempotency_key)).fetchone()
+                return _row_to_job(row)
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return _row_to_job(row)
+
+    def get(self, job_id: str, account: Optional[str] = None) -> Optional[Dict]:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or (account is not None and row["account"] != account):
+            return None
+        return _row_to_job(row)
+
+    def result(self, job_id: str, account: Optional[str] = None) -> Optional[Any]:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT account, result FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or (account is not None and row["account"] != account) or row["result"] is None:
+            return None
+        return json.loads(row["result"])
+
+    def list(self, account: str, limit: int = 50) -> List[Dict]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT * FROM jobs WHERE account = ? ORDER BY created_at DESC LIMIT ?",
+                                (account, limit)).fetchall()
+        return [_row_to_job(r) for r in rows]
+
+    def counts(self) -> Dict[str, int]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {r["status"]: r["n"] for r in rows}
+
+    # -- workers ----------------------------------------------------------
+
+    def _update(self, job_id: str, **fields) -> None:
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def _claim(self) -> Optional[sqlite3.Row]:
+        """Atomically take the oldest runnable job (or one whose lease expired)."""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT id FROM jobs WHERE (status = ? AND run_after <= ?) OR (status = ? AND lease_until < ?)"
+                    " ORDER BY run_after LIMIT 1", (QUEUED, now, RUNNING, now)).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                conn.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_until = ?, updated_at = ?"
+                    " WHERE id = ?", (RUNNING, now + self.lease, now, row["id"]))
+                claimed = conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+                conn.execute("COMMIT")
+                return claimed
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    async def _run(self, row: sqlite3.Row) -> None:
+        job = Job(self, row)
+        handler = self._handlers.get(job.kind)
+        try:
+            if handler is None:
+                raise UnknownJobKind(job.kind)
+            result = await handler(job)
+        except asyncio.CancelledError:
+            # Shutting down: hand the job back without spending an attempt.
+            self._update(job.id, status=QUEUED, attempts=max(0, job.attempt - 1), lease_until=None)
+            raise
+        except Exception as exc:
+            error = f"{type(exc).__name__}: {getattr(exc, 'detail', None) or exc}"
+            if job.attempt < row["max_attempts"] and not isinstance(exc, UnknownJobKind):
+                delay = min(self.max_backoff, self.backoff * 2 ** (job.attempt - 1))
+                delay *= random.uniform(0.8, 1.2)
+                self._update(job.id, status=QUEUED, run_after=time.time() + delay, lease_until=None, error=error)
+            else:
+                self._update(job.id, status=FAILED, lease_until=None, error=error, context=None)
+            return
+        self._update(job.id, status=SUCCEEDED, lease_until=None, error=None, context=None,
+                     result=json.dumps(result))
+
+    async def _worker(self) -> None:
+        while True:
+            try:
+                row = await asyncio.to_thread(self._claim)
+            except sqlite3.Error:
+                row = None
+            if row is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(row)
+
+    def start(self) -> None:
+        if self._workers or self.concurrency <= 0:
+            return
+        self._wakeup = asyncio.Event()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self) -> None:
+        workers, self._workers = self._workers, []
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    async def watch(self, job_id: str, account: Optional[str] = None, interval: float = 0.5):
+        """Yield the job each time it changes, until it reaches a terminal status."""
+        last = None
+        while True:
+            job = self.get(job_id, account)
+            if job is None:
+                return
+            if job["updatedAt"] != last:
+                last = job["updatedAt"]
+                yield job
+            if job["status"] in TERMINAL:
+                return
+            await asyncio.sleep(interval)
+
+
+def _row_to_job(row: sqlite3.Row) -> Dict:
+    return {
+        "id": row["id"],
+        "kind": row["kind"],
+        "status": row["status"],
+        "params": json.loads(row["params"]) if row["params"] else {},
+        "idempotencyKey": row["idempotency_key"],
+        "attempts": row["attempts"],
+        "maxAttempts": row["max_attempts"],
+        "progress": json.loads(row["progress"]) if row["progress"] else None,
+        "error": row["error"],
+        "hasResult": row["result"] is not None,
+        "runAfter": row["run_after"] if row["status"] == QUEUED else None,
+        "createdAt": row["created_at"],
+        "updatedAt": row["updated_at"],
+    }
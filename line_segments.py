@@ -0,0 +1,396 @@
+"""Columnar, memory-mapped storage for parsed receipt lines.
+
+Raw receipt JSON is mostly layout (spacers, dividers, text rows); answering a question
+from it means re-parsing every receipt. This format keeps only the parsed product lines
+(see `receipt_lines.parse_receipt_lines`) in fixed-width columns:
+
+    transaction   uint32   id into transactions.txt
+    day           uint16   days since 1970-01-01 (UTC)
+    description   uint32   id into descriptions.txt
+    quantity      uint16
+    amount        int32    line total in cents, before bonus discounts
+    discount      int32    bonus discount in cents (>= 0)
+    bonus         bitmap   one bit per line
+
+Descriptions and transaction ids are dictionary-encoded in append-only text files (line
+number = id), like the price history keys. Writers (`append`, `compact`) hold an exclusive
+lock on the directory and first pick up dictionary entries and segments other processes
+wrote, so concurrent conversions into one directory agree on every id. Lines are stored in immutable segment files
+listed in a manifest (segments.txt); `append` writes a new segment and `compact` merges
+segments into one, each switching the manifest with a temp file + rename so readers never
+see a partial segment or a half-finished merge. Readers mmap a segment and get each column
+as a `memoryview` cast to its type, so a scan touches the page cache rather than
+building Python objects; `numpy.frombuffer` on a column is zero-copy as well.
+
+Columns are little-endian and 8-byte aligned. On a big-endian host `Segment.column`
+returns a byte-swapped copy instead of a view.
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, run one writer at a time there
+    fcntl = None
+
+from receipt_lines import parse_moment, parse_receipt_lines
+
+MAGIC = b"APLS"
+VERSION = 1
+# magic, version, reserved, row count
+_HEADER = struct.Struct("<4sHHQ")
+# (name, array/memoryview typecode); "bonus" is a bitmap and handled separately.
+COLUMNS = (("transaction", "I"), ("day", "H"), ("description", "I"), ("quantity", "H"),
+           ("amount", "i"), ("discount", "i"))
+_ITEM_SIZE = {"I": 4, "H": 2, "i": 4}
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+NO_DAY = 0xFFFF
+MANIFEST = "segments.txt"
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+def _layout(rows: int) -> Dict[str, tuple]:
+    """name -> (offset, byte length) for a segment with `rows` lines."""
+    layout, offset = {}, _align(_HEADER.size)
+    for name, code in COLUMNS:
+        layout[name] = (offset, rows * _ITEM_SIZE[code])
+        offset = _align(offset + rows * _ITEM_SIZE[code])
+    layout["bonus"] = (offset, (rows + 7) // 8)
+    return layout
+
+
+def day_number(moment) -> int:
+    parsed = parse_moment(moment) if isinstance(moment, str) or moment is None else moment
+    if parsed is None:
+        return NO_DAY
+    return (parsed - EPOCH).days
+
+
+def day_to_iso(day: int) -> Optional[str]:
+    if day == NO_DAY:
+        return None
+    return datetime.fromtimestamp(day * 86400, tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+class Segment:
+    """One mmapped segment file; columns are views into the mapping."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with self.path.open("rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _reserved, self.rows = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError(f"{self.path} is not a receipt line segment")
+        self._layout = _layout(self.rows)
+        self._view = memoryview(self._map)
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def column(self, name: str) -> memoryview:
+        offset, length = self._layout[name]
+        raw = self._view[offset:offset + length]
+        if name == "bonus":
+            return raw
+        code = dict(COLUMNS)[name]
+        if sys.byteorder == "little":
+            return raw.cast(code)
+        swapped = array(code, raw.tobytes())
+        swapped.byteswap()
+        return memoryview(swapped)
+
+    def bonus(self, row: int) -> bool:
+        return bool(self.column("bonus")[row >> 3] >> (row & 7) & 1)
+
+    def close(self) -> None:
+        self._view.release()
+        self._map.close()
+
+
+def _write_segment(path: Path, columns: Dict[str, array], bonus: bytearray) -> None:
+    rows = len(columns["transaction"])
+    layout = _layout(rows)
+    end = layout["bonus"][0] + layout["bonus"][1]
+    buffer = bytearray(end)
+    _HEADER.pack_into(buffer, 0, MAGIC, VERSION, 0, rows)
+    for name, code in COLUMNS:
+        data = columns[name]
+        if sys.byteorder != "little":
+            data = array(code, data)
+            data.byteswap()
+        offset, length = layout[name]
+        buffer[offset:offset + length] = data.tobytes()
+    offset, length = layout["bonus"]
+    buffer[offset:offset + length] = bonus
+    tmp = path.with_suffix(".tmp")
+    with tmp.open("wb") as f:
+        f.write(buffer)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class LineSegments:
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.descriptions: List[str] = self._read_dictionary("descriptions.txt")
+        self._description_ids = {d: i for i, d in enumerate(self.descriptions)}
+        self.transactions: List[str] = self._read_dictionary("transactions.txt")
+        self._transaction_ids = {t: i for i, t in enumerate(self.transactions)}
+        self._stored = None
+        self._stored_for: List[Path] = []
+
+    def _read_dictionary(self, name: str) -> List[str]:
+        path = self.directory / name
+        return path.read_text(encoding="utf-8").splitlines() if path.exists() else []
+
+    @contextmanager
+    def _writing(self):
+        """Exclusive write access to the directory, with what other writers added loaded."""
+        with (self.directory / "lock").open("a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            for name, values, ids in (("descriptions.txt", self.descriptions, self._description_ids),
+                                      ("transactions.txt", self.transactions, self._transaction_ids)):
+                path = self.directory / name
+                if path.exists() and path.stat().st_size:
+                    # A line torn by a killed writer becomes a (junk) entry of its own.
+                    with path.open("rb+") as f:
+                        f.seek(-1, 2)
+                        if f.read(1) != b"\n":
+                            f.write(b"\n")
+                for value in self._read_dictionary(name)[len(values):]:
+                    ids[value] = len(values)
+                    values.append(value)
+            yield
+
+    def _append_dictionary(self, name: str, entries: List[str]) -> None:
+        if entries:
+            with (self.directory / name).open("a", encoding="utf-8") as f:
+                f.write("".join(e + "\n" for e in entries))
+
+    def _encode(self, values: List[str], ids: Dict[str, int], new: List[str], value: str) -> int:
+        code = ids.get(value)
+        if code is None:
+            code = ids[value] = len(values)
+            values.append(value)
+            new.append(value)
+        return code
+
+    def segment_paths(self) -> List[Path]:
+        """Live segments, as listed in the manifest (files not listed there are leftovers)."""
+        manifest = self.directory / MANIFEST
+        if not manifest.exists():
+            return []
+        return [self.directory / name for name in manifest.read_text(encoding="utf-8").split()]
+
+    def _write_manifest(self, paths: List[Path]) -> None:
+        tmp = self.directory / (MANIFEST + ".tmp")
+        tmp.write_text("".join(p.name + "\n" for p in paths), encoding="utf-8")
+        os.replace(tmp, self.directory / MANIFEST)
+
+    def _next_segment_path(self) -> Path:
+        numbers = [int(p.stem.split("-")[1]) for p in self.directory.glob("segment-*.col")]
+        return self.directory / f"segment-{max(numbers, default=0) + 1:06d}.col"
+
+    def _stored_transactions(self) -> set:
+        # From the segments rather than the dictionary: a crash between writing the
+        # dictionary and the segment must not make those receipts look converted.
+        paths = self.segment_paths()
+        if self._stored is None or paths != self._stored_for:
+            self._stored_for = paths
+            codes = set()
+            for segment in self.segments(paths):
+                column = segment.column("transaction")
+                codes.update(column)
+                del column
+                segment.close()
+            self._stored = {self.transactions[c] for c in codes}
+        return self._stored
+
+    # -- writing ----------------------------------------------------------
+
+    def append(self, lines: Iterable[Dict]) -> int:
+        """Write lines (dicts with description, quantity, amount_cents, discount_cents, bonus,
+        moment, transaction_id) as a new segment; returns the number of lines written.
+
+        Transactions already present in the store are skipped, so re-converting is harmless.
+        """
+        lines = list(lines)
+        with self._writing():
+            return self._append(lines)
+
+    def _append(self, lines: List[Dict]) -> int:
+        columns = {name: array(code) for name, code in COLUMNS}
+        bonus = bytearray()
+        new_descriptions: List[str] = []
+        new_transactions: List[str] = []
+        known = self._stored_transactions()
+        added = set()
+        for line in lines:
+            transaction_id = str(line.get("transaction_id") or "")
+            if transaction_id in known:
+                continue
+            added.add(transaction_id)
+            row = len(columns["transaction"])
+            columns["transaction"].append(self._encode(self.transactions, self._transaction_ids,
+                                                       new_transactions, transaction_id))
+            columns["day"].append(day_number(line.get("moment")))
+            columns["description"].append(self._encode(self.descriptions, self._description_ids,
+                                                       new_descriptions, line["description"]))
+            columns["quantity"].append(min(int(line["quantity"]), 0xFFFF))
+            columns["amount"].append(int(line["amount_cents"]))
+            columns["discount"].append(int(line.get("discount_cents") or 0))
+            if row % 8 == 0:
+                bonus.append(0)
+            if line.get("bonus"):
+                bonus[-1] |= 1 << (row % 8)
+        rows = len(columns["transaction"])
+        if not rows:
+            return 0
+        # Dictionaries first, so every id in a segment on disk resolves.
+        self._append_dictionary("descriptions.txt", new_descriptions)
+        self._append_dictionary("transactions.txt", new_transactions)
+        path = self._next_segment_path()
+        _write_segment(path, columns, bonus)
+        self._write_manifest(self.segment_paths() + [path])
+        known.update(added)
+        self._stored_for = self.segment_paths()
+        return rows
+
+    def append_receipts(self, receipts: Iterable[tuple]) -> int:
+        """Append (transaction id, receipt detail) pairs as one segment."""
+        return self.append(
+            {**line, "moment": detail.get("transactionMoment"), "transaction_id": transaction_id}
+            for transaction_id, detail in receipts
+            for line in parse_receipt_lines(detail)
+        )
+
+    def compact(self) -> int:
+        """Merge all segments into one; returns the number of segments merged."""
+        with self._writing():
+            return self._compact()
+
+    def _compact(self) -> int:
+        paths = self.segment_paths()
+        if len(paths) < 2:
+            return 0
+        columns = {name: array(code) for name, code in COLUMNS}
+        bonus = bytearray()
+        rows = 0
+        for segment in self.segments(paths):
+            for name, _code in COLUMNS:
+                columns[name].extend(segment.column(name))
+            bits = segment.column("bonus")
+            for i in range(len(segment)):
+                if rows % 8 == 0:
+                    bonus.append(0)
+                if bits[i >> 3] >> (i & 7) & 1:
+                    bonus[-1] |= 1 << (rows % 8)
+                rows += 1
+            del bits
+            segment.close()
+        target = self._next_segment_path()
+        _write_segment(target, columns, bonus)
+        # The manifest switch is the commit point; a crash before it leaves the old segments live.
+        self._write_manifest([target])
+        for path in paths:
+            path.unlink()
+        self._stored_for = [target]
+        return len(paths)
+
+    # -- reading ----------------------------------------------------------
+
+    def segments(self, paths: Optional[List[Path]] = None) -> Iterator[Segment]:
+        for path in paths if paths is not None else self.segment_paths():
+            yield Segment(path)
+
+    def rows(self) -> Iterator[Dict]:
+        """Decode every line back into a dict (for exports; scans should use the columns)."""
+        for segment in self.segments():
+            cols = {name: segment.column(name) for name, _code in COLUMNS}
+            for i in range(len(segment)):
+                yield {
+                    "transaction_id": self.transactions[cols["transaction"][i]],
+                    "date": day_to_iso(cols["day"][i]),
+                    "description": self.descriptions[cols["description"][i]],
+                    "quantity": cols["quantity"][i],
+                    "amount_cents": cols["amount"][i],
+                    "discount_cents": cols["discount"][i],
+                    "bonus": segment.bonus(i),
+                }
+            del cols
+            segment.close()
+
+    def spend_by_description(self, start_day: int = 0, end_day: int = NO_DAY) -> Dict[str, int]:
+        """Cents paid per description for lines with start_day <= day < end_day."""
+        totals: Dict[int, int] = {}
+        for segment in self.segments():
+            days = segment.column("day")
+            descriptions = segment.column("description")
+            amounts = segment.column("amount")
+            discounts = segment.column("discount")
+            for i in range(len(segment)):
+                if start_day <= days[i] < end_day:
+                    key = descriptions[i]
+                    totals[key] = totals.get(key, 0) + amounts[i] - discounts[i]
+            del days, descriptions, amounts, discounts
+            segment.close()
+        return {self.descriptions[k]: v for k, v in totals.items()}
+
+    def size_bytes(self) -> int:
+        files = self.segment_paths() + [self.directory / "descriptions.txt", self.directory / "transactions.txt"]
+        return sum(p.stat().st_size for p in files if p.exists())
+
+
+def convert(sources: List[Path], directory: Path, account: Optional[str] = None) -> int:
+    """Append receipts from JSON detail files or a receipts.sqlite store to a segment directory."""
+    segments = LineSegments(directory)
+    written = 0
+    for store in (s for s in sources if s.suffix == ".sqlite"):
+        from receipt_store import ReceiptStore
+        if not account:
+            raise SystemExit("--account is required when converting a receipts.sqlite store")
+        written += segments.append(ReceiptStore(store).iter_lines(account))
+
+    def details():
+        for path in sources:
+            if path.suffix != ".sqlite":
+                detail = json.loads(path.read_text(encoding="utf-8"))
+                yield str(detail.get("transactionId") or path.stem), detail
+    # All JSON files go into one segment.
+    written += segments.append_receipts(details())
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert receipts into columnar line segments.")
+    parser.add_argument("sources", nargs="+", type=Path, help="receipt detail JSON files or a receipts.sqlite store")
+    parser.add_argument("--out", type=Path, required=True, help="segment directory")
+    parser.add_argument("--account", help="account id (appie_account cookie) to convert from a receipts.sqlite store")
+    parser.add_argument("--compact", action="store_true", help="merge all segments afterwards")
+    args = parser.parse_args()
+    written = convert(args.sources, args.out, args.account)
+    segments = LineSegments(args.out)
+    if args.compact:
+        segments.compact()
+    print(f"{written} lines written; {len(segments.segment_paths())} segments, {segments.size_bytes()} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""Learned receipt description -> product matches.
+
+The frontend matcher (`enrichProductsWithDetails` in script.js) searches and scores
+candidates for every receipt line. Descriptions such as "AH HALFVOLLE MELK" recur on almost
+every receipt, so the product is remembered here, keyed by the normalized description plus
+the AH-brand flag, together with the score margin over the runner-up and the receipt unit
+price at match time. Entries are shared by all accounts, so only the server writes them: it
+searches and scores the line itself (`match_description` in server.py) and records its own
+result.
+
+A lookup is a hit only when the entry is confident (the margin was large enough). When the
+receipt price drifts too far from the price at match time the lookup is a miss, but the
+entry stays until a new server-side search replaces it. When a user rejects a match, only
+that account stops getting it: the rejection is stored per account and the shared entry
+stays for everyone else.
+"""
+import json
+import re
+import sqlite3
+import time
+from contextlib import closing
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from receipt_lines import normalize_description
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS matches (
+    description TEXT NOT NULL,
+    ah INTEGER NOT NULL,
+    webshop_id INTEGER NOT NULL,
+    title TEXT,
+    score REAL,
+    margin REAL,
+    price_cents INTEGER,
+    product TEXT,
+    source TEXT NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (description, ah)
+);
+CREATE INDEX IF NOT EXISTS matches_by_product ON matches (webshop_id);
+CREATE TABLE IF NOT EXISTS rejections (
+    account TEXT NOT NULL,
+    description TEXT NOT NULL,
+    ah INTEGER NOT NULL,
+    webshop_id INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (account, description, ah, webshop_id)
+);
+"""
+
+SOURCE_AUTO = "auto"
+
+
+def memo_key(description: str) -> Tuple[str, int]:
+    """(normalized description, AH-brand flag) the way the frontend builds its search query."""
+    text = normalize_description(description)
+    text = re.sub(r"\bBONUS\b", " ", text)
+    text = re.sub(r"\d+\s*X\s*", " ", text)
+    text = re.sub(r"\s+", " ", text).strip()
+    return text, int(bool(re.match(r"AH\b", text)))
+
+
+class MatchMemo:
+    def __init__(self, path: Path, min_margin: float = 20.0, max_drift: float = 0.15,
+                 min_drift_cents: int = 10):
+        self.path = Path(path)
+        self.min_margin = min_margin
+        self.max_drift = max_drift
+        self.min_drift_cents = min_drift_cents
+        self.stats = {"hits": 0, "misses": 0, "low_confidence": 0, "drifted": 0, "corrections": 0}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path), timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _confident(self, row: sqlite3.Row) -> bool:
+        return (row["margin"] or 0) >= self.min_margin and (row["score"] or 0) >= 0
+
+    def _drifted(self, row: sqlite3.Row, price_cents: Optional[int]) -> bool:
+        reference = row["price_cents"]
+        if price_cents is None or not reference:
+            return False
+        allowed = max(self.min_drift_cents, reference * self.max_drift)
+        return abs(price_cents - reference) > allowed
+
+    @staticmethod
+    def _rejected(conn: sqlite3.Connection, row: sqlite3.Row, account: Optional[str]) -> bool:
+        if account is None:
+            return False
+        return conn.execute(
+            "SELECT 1 FROM rejections WHERE account = ? AND description = ? AND ah = ? AND webshop_id = ?",
+            (account, row["description"], row["ah"], row["webshop_id"])).fetchone() is not None
+
+    def lookup(self, lines: List[Dict], account: Optional[str] = None) -> List[Dict]:
+        """Resolve a batch of receipt lines ({description, price_cents}) against the memo.
+
+        Matches the account rejected are misses for that account. A drifted price is a miss too,
+        but lookups never change an entry; only `record` does.
+        """
+        results = []
+        with closing(self._connect()) as conn, conn:
+            for line in lines:
+                description, ah = memo_key(line.get("description") or "")
+                row = conn.execute("SELECT * FROM matches WHERE description = ? AND ah = ?",
+                                   (description, ah)).fetchone()
+                result = {"description": line.get("description"), "hit": False}
+                if row is None:
+                    self.stats["misses"] += 1
+                    result["reason"] = "unknown"
+                elif self._drifted(row, line.get("price_cents")):
+                    self.stats["drifted"] += 1
+                    self.stats["misses"] += 1
+                    result["reason"] = "price_drift"
+                elif self._rejected(conn, row, account):
+                    self.stats["misses"] += 1
+                    result["reason"] = "rejected"
+                elif not self._confident(row):
+                    self.stats["low_confidence"] += 1
+                    self.stats["misses"] += 1
+                    result["reason"] = "low_confidence"
+                else:
+                    conn.execute("UPDATE matches SET hits = hits + 1 WHERE description = ? AND ah = ?",
+                                 (description, ah))
+                    self.stats["hits"] += 1
+                    result.update(hit=True, match=_row_to_match(row))
+                results.append(result)
+        return results
+
+    def record(self, description: str, webshop_id: int, title: Optional[str] = None,
+               score: Optional[float] = None, margin: Optional[float] = None,
+               price_cents: Optional[int] = None, product: Optional[Dict] = None) -> None:
+        """Remember the product the server chose for a description, replacing the previous entry."""
+        key, ah = memo_key(description)
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO matches (description, ah, webshop_id, title, score, margin, price_cents,"
+                " product, source, hits, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?)",
+                (key, ah, int(webshop_id), title, score, margin, price_cents,
+                 json.dumps(product) if product else None, SOURCE_AUTO, now, now))
+
+    def forget(self, description: str, account: str) -> bool:
+        """The account rejected the remembered product for a description; stop serving it to them."""
+        key, ah = memo_key(description)
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute("SELECT webshop_id FROM matches WHERE description = ? AND ah = ?",
+                               (key, ah)).fetchone()
+            if row is None:
+                return False
+            conn.execute("INSERT OR IGNORE INTO rejections (account, description, ah, webshop_id, created_at)"
+                         " VALUES (?, ?, ?, ?, ?)", (account, key, ah, row["webshop_id"], time.time()))
+        self.stats["corrections"] += 1
+        return True
+
+    def peek(self, description: str, account: Optional[str] = None) -> Optional[Dict]:
+        """Current entry for a description without touching stats."""
+        key, ah = memo_key(description)
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM matches WHERE description = ? AND ah = ?", (key, ah)).fetchone()
+            if row is None or self._rejected(conn, row, account):
+                return None
+        return _row_to_match(row)
+
+    def descriptions_for(self, webshop_id: int, account: Optional[str] = None) -> List[str]:
+        """Descriptions matched to a product, minus the ones the account rejected."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT * FROM matches WHERE webshop_id = ?", (int(webshop_id),)).fetchall()
+            return [r["description"] for r in rows if not self._rejected(conn, r, account)]
+
+    def metrics(self) -> Dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        with closing(self._connect()) as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM matches").fetchone()[0]
+        return {
+            **self.stats,
+            "entries": entries,
+            "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else None,
+        }
+
+
+def _row_to_match(row: sqlite3.Row) -> Dict:
+    return {
+        "webshopId": row["webshop_id"],
+        "title": row["title"],
+        "score": row["score"],
+        "margin": row["margin"],
+        "price_cents": row["price_cents"],
+        "source": row["source"],
+        "product": json.loads(row["product"]) if row["product"] else None,
+    }
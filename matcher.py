@@ -0,0 +1,243 @@
+"""Batch receipt line -> product candidate scoring.
+
+A port of the matching rules in script.js (`PriceDifference` + `scoreProduct` inside
+`enrichProductsWithDetails`) that scores every receipt line against every candidate in
+one pass. Each query word and title token is interned once into a shared vocabulary;
+"title contains word" and "subcategory contains word" are evaluated once per
+(word, candidate) pair into boolean matrices, and the per-line word sets become boolean
+rows, so the word-overlap features reduce to matrix products.
+
+The rules, and their quirks, match the JS exactly: substring tests for search and
+description words, token equality for the extra-word penalty, and the bonus price tiers
+that only apply when the indicator contains "BONUS".
+"""
+import re
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+STOP_WORDS = frozenset(['dr', 'oetker', 'de', 'het', 'een', 'en', 'met', 'voor', 'van', 'verse', 'vers',
+                        'original', 'classic', 'extra', 'pure', 'authentic', 'style', 'product'])
+EXCLUDE_WORDS = ('deeg', 'taartdeeg', 'dough', 'mix', 'poeder', 'powder', 'kruid', 'seasoning', 'basis')
+FEATURES = ("price", "brand", "search_words", "excluded", "desc_words", "subcategory", "extra_words")
+
+_NON_WORD = re.compile(r"[^a-z0-9\s]")
+_WHITESPACE = re.compile(r"\s+")
+_BONUS = re.compile(r"BONUS", re.IGNORECASE)
+_MULTIPLIER = re.compile(r"\d+\s*X\s*", re.IGNORECASE)
+
+BRAND_NONE, BRAND_BIO, BRAND_TERRA = 0, 1, 2
+
+
+def search_query(description: str) -> str:
+    """The search query the frontend derives from a receipt description."""
+    return _MULTIPLIER.sub("", _BONUS.sub("", description or "")).strip()
+
+
+def requires_ah(description: str) -> bool:
+    return re.match(r"AH\b", description or "", re.IGNORECASE) is not None
+
+
+def _title_words(title: str) -> List[str]:
+    return [w for w in _WHITESPACE.split(_NON_WORD.sub(" ", title.lower())) if w]
+
+
+def _candidate_price(product: Dict) -> Optional[float]:
+    price = product.get("currentPrice")
+    if price is None:
+        price = product.get("priceBeforeBonus")
+    return price
+
+
+def _is_ah_brand(product: Dict) -> bool:
+    return (product.get("brand") or "").lower().startswith("ah") or (product.get("title") or "").lower().startswith("ah ")
+
+
+class _Vocabulary:
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+
+    def intern(self, word: str) -> int:
+        word_id = self.ids.get(word)
+        if word_id is None:
+            word_id = self.ids[word] = len(self.ids)
+        return word_id
+
+
+class BatchMatcher:
+    """Scores all receipt lines against all candidates.
+
+    `lines` are dicts with `description`, optional `indicator`, `amount` (line total) and
+    `quantity`, as found in `receiptUiItems`. `candidates` are product dicts from the
+    product search API.
+    """
+
+    def __init__(self, candidates: Sequence[Dict]):
+        self.candidates = list(candidates)
+        self.vocab = _Vocabulary()
+        titles = [(c.get("title") or "").lower() for c in self.candidates]
+        self._titles = titles
+        self._subs = [(c.get("subCategory") or "").lower() for c in self.candidates]
+        n = len(self.candidates)
+        prices = [_candidate_price(c) for c in self.candidates]
+        self.prices = np.array([np.nan if p is None else float(p) for p in prices], dtype=np.float64)
+        brands = [(c.get("brand") or "").lower() for c in self.candidates]
+        self.brand_bio = np.array([b == "ah biologisch" for b in brands], dtype=bool)
+        self.brand_terra = np.array([b == "ah terra" for b in brands], dtype=bool)
+        self.has_sub = np.array([bool(c.get("subCategory")) for c in self.candidates], dtype=bool)
+        self.excluded = np.array([any(w in t for w in EXCLUDE_WORDS) for t in titles], dtype=bool)
+        self.is_ah = np.array([_is_ah_brand(c) for c in self.candidates], dtype=bool)
+        # Title tokens eligible for the extra-word penalty, kept as a (word x candidate) count matrix.
+        token_rows: List[int] = []
+        token_cols: List[int] = []
+        for i, title in enumerate(titles):
+            for word in _title_words(title):
+                if len(word) > 2 and word not in STOP_WORDS:
+                    token_rows.append(i)
+                    token_cols.append(self.vocab.intern(word))
+        rows = np.array(token_rows, dtype=np.int64)
+        self.eligible_tokens = np.bincount(rows, minlength=n).astype(np.int32)
+        # Title tokens are interned first, so their ids are exactly the first columns.
+        self._title_vocab = len(self.vocab.ids)
+        self._tokens = np.zeros((self._title_vocab, n), dtype=np.float32)
+        np.add.at(self._tokens, (np.array(token_cols, dtype=np.int64), rows), 1)
+        # Substring containment is computed lazily per query word and cached as a column.
+        self._contains_title: Dict[int, np.ndarray] = {}
+        self._contains_sub: Dict[int, np.ndarray] = {}
+
+    def _containment(self, word_ids: List[int], words: List[str], sub: bool) -> np.ndarray:
+        cache = self._contains_sub if sub else self._contains_title
+        haystacks = self._subs if sub else self._titles
+        columns = []
+        for word_id, word in zip(word_ids, words):
+            column = cache.get(word_id)
+            if column is None:
+                column = cache[word_id] = np.fromiter((word in h for h in haystacks), dtype=bool,
+                                                      count=len(haystacks))
+            columns.append(column)
+        if not columns:
+            return np.zeros((0, len(haystacks)), dtype=bool)
+        return np.vstack(columns)
+
+    def score(self, lines: Sequence[Dict]) -> Dict[str, np.ndarray]:
+        """Per-feature score matrices (lines x candidates) plus their sum under "total"."""
+        n_lines, n_cand = len(lines), len(self.candidates)
+        search_sets, desc_sets, search_counts, compare_prices, bonus_lines, brand_kinds = [], [], [], [], [], []
+        for line in lines:
+            description = line.get("description") or ""
+            query = search_query(description).lower()
+            search_words = [w for w in query.split(" ") if len(w) > 2]
+            desc_words = [w for w in _BONUS.sub("", description.lower()).split(" ") if len(w) > 3]
+            search_sets.append(sorted({self.vocab.intern(w) for w in search_words}))
+            desc_sets.append(sorted({self.vocab.intern(w) for w in desc_words}))
+            search_counts.append(len(search_words))
+            compare_prices.append(_unit_price(line))
+            bonus_lines.append("BONUS" in str(line.get("indicator") or "").upper())
+            upper = description.upper()
+            brand_kinds.append(BRAND_BIO if upper.startswith("AH BIO") else
+                               BRAND_TERRA if upper.startswith("AH TERRA") else BRAND_NONE)
+
+        vocab_size = len(self.vocab.ids)
+        words_by_id = [None] * vocab_size
+        for word, word_id in self.vocab.ids.items():
+            words_by_id[word_id] = word
+        # Line membership rows over the shared vocabulary. Counts are small integers, so
+        # float32 keeps the products exact while letting them run through BLAS.
+        search_rows = np.zeros((n_lines, vocab_size), dtype=np.float32)
+        desc_rows = np.zeros((n_lines, vocab_size), dtype=np.float32)
+        for i, (s_ids, d_ids) in enumerate(zip(search_sets, desc_sets)):
+            search_rows[i, s_ids] = 1
+            desc_rows[i, d_ids] = 1
+
+        # Only query words need substring tests; restrict the matrices to those columns.
+        query_ids = sorted(set().union(*search_sets, *desc_sets)) if n_lines else []
+        query_words = [words_by_id[i] for i in query_ids]
+        in_title = self._containment(query_ids, query_words, sub=False).astype(np.float32)  # Q x N
+        search_q = search_rows[:, query_ids]
+        desc_q = desc_rows[:, query_ids]
+
+        features: Dict[str, np.ndarray] = {}
+        features["price"] = _price_scores(np.array(compare_prices, dtype=np.float64),
+                                          np.array(bonus_lines, dtype=bool), self.prices)
+        kinds = np.array(brand_kinds, dtype=np.int8)[:, None]
+        features["brand"] = 60 * (((kinds == BRAND_BIO) & self.brand_bio[None, :])
+                                  | ((kinds == BRAND_TERRA) & self.brand_terra[None, :])).astype(np.int32)
+        features["search_words"] = 10 * (search_q @ in_title).astype(np.int32)
+        features["excluded"] = np.broadcast_to(-80 * self.excluded.astype(np.int32), (n_lines, n_cand)).copy()
+        features["desc_words"] = 5 * (desc_q @ in_title).astype(np.int32)
+
+        sub_matches = (search_q @ self._containment(query_ids, query_words, sub=True).astype(np.float32)).astype(np.int32)
+        single_word = (np.array(search_counts) == 1)[:, None]
+        features["subcategory"] = np.where(
+            self.has_sub[None, :],
+            25 * sub_matches - 15 * ((sub_matches == 0) & single_word),
+            0,
+        ).astype(np.int32)
+
+        # Title tokens count as "extra" unless the line's search or description set contains them.
+        known = np.maximum(search_rows, desc_rows)[:, :self._title_vocab]
+        covered = (known @ self._tokens).astype(np.int32)
+        features["extra_words"] = -8 * (self.eligible_tokens[None, :] - covered)
+
+        total = np.zeros((n_lines, n_cand), dtype=np.float64)
+        for name in FEATURES:
+            total += features[name]
+        features["total"] = total
+        return features
+
+    def rank(self, lines: Sequence[Dict], top: Optional[int] = None, brand_filter: bool = True) -> List[List[Dict]]:
+        """Ranked candidates per line, best first, with per-feature score breakdowns.
+
+        With `brand_filter`, AH lines only consider AH-brand candidates and other lines only
+        non-AH candidates, falling back to all candidates when that leaves none (as script.js does).
+        """
+        features = self.score(lines)
+        total = features["total"]
+        results = []
+        for i, line in enumerate(lines):
+            allowed = np.ones(len(self.candidates), dtype=bool)
+            if brand_filter:
+                wanted = self.is_ah if requires_ah(line.get("description") or "") else ~self.is_ah
+                if wanted.any():
+                    allowed = wanted
+            indices = np.flatnonzero(allowed)
+            order = indices[np.argsort(-total[i, indices], kind="stable")]
+            if top is not None:
+                order = order[:top]
+            results.append([
+                {
+                    "index": int(j),
+                    "product": self.candidates[j],
+                    "score": float(total[i, j]),
+                    "breakdown": {name: float(features[name][i, j]) for name in FEATURES},
+                }
+                for j in order
+            ])
+        return results
+
+
+_JS_NUMBER = re.compile(r"\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?")
+
+
+def _parse_float(value) -> float:
+    """JS `parseFloat(String(value).replace(',', '.'))`: numeric prefix, NaN when absent."""
+    match = _JS_NUMBER.match(str(value).replace(",", ".", 1))
+    return float(match.group(0)) if match else np.nan
+
+
+def _unit_price(line: Dict) -> float:
+    """Receipt unit price (line amount / quantity) the way the frontend derives it."""
+    amount = _parse_float(line.get("amount") or "")
+    quantity = _parse_float(line.get("quantity") or "1")
+    if np.isnan(quantity) or quantity == 0:
+        quantity = 1
+    return amount / quantity if quantity > 0 else amount
+
+
+def _price_scores(compare: np.ndarray, bonus: np.ndarray, prices: np.ndarray) -> np.ndarray:
+    diff = np.abs(prices[None, :] - compare[:, None])
+    known = ~np.isnan(diff)
+    diff = np.where(known, diff, np.inf)
+    tiers = np.select([diff < 0.10, diff < 0.20, diff < 0.30, diff < 0.50], [500, 400, 300, 200], 0)
+    strict = np.where(diff < 0.02, 500, 0)
+    return np.where(known, np.where(bonus[:, None], tiers, strict), 0).astype(np.int32)
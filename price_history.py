@@ -0,0 +1,374 @@
+"""Append-only price history for products seen through search results and receipts.
+
+Observations are kept per series in parallel `array` columns (timestamp, price, price
+before bonus, source) instead of per-observation dicts. Series keys are dictionary-encoded:
+`w:<webshopId>` for catalog prices from search, which anyone may see, and
+`d:<account>:<description>` for prices an account actually paid on its receipts, which only
+that account may see. On disk the store is three append-only files: `keys.txt` (one key per
+line; the line number is the id), `observations.bin` (fixed-size records) and
+`receipts.txt` (account and transaction of every receipt recorded, so a receipt counts once).
+
+Recording only appends to an in-memory buffer; a background task writes it to disk in
+batches, so request handlers never wait on I/O. Several processes (server workers) can
+share one directory: each write holds an exclusive lock on `lock`, first reads what other
+processes appended since its last write (new key ids, observations, receipts) and only
+then assigns ids to its own new keys and appends.
+"""
+import asyncio
+import struct
+import time
+from array import array
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, run a single worker there
+    fcntl = None
+
+from receipt_lines import normalize_description, parse_moment, parse_receipt_lines
+
+SOURCE_SEARCH = 0
+SOURCE_RECEIPT = 1
+SOURCE_NAMES = {SOURCE_SEARCH: "search", SOURCE_RECEIPT: "receipt"}
+
+NO_PRICE = -1
+# series id, timestamp, price cents, price-before-bonus cents, source
+_RECORD = struct.Struct("<IIiiB")
+# A repeated identical search observation is only stored again after this long.
+REPEAT_INTERVAL = 6 * 3600
+# Receipt markers written into keys.txt by earlier versions.
+_LEGACY_RECEIPT_PREFIX = "t:"
+
+
+def product_key(webshop_id) -> str:
+    return f"w:{int(webshop_id)}"
+
+
+def description_key(account: str, description: str) -> str:
+    return f"d:{account}:{normalize_description(description)}"
+
+
+def _cents(value) -> int:
+    if value is None:
+        return NO_PRICE
+    try:
+        return int(round(float(value) * 100))
+    except (TypeError, ValueError):
+        return NO_PRICE
+
+
+class _Series:
+    __slots__ = ("ts", "price", "base", "source", "sorted")
+
+    def __init__(self):
+        self.ts = array("I")
+        self.price = array("i")
+        self.base = array("i")
+        self.source = array("B")
+        self.sorted = True
+
+    def append(self, ts: int, price: int, base: int, source: int) -> None:
+        if self.ts and ts < self.ts[-1]:
+            self.sorted = False
+        self.ts.append(ts)
+        self.price.append(price)
+        self.base.append(base)
+        self.source.append(source)
+
+    def sort(self) -> None:
+        if self.sorted:
+            return
+        order = sorted(range(len(self.ts)), key=self.ts.__getitem__)
+        self.ts = array("I", (self.ts[i] for i in order))
+        self.price = array("i", (self.price[i] for i in order))
+        self.base = array("i", (self.base[i] for i in order))
+        self.source = array("B", (self.source[i] for i in order))
+        self.sorted = True
+
+
+def _read_lines(path: Path, offset: int) -> Tuple[List[str], int]:
+    """Complete lines appended to `path` after `offset`, and the offset after them."""
+    if not path.exists():
+        return [], offset
+    with path.open("rb") as f:
+        f.seek(offset)
+        data = f.read()
+    complete = data[:data.rfind(b"\n") + 1]
+    return complete.decode("utf-8").splitlines(), offset + len(complete)
+
+
+def _append_lines(path: Path, lines: List[str]) -> None:
+    with path.open("ab") as f:
+        f.write("".join(line + "\n" for line in lines).encode("utf-8"))
+
+
+def _repair(keys_path: Path, data_path: Path, receipts_path: Path) -> None:
+    """Finish off what a process killed mid-write left behind (call with the lock held).
+
+    A torn last line is terminated, so every process reads it as the same (junk) key
+    instead of it swallowing the next one; a torn last record is cut off.
+    """
+    for path in (keys_path, receipts_path):
+        if path.exists() and path.stat().st_size:
+            with path.open("rb+") as f:
+                f.seek(-1, 2)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+    if data_path.exists():
+        size = data_path.stat().st_size
+        if size % _RECORD.size:
+            with data_path.open("rb+") as f:
+                f.truncate(size - size % _RECORD.size)
+
+
+class PriceHistory:
+    def __init__(self, directory: Path, flush_interval: float = 2.0):
+        self.directory = Path(directory)
+        self.flush_interval = flush_interval
+        self._keys: List[str] = []
+        self._key_ids: Dict[str, int] = {}
+        self._series: Dict[int, _Series] = {}
+        self._receipts: Set[str] = set()
+        # (key, ts, price, base, source, "<account>:<transaction id>" or None), not yet on disk
+        self._pending: List[tuple] = []
+        self._pending_receipts: Set[str] = set()
+        # Bytes of keys.txt / observations.bin / receipts.txt already read or written.
+        self._offsets = {"keys": 0, "observations": 0, "receipts": 0}
+        self._flushing: Optional[asyncio.Lock] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._load()
+
+    # -- disk exchange ----------------------------------------------------
+
+    def _load(self) -> None:
+        if self.directory.exists():
+            self._merge(self._exchange([]))
+
+    def _exchange(self, pending: List[tuple]) -> Dict:
+        """Under the directory lock: read what others appended, then append `pending`.
+
+        Runs in a worker thread, so it only reads the in-memory state; `_merge` applies
+        the returned changes on the event loop.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        keys_path = self.directory / "keys.txt"
+        data_path = self.directory / "observations.bin"
+        receipts_path = self.directory / "receipts.txt"
+        with (self.directory / "lock").open("a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            _repair(keys_path, data_path, receipts_path)
+            new_keys, _ = _read_lines(keys_path, self._offsets["keys"])
+            new_receipts, _ = _read_lines(receipts_path, self._offsets["receipts"])
+            records = []
+            if data_path.exists():
+                with data_path.open("rb") as f:
+                    f.seek(self._offsets["observations"])
+                    records = list(_RECORD.iter_unpack(f.read()))
+
+            # Our own observations, with ids that every process agrees on.
+            added = {key: len(self._keys) + i for i, key in enumerate(new_keys)}
+            seen_receipts = self._receipts.union(new_receipts)
+            seen_receipts.update(k[len(_LEGACY_RECEIPT_PREFIX):] for k in new_keys
+                                 if k.startswith(_LEGACY_RECEIPT_PREFIX))
+            own_keys, own_receipts, data = [], {}, bytearray()
+            for key, ts, price, base, source, transaction_id in pending:
+                if transaction_id is not None:
+                    if transaction_id in seen_receipts and transaction_id not in own_receipts:
+                        continue  # another process recorded this receipt first
+                    own_receipts[transaction_id] = None
+                key_id = self._key_ids.get(key)
+                if key_id is None:
+                    key_id = added.get(key)
+                if key_id is None:
+                    key_id = added[key] = len(self._keys) + len(added)
+                    own_keys.append(key)
+                record = (key_id, ts, price, base, source)
+                records.append(record)
+                data += _RECORD.pack(*record)
+
+            # Keys first, so every record on disk refers to a known key.
+            if own_keys:
+                _append_lines(keys_path, own_keys)
+            if data:
+                with data_path.open("ab") as f:
+                    f.write(data)
+            if own_receipts:
+                _append_lines(receipts_path, list(own_receipts))
+            offsets = {name: path.stat().st_size if path.exists() else 0
+                       for name, path in (("keys", keys_path), ("observations", data_path),
+                                          ("receipts", receipts_path))}
+        return {"keys": new_keys + own_keys, "records": records, "receipts": new_receipts + list(own_receipts),
+                "offsets": offsets}
+
+    def _merge(self, changes: Dict) -> None:
+        for key in changes["keys"]:
+            self._key_ids[key] = len(self._keys)
+            self._keys.append(key)
+            if key.startswith(_LEGACY_RECEIPT_PREFIX):
+                self._receipts.add(key[len(_LEGACY_RECEIPT_PREFIX):])
+        for key_id, ts, price, base, source in changes["records"]:
+            if key_id < len(self._keys):
+                self._series.setdefault(key_id, _Series()).append(ts, price, base, source)
+        self._receipts.update(changes["receipts"])
+        self._offsets = changes["offsets"]
+
+    # -- recording (hot path: buffer only) --------------------------------
+
+    def record_search(self, products: Iterable[Dict], ts: Optional[float] = None) -> None:
+        """Buffer the current prices of every product in a search response."""
+        now = int(ts or time.time())
+        for product in products:
+            webshop_id = product.get("webshopId")
+            if webshop_id is None:
+                continue
+            self._pending.append((product_key(webshop_id), now, _cents(product.get("currentPrice")),
+                                  _cents(product.get("priceBeforeBonus")), SOURCE_SEARCH, None))
+
+    def record_receipt(self, detail: Dict, transaction_id: str, account: str) -> None:
+        """Buffer the unit prices an account actually paid on a receipt (once per transaction)."""
+        moment = parse_moment(detail.get("transactionMoment"))
+        marker = f"{account}:{transaction_id}"
+        if marker in self._receipts or marker in self._pending_receipts or moment is None:
+            return
+        self._pending_receipts.add(marker)
+        ts = int(moment.timestamp())
+        for line in parse_receipt_lines(detail):
+            paid = line["amount_cents"] - line["discount_cents"]
+            self._pending.append((description_key(account, line["description"]), ts,
+                                  int(round(paid / line["quantity"])), line["unit_cents"], SOURCE_RECEIPT,
+                                  marker))
+
+    # -- background writer ------------------------------------------------
+
+    def _last_search(self, key: str) -> Optional[Tuple[int, int, int]]:
+        key_id = self._key_ids.get(key)
+        series = self._series.get(key_id) if key_id is not None else None
+        if series is None or not series.sorted or not series.ts or series.source[-1] != SOURCE_SEARCH:
+            return None
+        return series.ts[-1], series.price[-1], series.base[-1]
+
+    def _drop_repeats(self, pending: List[tuple]) -> List[tuple]:
+        """Drop search prices seen again unchanged shortly after; nothing new to store."""
+        last: Dict[str, Tuple[int, int, int]] = {}
+        kept = []
+        for entry in pending:
+            key, ts, price, base, source, _ = entry
+            if source == SOURCE_SEARCH:
+                previous = last.get(key) or self._last_search(key)
+                if previous is not None and previous[1:] == (price, base) and ts - previous[0] < REPEAT_INTERVAL:
+                    continue
+                last[key] = (ts, price, base)
+            kept.append(entry)
+        return kept
+
+    async def flush(self) -> None:
+        if self._flushing is None:
+            self._flushing = asyncio.Lock()
+        async with self._flushing:
+            pending, self._pending = self._pending, []
+            receipts, self._pending_receipts = self._pending_receipts, set()
+            pending = self._drop_repeats(pending)
+            try:
+                changes = await asyncio.to_thread(self._exchange, pending)
+            except BaseException:
+                self._pending[:0] = pending
+                self._pending_receipts |= receipts
+                raise
+            self._merge(changes)
+
+    async def _writer_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                pass
+
+    def start(self) -> None:
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._writer_loop())
+
+    async def stop(self) -> None:
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+        await self.flush()
+
+    # -- queries ----------------------------------------------------------
+
+    def query(self, keys: Iterable[str], start: Optional[int] = None, end: Optional[int] = None,
+              bucket: Optional[int] = None) -> List[Dict]:
+        """Observations for the given series within [start, end], oldest first.
+
+        With `bucket` (seconds) the points are downsampled to one entry per bucket carrying
+        min/max/avg/last of the price.
+        """
+        keys = list(keys)
+        # Buffered observations count too; they just aren't on disk yet.
+        wanted = set(keys)
+        rows = [(ts, price, base, source) for key, ts, price, base, source, _ in self._drop_repeats(self._pending)
+                if key in wanted and (start is None or ts >= start) and (end is None or ts <= end)]
+        for key in keys:
+            key_id = self._key_ids.get(key)
+            series = self._series.get(key_id) if key_id is not None else None
+            if series is None:
+                continue
+            series.sort()
+            lo = 0 if start is None else _bisect(series.ts, start)
+            hi = len(series.ts) if end is None else _bisect(series.ts, end + 1)
+            for i in range(lo, hi):
+                rows.append((series.ts[i], series.price[i], series.base[i], series.source[i]))
+        rows.sort(key=lambda r: r[0])
+        if not bucket:
+            return [_point(ts, price, base, source) for ts, price, base, source in rows]
+        return _downsample(rows, bucket)
+
+    def stats(self) -> Dict:
+        return {
+            "series": len(self._series),
+            "observations": sum(len(s.ts) for s in self._series.values()),
+            "pending": len(self._pending),
+        }
+
+
+def _bisect(column: array, value: int) -> int:
+    lo, hi = 0, len(column)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if column[mid] < value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _price(cents: int) -> Optional[float]:
+    return None if cents == NO_PRICE else cents / 100
+
+
+def _point(ts: int, price: int, base: int, source: int) -> Dict:
+    return {"ts": ts, "price": _price(price), "priceBeforeBonus": _price(base), "source": SOURCE_NAMES[source]}
+
+
+def _downsample(rows: List[tuple], bucket: int) -> List[Dict]:
+    points: List[Dict] = []
+    current = None
+    for ts, price, _base, _source in rows:
+        if price == NO_PRICE:
+            continue
+        start = ts - ts % bucket
+        if current is None or current["ts"] != start:
+            current = {"ts": start, "min": price, "max": price, "sum": 0, "count": 0, "last": price}
+            points.append(current)
+        current["min"] = min(current["min"], price)
+        current["max"] = max(current["max"], price)
+        current["sum"] += price
+        current["count"] += 1
+        current["last"] = price
+    return [
+        {"ts": p["ts"], "min": p["min"] / 100, "max": p["max"] / 100,
+         "avg": round(p["sum"] / p["count"] / 100, 2), "last": p["last"] / 100, "count": p["count"]}
+        for p in points
+    ]
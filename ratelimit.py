@@ -0,0 +1,307 @@
+"""Upstream rate limiting for calls to api.ah.nl.
+
+A global token bucket caps the request rate of the whole deployment (everything leaves from
+one IP; with several worker processes it is a `SharedTokenBucket` they all draw from), a
+per-account bucket caps each user, and a per-account concurrency limit keeps one
+heavy user from occupying every in-flight slot. Waiters are queued per account and served
+round-robin, so a burst of enrichment searches from one browser cannot starve the others.
+"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+
+class RateLimitExceeded(Exception):
+    """Raised when the wait queue is full (or the caller's wait budget runs out)."""
+
+    def __init__(self, reason: str, retry_after: float = 1.0):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        if now <= self.updated:
+            return
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= 1
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class SharedTokenBucket:
+    """A token bucket kept in a SharedState store, so every worker process draws from it.
+
+    One token at a time is reserved from the store and spent by `take`. The reservation is
+    a blocking SQLite transaction, so it runs in a worker thread: `ready` only says whether
+    a reserved token is at hand, starting a reservation if not, and `on_refill` (set by the
+    governor) is called when one comes back. While the store says the bucket is empty, it
+    isn't asked again until a token is due.
+    """
+
+    def __init__(self, state, name: str, rate: float, burst: float):
+        self.state = state
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.on_refill: Optional[Callable[[], None]] = None
+        self._reserved = False
+        self._due = 0.0
+        self._refilling: Optional[asyncio.Task] = None
+
+    def ready(self, now: float) -> bool:
+        if self._reserved:
+            return True
+        loop = asyncio.get_running_loop()
+        if self._refilling is not None and self._refilling.get_loop() is not loop:
+            self._refilling = None  # left behind by an event loop that has gone away
+        if self._refilling is None and now >= self._due:
+            self._refilling = loop.create_task(self._refill())
+        return False
+
+    async def _refill(self) -> None:
+        try:
+            wait = await asyncio.to_thread(self.state.take_token, self.name, self.rate, self.burst)
+        except Exception:
+            wait = 1 / self.rate  # store busy or unavailable; try again when a token would be due
+        finally:
+            self._refilling = None
+        self._reserved = not wait
+        self._due = time.monotonic() + wait
+        if self.on_refill is not None:
+            self.on_refill()
+
+    def take(self) -> None:
+        self._reserved = False
+
+    def wait_time(self, now: float) -> float:
+        if self._reserved:
+            return 0.0
+        if self._refilling is not None:
+            return 1.0  # on_refill wakes the governor when the reservation is back
+        return max(0.0, self._due - now)
+
+
+class UpstreamGovernor:
+    """Token-bucket limiter with fair per-account queueing.
+
+    Use as ``async with governor.slot(account): ...`` around each upstream call.
+    """
+
+    def __init__(self, global_rate: float, global_burst: float, account_rate: float,
+                 account_burst: float, account_concurrency: int, max_queue: int,
+                 max_queue_per_account: int, global_bucket=None):
+        self.global_bucket = global_bucket or TokenBucket(global_rate, global_burst)
+        if isinstance(self.global_bucket, SharedTokenBucket):
+            self.global_bucket.on_refill = self._kick
+        self.account_rate = account_rate
+        self.account_burst = account_burst
+        self.account_concurrency = account_concurrency
+        self.max_queue = max_queue
+        self.max_queue_per_account = max_queue_per_account
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._inflight: Dict[str, int] = {}
+        # account -> FIFO of (future, enqueued_at); OrderedDict order is the round-robin order.
+        self._queues: "OrderedDict[str, Deque[Tuple[asyncio.Future, float]]]" = OrderedDict()
+        self._queued = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._pump_task: Optional[asyncio.Task] = None
+        self.stats = {"granted": 0, "queued": 0, "rejected": 0, "timed_out": 0}
+        self._waits: Deque[float] = deque(maxlen=500)
+
+    def _bucket(self, account: str) -> TokenBucket:
+        bucket = self._buckets.get(account)
+        if bucket is None:
+            if len(self._buckets) >= 10000:
+                self._prune_idle()
+            bucket = self._buckets[account] = TokenBucket(self.account_rate, self.account_burst)
+        return bucket
+
+    def _prune_idle(self) -> None:
+        # Full buckets with nothing in flight or queued carry no state worth keeping.
+        now = time.monotonic()
+        for account, bucket in list(self._buckets.items()):
+            bucket._refill(now)
+            if bucket.tokens >= bucket.burst and account not in self._inflight and account not in self._queues:
+                del self._buckets[account]
+
+    def _can_grant(self, account: str, now: float) -> bool:
+        return (self._inflight.get(account, 0) < self.account_concurrency
+                and self.global_bucket.ready(now)
+                and self._bucket(account).ready(now))
+
+    def _grant(self, account: str, enqueued_at: float, now: float) -> None:
+        self.global_bucket.take()
+        self._bucket(account).take()
+        self._inflight[account] = self._inflight.get(account, 0) + 1
+        self.stats["granted"] += 1
+        self._waits.append(now - enqueued_at)
+
+    def _dispatch(self) -> float:
+        """Grant queued waiters round-robin; return how long until another grant may be possible."""
+        progressed = True
+        while progressed:
+            progressed = False
+            for account in list(self._queues):
+                queue = self._queues[account]
+                while queue and queue[0][0].done():  # cancelled by the caller
+                    queue.popleft()
+                    self._queued -= 1
+                if not queue:
+                    del self._queues[account]
+                    continue
+                now = time.monotonic()
+                if not self._can_grant(account, now):
+                    continue
+                future, enqueued_at = queue.popleft()
+                self._queued -= 1
+                self._grant(account, enqueued_at, now)
+                future.set_result(None)
+                # Served accounts go to the back of the line.
+                if queue:
+                    self._queues.move_to_end(account)
+                else:
+                    del self._queues[account]
+                progressed = True
+                break
+        now = time.monotonic()
+        global_wait = self.global_bucket.wait_time(now)
+        waits = [
+            max(global_wait, self._bucket(account).wait_time(now))
+            for account in self._queues
+            # Accounts at their concurrency cap are woken by release() instead.
+            if self._inflight.get(account, 0) < self.account_concurrency
+        ]
+        return max(0.005, min(waits, default=0.05))
+
+    async def _pump(self) -> None:
+        while self._queued:
+            delay = self._dispatch()
+            if not self._queued:
+                break
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+        self._pump_task = None
+
+    def _kick(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # First use, or the event loop the pump ran on has gone away (e.g. a restarted app).
+            self._loop, self._wake, self._pump_task = loop, asyncio.Event(), None
+        self._wake.set()
+        if self._pump_task is None and self._queued:
+            self._pump_task = asyncio.ensure_future(self._pump())
+
+    async def acquire(self, account: str, timeout: Optional[float] = None) -> None:
+        now = time.monotonic()
+        if not self._queued and self._can_grant(account, now):
+            self._grant(account, now, now)
+            return
+        if self._queued >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise RateLimitExceeded("Upstream queue is full", retry_after=self._retry_after())
+        queue = self._queues.setdefault(account, deque())
+        if len(queue) >= self.max_queue_per_account:
+            self.stats["rejected"] += 1
+            raise RateLimitExceeded("Too many queued upstream calls for this account",
+                                    retry_after=self._retry_after())
+        future = asyncio.get_running_loop().create_future()
+        queue.append((future, now))
+        self._queued += 1
+        self.stats["queued"] += 1
+        self._kick()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                return  # granted right as the timeout fired; keep the slot
+            future.cancel()
+            self.stats["timed_out"] += 1
+            raise RateLimitExceeded("Timed out waiting for an upstream slot", retry_after=self._retry_after())
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(account)
+            else:
+                future.cancel()
+            raise
+
+    def release(self, account: str) -> None:
+        remaining = self._inflight.get(account, 0) - 1
+        if remaining > 0:
+            self._inflight[account] = remaining
+        else:
+            self._inflight.pop(account, None)
+        if self._queued:
+            self._kick()
+
+    def slot(self, account: str, timeout: Optional[float] = None) -> "_Slot":
+        return _Slot(self, account, timeout)
+
+    def try_slot(self, account: str) -> Optional["_Slot"]:
+        """Non-blocking variant: a held slot if one is free right now, else None."""
+        now = time.monotonic()
+        if self._queued or not self._can_grant(account, now):
+            return None
+        self._grant(account, now, now)
+        return _Slot(self, account, None, held=True)
+
+    def _retry_after(self) -> float:
+        return max(1.0, self._queued / max(self.global_bucket.rate, 0.001))
+
+    def metrics(self) -> Dict:
+        waits = sorted(self._waits)
+
+        def pct(p: float) -> Optional[int]:
+            if not waits:
+                return None
+            return int(waits[min(len(waits) - 1, int(len(waits) * p))] * 1000)
+
+        return {
+            **self.stats,
+            "queue_length": self._queued,
+            "queued_accounts": len(self._queues),
+            "inflight": sum(self._inflight.values()),
+            "wait_ms": {"p50": pct(0.50), "p95": pct(0.95), "max": pct(1.0)},
+        }
+
+
+class _Slot:
+    def __init__(self, governor: UpstreamGovernor, account: str, timeout: Optional[float], held: bool = False):
+        self.governor = governor
+        self.account = account
+        self.timeout = timeout
+        self.held = held
+
+    async def __aenter__(self) -> "_Slot":
+        if not self.held:
+            await self.governor.acquire(self.account, self.timeout)
+            self.held = True
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        if self.held:
+            self.held = False
+            self.governor.release(self.account)
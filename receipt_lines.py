@@ -0,0 +1,101 @@
+"""Helpers for turning raw AH receipt JSON into product lines.
+
+A receipt detail (`/mobile-services/v2/receipts/{id}`) is a flat list of `receiptUiItems`.
+Purchased products are the `product` items between the products header and the first
+subtotal; after the subtotal come bonus discounts (quantity "BONUS", negative amount),
+savings summaries and payment lines, which are not purchases.
+"""
+import re
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Union
+
+# Receipt lines that look like products but aren't purchases.
+NON_PRODUCT_DESCRIPTIONS = {"BONUSKAART", "WAARVAN", "PINNEN", "BONUS BOX", "ESPAARZEGELS", "STATIEGELD"}
+
+
+def parse_amount(value: Union[str, float, int, None]) -> Optional[int]:
+    """Parse a receipt amount ("1,23", "-0,12", 1.23) into cents; None when unparseable."""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(round(value * 100))
+    text = value.strip().replace("€", "").replace(" ", "")
+    if not text:
+        return None
+    text = text.replace(".", "").replace(",", ".") if "," in text else text
+    try:
+        return int(round(float(text) * 100))
+    except ValueError:
+        return None
+
+
+def parse_quantity(value: Union[str, int, None]) -> int:
+    """Parse a receipt quantity; non-numeric or missing quantities count as 1."""
+    if value is None:
+        return 1
+    try:
+        qty = float(str(value).replace(",", "."))
+    except ValueError:
+        return 1
+    return max(1, int(round(qty)))
+
+
+def normalize_description(description: str) -> str:
+    """Canonical form of a receipt description, used as a lookup key."""
+    return re.sub(r"\s+", " ", description or "").strip().upper()
+
+
+def parse_moment(value: Optional[str]) -> Optional[datetime]:
+    """Parse a `transactionMoment` into an aware datetime; None when malformed."""
+    if not value:
+        return None
+    try:
+        moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment
+
+
+def parse_receipt_lines(detail: Dict) -> List[Dict]:
+    """Extract purchased product lines from a receipt detail.
+
+    Each line has `description`, `quantity`, `amount_cents` (line total as paid before
+    bonus discounts), `unit_cents`, `bonus` (True when the line carries the bonus
+    indicator or received a bonus discount) and `discount_cents` (>= 0).
+    """
+    lines: List[Dict] = []
+    by_description: Dict[str, Dict] = {}
+    in_products = True
+    for item in detail.get("receiptUiItems") or []:
+        kind = item.get("type")
+        if kind in ("subtotal", "total"):
+            in_products = False
+            continue
+        if kind != "product" or not item.get("description"):
+            continue
+        description = normalize_description(item["description"])
+        amount = parse_amount(item.get("amount"))
+        if not in_products:
+            # Bonus discounts after the subtotal refer back to a purchased line.
+            if str(item.get("quantity", "")).upper() == "BONUS" and amount is not None:
+                line = by_description.get(description)
+                if line is not None:
+                    line["bonus"] = True
+                    line["discount_cents"] += -amount if amount < 0 else amount
+            continue
+        if amount is None or amount < 0 or description in NON_PRODUCT_DESCRIPTIONS:
+            continue
+        quantity = parse_quantity(item.get("quantity"))
+        line = {
+            "description": description,
+            "quantity": quantity,
+            "amount_cents": amount,
+            "unit_cents": int(round(amount / quantity)),
+            "bonus": "B" in str(item.get("indicator") or "").upper(),
+            "discount_cents": 0,
+        }
+        lines.append(line)
+        by_description.setdefault(description, line)
+    return lines
@@ -0,0 +1,231 @@
+"""Local copy of each account's purchase history.
+
+Receipt summaries (from the receipts list) and receipt details are written through to a
+SQLite database as they pass through the API, together with the parsed product lines
+(see `receipt_lines.parse_receipt_lines`). Readers iterate over cursors in batches, so an
+export or scan never holds the whole history in memory.
+
+Connections are opened per operation, and iterators open one per batch: the store is
+used both from the event loop and from the threadpool that drives streaming responses,
+which may advance one iterator from several threads.
+"""
+import json
+import sqlite3
+import time
+from contextlib import closing
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from receipt_lines import parse_amount, parse_moment, parse_receipt_lines
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS receipts (
+    account TEXT NOT NULL,
+    transaction_id TEXT NOT NULL,
+    moment TEXT,
+    total_cents INTEGER,
+    discount_cents INTEGER,
+    summary TEXT,
+    detail TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (account, transaction_id)
+);
+CREATE INDEX IF NOT EXISTS receipts_by_moment ON receipts (account, moment);
+CREATE TABLE IF NOT EXISTS receipt_lines (
+    account TEXT NOT NULL,
+    transaction_id TEXT NOT NULL,
+    line_no INTEGER NOT NULL,
+    moment TEXT,
+    description TEXT NOT NULL,
+    quantity INTEGER NOT NULL,
+    amount_cents INTEGER NOT NULL,
+    discount_cents INTEGER NOT NULL,
+    bonus INTEGER NOT NULL,
+    PRIMARY KEY (account, transaction_id, line_no)
+);
+CREATE INDEX IF NOT EXISTS receipt_lines_by_moment ON receipt_lines (account, moment, transaction_id, line_no);
+"""
+
+BATCH_SIZE = 500
+
+
+def _iso(moment: Optional[str]) -> Optional[str]:
+    # Normalize to a sortable UTC ISO string; keep malformed upstream values out of range filters.
+    parsed = parse_moment(moment)
+    return parsed.strftime("%Y-%m-%dT%H:%M:%SZ") if parsed else None
+
+
+class ReceiptStore:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path), timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    # -- writes -----------------------------------------------------------
+
+    def upsert_summaries(self, account: str, receipts: List[Dict]) -> int:
+        """Store the receipts list; returns how many transactions were new."""
+        now = time.time()
+        rows = []
+        for receipt in receipts or []:
+            transaction_id = receipt.get("transactionId")
+            if not transaction_id:
+                continue
+            rows.append((
+                account, str(transaction_id), _iso(receipt.get("transactionMoment")),
+                parse_amount(((receipt.get("total") or {}).get("amount") or {}).get("amount")),
+                parse_amount((receipt.get("totalDiscount") or {}).get("amount")),
+                json.dumps(receipt), now,
+            ))
+        with closing(self._connect()) as conn, conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO receipts (account, transaction_id, moment, total_cents, discount_cents,"
+                " summary, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            inserted = conn.total_changes - before
+            conn.executemany(
+                "UPDATE receipts SET moment = COALESCE(?, moment), total_cents = ?, discount_cents = ?,"
+                " summary = ?, updated_at = ? WHERE account = ? AND transaction_id = ?",
+                [(r[2], r[3], r[4], r[5], r[6], r[0], r[1]) for r in rows])
+        return inserted
+
+    def store_detail(self, account: str, transaction_id: str, detail: Dict) -> Optional[List[Dict]]:
+        """Store a receipt detail and its parsed lines.
+
+        Returns the parsed lines when the detail was not stored before, else None.
+        """
+        lines = parse_receipt_lines(detail)
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT moment, detail IS NOT NULL AS has_detail FROM receipts"
+                " WHERE account = ? AND transaction_id = ?", (account, transaction_id)).fetchone()
+            if row is not None and row["has_detail"]:
+                return None
+            moment = _iso(detail.get("transactionMoment")) or (row["moment"] if row else None)
+            if row is None:
+                conn.execute(
+                    "INSERT INTO receipts (account, transaction_id, moment, detail, updated_at)"
+                    " VALUES (?, ?, ?, ?, ?)", (account, transaction_id, moment, json.dumps(detail), now))
+            else:
+                conn.execute(
+                    "UPDATE receipts SET moment = ?, detail = ?, updated_at = ?"
+                    " WHERE account = ? AND transaction_id = ?",
+                    (moment, json.dumps(detail), now, account, transaction_id))
+            conn.executemany(
+                "INSERT OR REPLACE INTO receipt_lines (account, transaction_id, line_no, moment, description,"
+                " quantity, amount_cents, discount_cents, bonus) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(account, transaction_id, i, moment, line["description"], line["quantity"],
+                  line["amount_cents"], line["discount_cents"], int(line["bonus"]))
+                 for i, line in enumerate(lines)])
+        for line in lines:
+            line["moment"] = moment
+            line["transaction_id"] = transaction_id
+        return lines
+
+    # -- reads ------------------------------------------------------------
+
+    def get_detail(self, account: str, transaction_id: str) -> Optional[Dict]:
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT detail FROM receipts WHERE account = ? AND transaction_id = ?",
+                (account, transaction_id)).fetchone()
+        return json.loads(row["detail"]) if row and row["detail"] else None
+
+    def has_summaries(self, account: str) -> bool:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT 1 FROM receipts WHERE account = ? AND summary IS NOT NULL LIMIT 1",
+                               (account,)).fetchone()
+        return row is not None
+
+    def list_summaries(self, account: str, limit: Optional[int] = None, after: Optional[Tuple[str, str]] = None,
+                       start: Optional[str] = None, end: Optional[str] = None) -> Tuple[List[Dict], Optional[Tuple[str, str]], int]:
+        """A page of receipt summaries, newest first.
+
+        Paging is keyset-based: `after` is the (moment, transaction id) of the last receipt
+        of the previous page. Returns (summaries, key for the next page or None, total
+        number of receipts within [start, end)).
+        """
+        where = " WHERE account = ? AND summary IS NOT NULL"
+        params: list = [account]
+        if start:
+            where += " AND moment >= ?"
+            params.append(start)
+        if end:
+            where += " AND moment < ?"
+            params.append(end)
+        with closing(self._connect()) as conn:
+            total = conn.execute("SELECT COUNT(*) FROM receipts" + where, params).fetchone()[0]
+            query = "SELECT COALESCE(moment, '') AS sort_moment, transaction_id, summary FROM receipts" + where
+            if after:
+                query += " AND (COALESCE(moment, '') < ? OR (COALESCE(moment, '') = ? AND transaction_id < ?))"
+                params += [after[0], after[0], after[1]]
+            query += " ORDER BY sort_moment DESC, transaction_id DESC"
+            if limit is not None:
+                # One extra row tells whether there is a next page.
+                query += " LIMIT ?"
+                params.append(limit + 1)
+            rows = conn.execute(query, params).fetchall()
+        next_key = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_key = (rows[-1]["sort_moment"], rows[-1]["transaction_id"])
+        return [json.loads(r["summary"]) for r in rows], next_key, total
+
+    def get_summary(self, account: str, transaction_id: str) -> Optional[Dict]:
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT summary FROM receipts WHERE account = ? AND transaction_id = ?",
+                (account, transaction_id)).fetchone()
+        return json.loads(row["summary"]) if row and row["summary"] else None
+
+    def missing_details(self, account: str) -> List[str]:
+        """Transaction ids known from the receipts list whose detail hasn't been stored yet."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT transaction_id FROM receipts WHERE account = ? AND detail IS NULL"
+                " ORDER BY moment DESC", (account,)).fetchall()
+        return [r["transaction_id"] for r in rows]
+
+    def iter_lines(self, account: str, start: Optional[str] = None, end: Optional[str] = None) -> Iterator[Dict]:
+        """Yield stored product lines oldest first, optionally within [start, end) ISO bounds.
+
+        Each batch is read with a short connection of its own, keyset-paged on (moment,
+        transaction id, line no), so the iterator can be advanced from any thread, as the
+        threadpool behind a StreamingResponse does.
+        """
+        select = ("SELECT transaction_id, line_no, moment, description, quantity, amount_cents,"
+                  " discount_cents, bonus FROM receipt_lines WHERE account = ?")
+        params: list = [account]
+        if start:
+            select += " AND moment >= ?"
+            params.append(start)
+        if end:
+            select += " AND moment < ?"
+            params.append(end)
+        key = None  # (moment, transaction id, line no) of the last line yielded
+        while True:
+            query, batch_params = select, list(params)
+            if key is not None and key[0] is None:
+                # Lines without a moment sort first; finish those, then continue with the rest.
+                query += " AND (moment IS NOT NULL OR (transaction_id, line_no) > (?, ?))"
+                batch_params += key[1:]
+            elif key is not None:
+                query += " AND (moment, transaction_id, line_no) > (?, ?, ?)"
+                batch_params += key
+            query += " ORDER BY moment, transaction_id, line_no LIMIT ?"
+            batch_params.append(BATCH_SIZE)
+            with closing(self._connect()) as conn:
+                rows = conn.execute(query, batch_params).fetchall()
+            for row in rows:
+                yield dict(row)
+            if len(rows) < BATCH_SIZE:
+                return
+            key = [rows[-1]["moment"], rows[-1]["transaction_id"], rows[-1]["line_no"]]
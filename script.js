@@ -16,7 +16,12 @@ const translations = {
             discount: 'Your Savings',
             total: 'Total',
             quantity: 'Qty',
-            backToList: 'Back to Receipts'
+            backToList: 'Back to Receipts',
+            loadMore: 'Load more receipts',
+            syncHistory: 'Sync full history',
+            syncProgress: 'Syncing receipts: {done} of {total}',
+            syncDone: 'History synced: {fetched} receipts fetched.',
+            syncFailed: 'History sync failed: {error}'
         },
         login: {
             title: 'Sign in with your Albert Heijn account to see your purchase history.',
@@ -42,7 +47,9 @@ const translations = {
             highlights: 'Highlights',
             fullDescription: 'Full Description',
             nutritionalInfo: 'Nutritional Information',
-            noInfo: 'No detailed information available for this product.'
+            noInfo: 'No detailed information available for this product.',
+            wrongMatch: 'Wrong product? Forget this match',
+            matchForgotten: 'Match forgotten. This item will be searched again next time.'
         }
     },
     nl: {
@@ -59,7 +66,12 @@ const translations = {
             discount: 'Uw Voordeel',
             total: 'Totaal',
             quantity: 'Aantal',
-            backToList: 'Terug naar Bonnen'
+            backToList: 'Terug naar Bonnen',
+            loadMore: 'Meer bonnen laden',
+            syncHistory: 'Volledige geschiedenis ophalen',
+            syncProgress: 'Bonnen ophalen: {done} van {total}',
+            syncDone: 'Geschiedenis opgehaald: {fetched} bonnen.',
+            syncFailed: 'Ophalen van geschiedenis mislukt: {error}'
         },
         login: {
             title: 'Log in met uw Albert Heijn account om uw aankoopgeschiedenis te zien.',
@@ -85,7 +97,9 @@ const translations = {
             highlights: 'Hoogtepunten',
             fullDescription: 'Volledige Beschrijving',
             nutritionalInfo: 'Voedingswaarde',
-            noInfo: 'Geen gedetailleerde informatie beschikbaar voor dit product.'
+            noInfo: 'Geen gedetailleerde informatie beschikbaar voor dit product.',
+            wrongMatch: 'Verkeerd product? Vergeet deze koppeling',
+            matchForgotten: 'Koppeling vergeten. Dit artikel wordt de volgende keer opnieuw gezocht.'
         }
     }
 };
@@ -470,18 +484,27 @@ document.getElementById('login-form')?.addEventListener('submit', async function
 
 // Load receipts
 // Load receipts
-async function loadReceipts() {
+const RECEIPTS_PAGE_SIZE = 50;
+let receiptsNextCursor = null;
+let loadedReceipts = [];
+
+async function loadReceipts(cursor = null) {
     showLoading();
     
     try {
-        const response = await fetch('/api/receipts');
+        const params = new URLSearchParams({ limit: RECEIPTS_PAGE_SIZE });
+        if (cursor) params.set('cursor', cursor);
+        // The browser revalidates with If-None-Match, so unchanged pages come back as 304s.
+        const response = await fetch(`/api/receipts?${params}`);
         
         if (!response.ok) {
             throw new Error('Failed to load receipts');
         }
         
         const data = await response.json();
-        displayReceipts(data.receipts);
+        loadedReceipts = cursor ? loadedReceipts.concat(data.receipts || []) : (data.receipts || []);
+        receiptsNextCursor = data.nextCursor || null;
+        displayReceipts(loadedReceipts);
         hideLoading();
     } catch (error) {
         hideLoading();
@@ -537,6 +560,14 @@ function displayReceipts(receipts) {
     listElement.innerHTML = '';
     listElement.appendChild(table);
     
+    if (receiptsNextCursor) {
+        const more = document.createElement('button');
+        more.className = 'load-more-btn';
+        more.textContent = translations[currentLanguage].receipt.loadMore;
+        more.addEventListener('click', () => loadReceipts(receiptsNextCursor));
+        listElement.appendChild(more);
+    }
+    
     // Add click handlers for view buttons
     document.querySelectorAll('.view-btn').forEach(btn => {
         btn.addEventListener('click', function() {
@@ -720,14 +751,101 @@ function PriceDifference({ productPrice, comparePrice, receiptIndicator, searchQ
     else return {score, expand: true };
 }
 
+// Receipt unit price for a receipt line (amount / quantity), or null when unparseable
+function receiptUnitPriceOf(item) {
+    const amount = parseFloat((item.amount || '').toString().replace(',', '.'));
+    const quantity = parseFloat((item.quantity || '1').toString().replace(',', '.')) || 1;
+    if (!Number.isFinite(amount)) return null;
+    return quantity > 0 ? amount / quantity : amount;
+}
+
+// Ask the server which receipt lines already have a confident remembered match.
+// Returns an array parallel to `products` (null entries for misses).
+async function lookupMatchMemo(products) {
+    try {
+        const response = await fetch('/api/matches/lookup', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                lines: products.map(p => ({ description: p.description, price: receiptUnitPriceOf(p) }))
+            })
+        });
+        if (!response.ok) return products.map(() => null);
+        const data = await response.json();
+        return (data.results || []).map(r => (r.hit && r.match && r.match.product) ? r.match : null);
+    } catch (error) {
+        console.warn('Match memo lookup failed:', error);
+        return products.map(() => null);
+    }
+}
+
+// Report the chosen product for a receipt description (fire-and-forget). The server
+// re-scores the line itself and remembers its own pick, so only the line and our pick are sent.
+function rememberMatch(description, bestMatch, receiptUnitPrice) {
+    if (!bestMatch || !bestMatch.product || bestMatch.product.webshopId == null) return;
+    fetch('/api/matches', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+            description,
+            webshopId: bestMatch.product.webshopId,
+            price: receiptUnitPrice
+        })
+    }).catch(error => console.warn('Could not remember match:', error));
+}
+
+// Fill a product card with the matched product's image and details
+function renderMatchedProduct(card, productInfo) {
+    // Find suitable image (200x200 or 400x400)
+    let imageUrl = '';
+    if (productInfo.images && productInfo.images.length > 0) {
+        const img = productInfo.images.find(img => img.width === 200) || 
+                   productInfo.images.find(img => img.width === 400) ||
+                   productInfo.images[0];
+        
+        // Use our proxy to avoid CORS issues
+        imageUrl = `/api/products/image?url=${encodeURIComponent(img.url)}`;
+    }
+    
+    // Update the card with image and additional info
+    const placeholder = card.querySelector('.product-image-placeholder');
+    if (imageUrl) {
+        placeholder.innerHTML = `<img src="${imageUrl}" alt="${productInfo.title}" onerror="this.parentElement.innerHTML='<div class=\\'no-image\\'>📦</div>'" />`;
+    } else {
+        placeholder.innerHTML = `<div class="no-image">📦</div>`;
+    }
+    
+    // Add more product info
+    const infoDiv = card.querySelector('.product-info');
+    if (productInfo.salesUnitSize) {
+        infoDiv.innerHTML += `<p class="product-size">${productInfo.salesUnitSize}</p>`;
+    }
+    
+    // Add bonus indicator if applicable
+    if (productInfo.discountType) {
+        infoDiv.innerHTML += `<p class="product-bonus">🏷️ Bonus</p>`;
+    }
+    
+    // Store full product data for detail view
+    card.setAttribute('data-product-data', JSON.stringify(productInfo));
+}
+
 // Enrich products with images and details from product search API
 async function enrichProductsWithDetails(products) {
+    // Lines with a confident remembered match skip searching and scoring entirely
+    const memoMatches = await lookupMatchMemo(products);
     for (let i = 0; i < products.length; i++) {
         const product = products[i];
         const card = document.querySelector(`[data-product-index="${i}"]`);
         
         if (!card) continue;
         
+        if (memoMatches[i]) {
+            console.log(`Match memo hit for "${product.description}" -> ${memoMatches[i].title}`);
+            renderMatchedProduct(card, memoMatches[i].product);
+            continue;
+        }
+        
     // Get the receipt data for matching
     // Parse numeric fields robustly (receipt uses commas for decimals sometimes)
     const rawPriceStr = (card.getAttribute('data-product-price') || '').toString();
@@ -1073,38 +1191,8 @@ async function enrichProductsWithDetails(products) {
                     // ignore
                 }
 
-                // Find suitable image (200x200 or 400x400)
-                let imageUrl = '';
-                if (productInfo.images && productInfo.images.length > 0) {
-                    const img = productInfo.images.find(img => img.width === 200) || 
-                               productInfo.images.find(img => img.width === 400) ||
-                               productInfo.images[0];
-                    
-                    // Use our proxy to avoid CORS issues
-                    imageUrl = `/api/products/image?url=${encodeURIComponent(img.url)}`;
-                }
-                
-                // Update the card with image and additional info
-                const placeholder = card.querySelector('.product-image-placeholder');
-                if (imageUrl) {
-                    placeholder.innerHTML = `<img src="${imageUrl}" alt="${productInfo.title}" onerror="this.parentElement.innerHTML='<div class=\\'no-image\\'>📦</div>'" />`;
-                } else {
-                    placeholder.innerHTML = `<div class="no-image">📦</div>`;
-                }
-                
-                // Add more product info
-                const infoDiv = card.querySelector('.product-info');
-                if (productInfo.salesUnitSize) {
-                    infoDiv.innerHTML += `<p class="product-size">${productInfo.salesUnitSize}</p>`;
-                }
-                
-                // Add bonus indicator if applicable
-                if (productInfo.discountType) {
-                    infoDiv.innerHTML += `<p class="product-bonus">🏷️ Bonus</p>`;
-                }
-                
-                // Store full product data for detail view
-                card.setAttribute('data-product-data', JSON.stringify(productInfo));
+                rememberMatch(receiptDescription, bestMatch, receiptUnitPrice);
+                renderMatchedProduct(card, productInfo);
             } else {
                 // No product found, show placeholder
                 const placeholder = card.querySelector('.product-image-placeholder');
@@ -1129,6 +1217,50 @@ document.getElementById('logout-btn')?.addEventListener('click', async function(
     }
 });
 
+// Fetch every receipt detail into the server-side history as a background job.
+// The job keeps running if this page is closed; progress streams in over server-sent events.
+document.getElementById('sync-history-btn')?.addEventListener('click', async function() {
+    const button = this;
+    const t = translations[currentLanguage].receipt;
+    const format = (text, values) => text.replace(/\{(\w+)\}/g, (_, key) => values[key] ?? '');
+    button.disabled = true;
+    try {
+        const response = await fetch('/api/jobs', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json', 'Idempotency-Key': `backfill-${new Date().toISOString().slice(0, 13)}` },
+            body: JSON.stringify({ kind: 'backfill' })
+        });
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        const job = await response.json();
+        const events = new EventSource(`/api/jobs/${job.id}/events`);
+        const update = (event) => {
+            const state = JSON.parse(event.data);
+            if (state.progress && state.progress.total != null) {
+                showSuccess(format(t.syncProgress, state.progress));
+            }
+        };
+        events.addEventListener('progress', update);
+        events.addEventListener('done', async (event) => {
+            events.close();
+            button.disabled = false;
+            const state = JSON.parse(event.data);
+            if (state.status !== 'succeeded') {
+                showError(format(t.syncFailed, { error: state.error || state.status }));
+                return;
+            }
+            const result = await (await fetch(`/api/jobs/${job.id}/result`)).json();
+            showSuccess(format(t.syncDone, result.result || {}));
+        });
+        events.onerror = () => {
+            events.close();
+            button.disabled = false;
+        };
+    } catch (error) {
+        button.disabled = false;
+        showError(format(t.syncFailed, { error: error.message }));
+    }
+});
+
 // UI Helper Functions
 function showLoginSection() {
     document.getElementById('login-section').style.display = 'block';
@@ -1192,8 +1324,21 @@ async function showProductDetails(index) {
         return;
     }
     
-    const product = JSON.parse(productDataStr);
+    let product = JSON.parse(productDataStr);
     const t = translations[currentLanguage].modal;
+
+    // Prefer the local catalog's copy (kept fresh server-side); the card snapshot may be an old memo match
+    if (product.webshopId) {
+        try {
+            const response = await fetch(`/api/products/${product.webshopId}`);
+            if (response.ok) {
+                const entry = await response.json();
+                product = { ...product, ...entry.product };
+            }
+        } catch (error) {
+            console.warn('Catalog lookup failed, using card data:', error);
+        }
+    }
     
     // Log product data to see nutrition structure
     console.log('Full product data:', product);
@@ -1283,6 +1428,7 @@ async function showProductDetails(index) {
                             <h3>${t.fullDescription}</h3>
                             <p>${descriptionFull}</p>
                         </div>` : ''}
+                    <button class="modal-unmatch" onclick="forgetProductMatch(${index})">${t.wrongMatch}</button>
                 </div>
             </div>
         </div>
@@ -1295,6 +1441,21 @@ async function showProductDetails(index) {
     document.body.appendChild(modalContainer);
 }
 
+// Drop the remembered match for a product card so it is searched again next time
+async function forgetProductMatch(index) {
+    const card = document.querySelector(`[data-product-index="${index}"]`);
+    if (!card) return;
+    const description = card.getAttribute('data-product-name');
+    try {
+        await fetch(`/api/matches?description=${encodeURIComponent(description)}`, { method: 'DELETE' });
+        closeProductModal();
+        showSuccess(translations[currentLanguage].modal.matchForgotten);
+        setTimeout(hideSuccess, 3000);
+    } catch (error) {
+        console.error('Could not forget match:', error);
+    }
+}
+
 // Format nutritional information for display
 function formatNutritionalInfo(nutritionData) {
     if (!nutritionData) return '<p>No nutritional information available</p>';
@@ -6,16 +6,37 @@ import httpx
 from typing import Optional, Dict
 import asyncio
 import uuid
+from collections import deque
 from uuid import uuid4
 from fastapi import FastAPI, HTTPException, Form, Request
-from fastapi.responses import JSONResponse, FileResponse, HTMLResponse
+from fastapi.responses import JSONResponse, FileResponse, HTMLResponse, Response, StreamingResponse
 from fastapi import Body
 from fastapi.staticfiles import StaticFiles
 import base64
+import csv
+import functools
+import io
+import zlib
 import hashlib
+import hmac
+import random
+import re
 import secrets
 from urllib.parse import urlencode
 
+from catalog import ProductCatalog
+from history_index import HistoryIndex
+from jobs import Job, JobQueue, UnknownJobKind
+from match_memo import MatchMemo, memo_key
+from matcher import BatchMatcher, search_query
+from price_history import PriceHistory, description_key, product_key
+from ratelimit import RateLimitExceeded, SharedTokenBucket, UpstreamGovernor
+from receipt_lines import parse_moment, parse_receipt_lines
+from receipt_store import ReceiptStore
+from shared_state import LeaseTimeout, SharedState, atomic_write_text, new_owner
+from suggestions import SuggestionModel
+from tracing import TRACER, current_span, span, span_tree
+
 app = FastAPI()
 
 # ...existing code...
@@ -27,6 +48,7 @@ import os
 
 TOKENS_PATH = Path("appie!/ah_tokens.json")
 DEVICE_ID_COOKIE = "ah_device_id"
+ACCOUNT_COOKIE = "appie_account"
 
 # In serverless environments (like Vercel), filesystem is ephemeral/readonly except /tmp.
 # We'll primarily use cookies for per-user state; fall back to /tmp for local dev.
@@ -34,6 +56,10 @@ TMP_DIR = Path("/tmp")
 TMP_DIR.mkdir(exist_ok=True)
 DEVICE_ID_TMP_PATH = TMP_DIR / "device_id.txt"
 DEVICE_ID = None  # will be set per-request from cookie or tmp
+# Local data (price history, stored receipts, ...). Only /tmp is writable on Vercel.
+DATA_DIR = Path(os.environ.get("APPIE_DATA_DIR") or (TMP_DIR / "appie-data" if os.environ.get("VERCEL") else "appie!/data"))
+# Tokens, device ids, locks and cache entries shared by all worker processes.
+SHARED_STATE = SharedState(DATA_DIR / "shared_state.sqlite")
 
 
 def _cookie_to_tokens(cookie_val: Optional[str]) -> Optional[Dict]:
@@ -71,11 +97,10 @@ def save_tokens(tokens: Dict) -> Dict:
     }
     if user_flag:
         normalized["user"] = True
-    # Persist locally for dev; cookie for prod
+    # Persist locally for dev; cookie for prod. Written via rename so a concurrent reader
+    # (another worker) never sees a half-written file.
     try:
-        TOKENS_PATH.parent.mkdir(parents=True, exist_ok=True)
-        with TOKENS_PATH.open("w", encoding="utf-8") as f:
-            json.dump(normalized, f)
+        atomic_write_text(TOKENS_PATH, json.dumps(normalized))
     except Exception:
         pass
     return normalized
@@ -92,33 +117,262 @@ def _determine_device_id(request: Request) -> str:
     cookie_id = request.cookies.get(DEVICE_ID_COOKIE)
     if cookie_id:
         return cookie_id
-    # Fallback to tmp file in local/serverful envs
-    if DEVICE_ID_TMP_PATH.exists():
-        try:
-            return DEVICE_ID_TMP_PATH.read_text().strip()
-        except Exception:
-            pass
-    # Generate new
-    new_id = str(uuid4())
+    # Fallback to one id shared by all workers in local/serverful envs; whichever worker
+    # gets here first creates it.
+    return SHARED_STATE.get_or_create("device-id", "default", _initial_device_id)
+
+
+def _initial_device_id() -> str:
+    # Keep the id an older version left in /tmp, so upstream keeps seeing the same device.
     try:
-        DEVICE_ID_TMP_PATH.write_text(new_id)
+        legacy = DEVICE_ID_TMP_PATH.read_text().strip()
+        if legacy:
+            return legacy
     except Exception:
         pass
-    return new_id
+    return str(uuid4())
+
+# ----------------------------
+# Latency budget & hedging
+# ----------------------------
+
+# End-to-end budget (seconds) for all upstream work done on behalf of one incoming request:
+# token refresh, retries, backoff sleeps and the v1->v2 fallback all draw from it.
+REQUEST_BUDGET = float(os.environ.get("AH_REQUEST_BUDGET", "8"))
+# Upper bound for a single upstream attempt; the remaining budget is used when it is smaller.
+ATTEMPT_TIMEOUT = float(os.environ.get("AH_ATTEMPT_TIMEOUT", "10"))
+# Don't start an attempt with less than this much budget left.
+MIN_ATTEMPT_BUDGET = 0.25
+# Hedged GETs: when enabled, a duplicate request is sent if the first one hasn't answered
+# after AH_HEDGE_DELAY seconds, or after the observed p95 latency for that path when unset.
+HEDGE_ENABLED = os.environ.get("AH_HEDGE", "0") in ("1", "true", "yes")
+HEDGE_DELAY = float(os.environ["AH_HEDGE_DELAY"]) if os.environ.get("AH_HEDGE_DELAY") else None
+HEDGE_MIN_SAMPLES = 20
+# path -> recent upstream latencies (seconds)
+_LATENCY_SAMPLES: Dict[str, deque] = {}
+HEDGE_STATS = {"sent": 0, "won": 0}
+
+
+# Upstream rate limiting: everything leaves from one IP, so a global token bucket (shared by
+# all workers) caps the deployment while per-account buckets and concurrency caps keep users
+# fair; those are per worker.
+RATE_GLOBAL = float(os.environ.get("AH_RATE_GLOBAL", "10"))
+RATE_GLOBAL_BURST = float(os.environ.get("AH_RATE_GLOBAL_BURST", "20"))
+UPSTREAM_GOVERNOR = UpstreamGovernor(
+    global_rate=RATE_GLOBAL,
+    global_burst=RATE_GLOBAL_BURST,
+    global_bucket=SharedTokenBucket(SHARED_STATE, "upstream", RATE_GLOBAL, RATE_GLOBAL_BURST),
+    account_rate=float(os.environ.get("AH_RATE_ACCOUNT", "4")),
+    account_burst=float(os.environ.get("AH_RATE_ACCOUNT_BURST", "8")),
+    account_concurrency=int(os.environ.get("AH_ACCOUNT_CONCURRENCY", "4")),
+    max_queue=int(os.environ.get("AH_QUEUE_MAX", "200")),
+    max_queue_per_account=int(os.environ.get("AH_QUEUE_MAX_PER_ACCOUNT", "50")),
+)
+
+
+@app.exception_handler(RateLimitExceeded)
+async def rate_limited_handler(request: Request, exc: RateLimitExceeded):
+    return JSONResponse(
+        {"ok": False, "error_code": "rate_limited", "detail": exc.reason},
+        status_code=429,
+        headers={"Retry-After": str(int(exc.retry_after + 0.5))},
+    )
+
+
+def limiter_key(request: Request) -> str:
+    """Who an upstream call counts against in the per-account rate limits.
+
+    Not `account_key`: a client without the account cookie gets a new account id on every
+    request. The key is the AH login instead (a hash of its refresh token), or the client
+    address when there are no tokens.
+    """
+    tokens = load_tokens(request) or {}
+    secret = tokens.get("refresh_token") or tokens.get("access_token")
+    if secret:
+        return "ah-" + hashlib.sha256(str(secret).encode()).hexdigest()[:32]
+    return "ip-" + (request.client.host if request.client else "unknown")
+
+
+@app.middleware("http")
+async def stamp_request_deadline(request: Request, call_next):
+    request.state.deadline = time.monotonic() + REQUEST_BUDGET
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def trace_request(request: Request, call_next):
+    # One root span per API call; its child spans show where the time went.
+    path = request.url.path
+    if not path.startswith("/api/") or path.startswith("/api/debug/traces"):
+        return await call_next(request)
+    with TRACER.trace(f"{request.method} {path}", method=request.method, path=path) as root:
+        response = await call_next(request)
+        root.set(status_code=response.status_code)
+        if "content-length" not in response.headers:
+            # Streamed body (export, job events): this trace ends at the first byte, not the last.
+            root.set(streamed=True)
+        if response.status_code >= 500:
+            root.fail(f"HTTP {response.status_code}")
+    if root.trace_id:
+        response.headers["X-Trace-Id"] = root.trace_id
+    return response
+
+
+def remaining_budget(request: Request) -> float:
+    deadline = getattr(request.state, "deadline", None)
+    if deadline is None:
+        # Called outside the middleware (e.g. a synthetic request); start the clock now.
+        deadline = request.state.deadline = time.monotonic() + REQUEST_BUDGET
+    return deadline - time.monotonic()
+
+
+def detached_request(request: Request) -> Request:
+    """A copy of `request` for work that outlives it, with its own state and latency budget.
+
+    The copy shares the cookies and account but not `request.state`, so setting its
+    deadline leaves the budget of the request it was started from alone.
+    """
+    state = {**request.scope.get("state", {}), "deadline": time.monotonic() + REQUEST_BUDGET}
+    return Request({**request.scope, "state": state})
+
+
+def attempt_timeout(request: Request) -> float:
+    """Timeout for the next upstream attempt, or 504 when the request budget is spent."""
+    remaining = remaining_budget(request)
+    if remaining < MIN_ATTEMPT_BUDGET:
+        raise HTTPException(status_code=504, detail="Upstream latency budget exhausted")
+    return min(ATTEMPT_TIMEOUT, remaining)
+
+
+def _record_latency(path: str, seconds: float) -> None:
+    _LATENCY_SAMPLES.setdefault(path, deque(maxlen=200)).append(seconds)
+
+
+def latency_percentile(path: str, pct: float) -> Optional[float]:
+    samples = _LATENCY_SAMPLES.get(path)
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+def _hedge_delay(path: str) -> Optional[float]:
+    if not HEDGE_ENABLED:
+        return None
+    if HEDGE_DELAY is not None:
+        return HEDGE_DELAY
+    if len(_LATENCY_SAMPLES.get(path, ())) < HEDGE_MIN_SAMPLES:
+        return None
+    return latency_percentile(path, 0.95)
+
+
+async def _send_get(client: httpx.AsyncClient, path: str, params: Optional[Dict],
+                    headers: Dict[str, str], timeout: float, account: Optional[str] = None) -> httpx.Response:
+    """One logical upstream GET, optionally hedged with a duplicate after the p95 delay.
+
+    Whichever copy answers first wins; the other is cancelled. The hedge only goes out if
+    the rate limiter has a slot free for `account` right now; it never queues.
+    """
+    url = f"{AH_BASE}{path}"
+    started = time.monotonic()
+
+    async def get(budget: float, hedge: bool = False) -> httpx.Response:
+        correlation_id = str(uuid.uuid4())
+        # The correlation id on the span matches this exchange up with upstream's logs.
+        with span("upstream.get", path=path, correlation_id=correlation_id, timeout=round(budget, 3),
+                  hedge=hedge) as s:
+            # httpx timeouts apply per network operation; wait_for bounds the whole exchange.
+            try:
+                resp = await asyncio.wait_for(client.get(
+                    url, params=params, timeout=budget,
+                    headers={**headers, "X-Correlation-ID": correlation_id},
+                ), budget)
+            except asyncio.TimeoutError:
+                raise httpx.ReadTimeout(f"Upstream GET {path} exceeded {budget:.2f}s")
+            except asyncio.CancelledError:
+                s.set(cancelled=True)
+                raise
+            s.set(status_code=resp.status_code)
+            return resp
+
+    def fire(budget: float, hedge: bool = False) -> asyncio.Task:
+        return asyncio.ensure_future(get(budget, hedge))
+
+    primary = fire(timeout)
+    delay = _hedge_delay(path)
+    if delay is None or delay >= timeout - MIN_ATTEMPT_BUDGET:
+        resp = await primary
+        _record_latency(path, time.monotonic() - started)
+        return resp
+
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if primary in done:
+        resp = primary.result()
+        _record_latency(path, time.monotonic() - started)
+        return resp
+
+    hedge_slot = UPSTREAM_GOVERNOR.try_slot(account) if account is not None else None
+    if account is not None and hedge_slot is None:
+        resp = await primary
+        _record_latency(path, time.monotonic() - started)
+        return resp
+    hedge = fire(timeout - delay, hedge=True)
+    HEDGE_STATS["sent"] += 1
+    pending = {primary, hedge}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        HEDGE_STATS["won"] += 1
+                    _record_latency(path, time.monotonic() - started)
+                    return task.result()
+                error = task.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+        if hedge_slot is not None:
+            await hedge_slot.__aexit__(None, None, None)
+    raise error
+
+
+# How long a spent refresh token keeps mapping to the tokens it was exchanged for (seconds).
+REFRESHED_TOKENS_TTL = 30 * 86400
+REFRESH_CHAIN_MAX = 5
+
 
 async def refresh_token_if_needed(request: Request) -> str:
     tokens = load_tokens(request)
     if not tokens:
         raise HTTPException(status_code=401, detail="Not logged in (no tokens)")
 
-    if not token_is_expired(tokens):
-        return tokens["access_token"]
-
+    # Tokens refreshed earlier (by any worker) are found under the refresh token that was
+    # spent for them, so a client still sending the old cookie gets the new tokens instead
+    # of refreshing again; follow the chain when those expired too.
+    for _ in range(REFRESH_CHAIN_MAX):
+        if not token_is_expired(tokens):
+            return tokens["access_token"]
+        refresh_token = tokens.get("refresh_token")
+        if not refresh_token:
+            raise HTTPException(status_code=401, detail="No refresh token; please log in again")
+        key = hashlib.sha256(refresh_token.encode()).hexdigest()
+        with span("token.refresh") as s:
+            s.set(cached=SHARED_STATE.get("refreshed-tokens", key) is not None)
+            try:
+                tokens = await SHARED_STATE.single_flight(
+                    "refreshed-tokens", key, functools.partial(_refresh_access_token, request, tokens),
+                    ttl=REFRESHED_TOKENS_TTL, lease_ttl=ATTEMPT_TIMEOUT + 5, wait=max(0.0, remaining_budget(request)))
+            except LeaseTimeout:
+                raise HTTPException(status_code=504, detail="Token refresh still in progress elsewhere")
+    raise HTTPException(status_code=401, detail="Tokens expired; please log in again")
+
+
+async def _refresh_access_token(request: Request, tokens: Dict) -> Dict:
     refresh_token = tokens.get("refresh_token")
-    if not refresh_token:
-        raise HTTPException(status_code=401, detail="No refresh token; please log in again")
 
-    async with httpx.AsyncClient(timeout=10.0) as client:
+    async with httpx.AsyncClient(timeout=attempt_timeout(request)) as client:
         resp = await client.post(
             f"{AH_BASE}/mobile-auth/v1/auth/token/refresh",
             json={"clientId": AH_CLIENT_ID, "refreshToken": refresh_token},
@@ -141,8 +395,7 @@ async def refresh_token_if_needed(request: Request) -> str:
     # Inherit user flag from previous tokens if it existed
     if tokens.get("user"):
         new_tokens["user"] = True
-    saved = save_tokens(new_tokens)
-    return new_tokens["access_token"]
+    return save_tokens(new_tokens)
 
 
 async def exchange_code_for_token(code: str, request: Request) -> Dict:
@@ -246,6 +499,9 @@ async def api_login(request: Request, code: str = Form(...), state: str = Form(N
         secure=True,
         samesite="lax",
     )
+    # Stored data stays with this browser's account across logins until it logs out.
+    _set_account_cookie(response, account_key(request))
+    request.state.account_issued = False
     # Clear oauth cookies post-success
     response.delete_cookie("oauth_state")
     response.delete_cookie("pkce_v")
@@ -261,6 +517,7 @@ async def api_logout():
         except Exception:
             pass
     resp = JSONResponse({"status": "ok"})
+    # Only the AH tokens: the account cookie stays, so logging in again finds the stored data.
     resp.delete_cookie("ah_tokens")
     return resp
 
@@ -409,13 +666,9 @@ async def login_callback(request: Request):
         return HTMLResponse(content=html)
 
 
-async def ah_get(path: str, params: Optional[Dict] = None, request: Optional[Request] = None) -> httpx.Response:
-    # Request is required for cookie-based state; maintain backward compatibility if None
-    if request is None:
-        raise HTTPException(status_code=400, detail="Missing request context")
-    access_token = await refresh_token_if_needed(request)
+def _upstream_headers(access_token: str, device_id: str) -> Dict[str, str]:
     # Emulate more mobile headers for gateway routing; adjust values as needed.
-    base_headers = {
+    return {
         "User-Agent": f"{AH_USER_AGENT} (Android; 14; Sandbox)",
         "Authorization": f"Bearer {access_token}",
         "Accept": "application/json",
@@ -429,59 +682,371 @@ async def ah_get(path: str, params: Optional[Dict] = None, request: Optional[Req
         "X-Device-Platform": "android",
         "X-Device-Type": "phone",
         "X-OS-Version": "14",
-    "X-Device-Id": _determine_device_id(request),
+        "X-Device-Id": device_id,
         "X-Device-Model": "Pixel 7 Sandbox",
         "X-Network-Type": "wifi",
         "X-Platform": "android",
     }
 
+
+async def ah_get(path: str, params: Optional[Dict] = None, request: Optional[Request] = None) -> httpx.Response:
+    # Request is required for cookie-based state; maintain backward compatibility if None
+    if request is None:
+        raise HTTPException(status_code=400, detail="Missing request context")
+    access_token = await refresh_token_if_needed(request)
+    device_id = _determine_device_id(request)
+    account = limiter_key(request)
+    base_headers = _upstream_headers(access_token, device_id)
+
     # Retry & fallback logic: try path as-is; if still 503 service_unreachable, attempt v2 variant.
+    # Every attempt, backoff sleep and the fallback stay within the request's latency budget.
     attempts = 3
     last_resp = None
-    async with httpx.AsyncClient(timeout=10.0) as client:
+    async with httpx.AsyncClient(timeout=ATTEMPT_TIMEOUT) as client:
         for attempt in range(attempts):
-            correlation_id = str(uuid.uuid4())
-            headers = {**base_headers, "X-Correlation-ID": correlation_id}
-            last_resp = await client.get(f"{AH_BASE}{path}", params=params, headers=headers)
+            timeout = attempt_timeout(request) if last_resp is None else min(ATTEMPT_TIMEOUT, remaining_budget(request))
+            if timeout < MIN_ATTEMPT_BUDGET:
+                return last_resp
+            started = time.monotonic()
+            try:
+                with span("upstream.attempt", path=path, attempt=attempt + 1) as s:
+                    async with UPSTREAM_GOVERNOR.slot(account, timeout=timeout - MIN_ATTEMPT_BUDGET):
+                        # Time spent queued for a slot comes out of this attempt's budget.
+                        s.set(queued_ms=round((time.monotonic() - started) * 1000, 3))
+                        timeout = min(timeout, remaining_budget(request))
+                        last_resp = await _send_get(client, path, params, base_headers, timeout, account)
+                    s.set(status_code=last_resp.status_code)
+            except httpx.TimeoutException:
+                _record_endpoint_health(path, None, time.monotonic() - started, error="timeout")
+                if last_resp is None and remaining_budget(request) < MIN_ATTEMPT_BUDGET:
+                    raise HTTPException(status_code=504, detail=f"Upstream timeout for {path}")
+                continue
+            _record_endpoint_health(path, last_resp.status_code, time.monotonic() - started)
             if last_resp.status_code != 503:
                 return last_resp
             # backoff before retry with slight jitter to look less bot-like
             base = 0.5 * (2 ** attempt)
             jitter = 0.2 * base
-            import random
-            await asyncio.sleep(base + random.uniform(-jitter, jitter))
+            backoff = base + random.uniform(-jitter, jitter)
+            if backoff + MIN_ATTEMPT_BUDGET > remaining_budget(request):
+                # Not enough budget left to sleep and retry; hand back what we have.
+                break
+            with span("backoff", path=path, attempt=attempt + 1, seconds=round(backoff, 3)):
+                await asyncio.sleep(backoff)
 
         # If still 503 and initial path is v1, try v2 variant once.
-        if path == "/mobile-services/v1/receipts":
+        if path == "/mobile-services/v1/receipts" and remaining_budget(request) >= MIN_ATTEMPT_BUDGET:
             alt_path = "/mobile-services/v2/receipts"
-            correlation_id = str(uuid.uuid4())
-            headers = {**base_headers, "X-Correlation-ID": correlation_id}
-            alt_resp = await client.get(f"{AH_BASE}{alt_path}", params=params, headers=headers)
-            # Return alt_resp regardless; caller will decide.
-            return alt_resp
-
+            started = time.monotonic()
+            try:
+                with span("upstream.fallback", path=alt_path, from_path=path) as s:
+                    async with UPSTREAM_GOVERNOR.slot(account, timeout=remaining_budget(request) - MIN_ATTEMPT_BUDGET):
+                        alt_resp = await _send_get(client, alt_path, params, base_headers,
+                                                   min(ATTEMPT_TIMEOUT, remaining_budget(request)), account)
+                    s.set(status_code=alt_resp.status_code)
+            except httpx.TimeoutException:
+                _record_endpoint_health(alt_path, None, time.monotonic() - started, error="timeout")
+                alt_resp = None
+            if alt_resp is not None:
+                _record_endpoint_health(alt_path, alt_resp.status_code, time.monotonic() - started)
+                # Return alt_resp regardless; caller will decide.
+                return alt_resp
+
+    if last_resp is None:
+        raise HTTPException(status_code=504, detail=f"Upstream timeout for {path}")
     return last_resp
 
 
-@app.get("/api/receipts")
-async def api_receipts(request: Request):
+# ----------------------------
+# Receipt endpoint health table
+# ----------------------------
+
+# Known receipt list endpoint variants, in order of preference.
+RECEIPT_ENDPOINTS = [
+    "/mobile-services/v1/receipts",
+    "/mobile-services/v2/receipts",
+    "/mobile-services/receipts/v1/receipts",  # speculative legacy
+]
+# Overall deadline (seconds) for one concurrent probe round.
+PROBE_DEADLINE = float(os.environ.get("AH_PROBE_DEADLINE", "6"))
+# Background prober interval in seconds; 0 disables it (e.g. on serverless).
+PROBE_INTERVAL = float(os.environ.get("AH_PROBE_INTERVAL", "0"))
+# Health entries older than this are considered stale and re-probed on demand.
+PROBE_TTL = float(os.environ.get("AH_PROBE_TTL", str(max(PROBE_INTERVAL * 2, 60))))
+
+# path -> {"status_code", "ok", "latency_ms", "checked_at", "error"}
+ENDPOINT_HEALTH: Dict[str, Dict] = {}
+# Token file the background prober authenticates with: its own credential, never a user's.
+PROBE_TOKENS_PATH = Path(os.environ.get("AH_PROBE_TOKENS") or TOKENS_PATH)
+_PROBE_TASK: Optional[asyncio.Task] = None
+
+
+def _record_endpoint_health(path: str, status_code: Optional[int], latency: float, error: Optional[str] = None) -> None:
+    if path not in RECEIPT_ENDPOINTS:
+        return
+    ENDPOINT_HEALTH[path] = {
+        "status_code": status_code,
+        "ok": status_code == 200,
+        "latency_ms": int(latency * 1000),
+        "checked_at": time.time(),
+        "error": error,
+    }
+
+
+def _health_is_fresh(path: str) -> bool:
+    entry = ENDPOINT_HEALTH.get(path)
+    return bool(entry) and (time.time() - entry["checked_at"]) < PROBE_TTL
+
+
+def preferred_receipts_path() -> str:
+    """Pick the receipt list endpoint to try first, based on the health table.
+
+    Falls back to the v1 endpoint when nothing is known (or nothing is healthy).
+    """
+    for path in RECEIPT_ENDPOINTS:
+        if _health_is_fresh(path) and ENDPOINT_HEALTH[path]["ok"]:
+            return path
+    return RECEIPT_ENDPOINTS[0]
+
+
+async def _probe_once(client: httpx.AsyncClient, path: str, headers: Dict[str, str], account: str) -> Dict:
+    """Single GET against one candidate path (no retries) for diagnostics."""
+    started = time.monotonic()
+    try:
+        async with UPSTREAM_GOVERNOR.slot(account):
+            resp = await client.get(
+                f"{AH_BASE}{path}",
+                headers={**headers, "X-Correlation-ID": str(uuid.uuid4())},
+            )
+    except RateLimitExceeded as e:
+        return {"path": path, "status_code": None, "ok": False, "error": f"rate_limited: {e.reason}"}
+    except httpx.HTTPError as e:
+        _record_endpoint_health(path, None, time.monotonic() - started, error=type(e).__name__)
+        return {"path": path, "status_code": None, "ok": False, "error": str(e) or type(e).__name__}
+    _record_endpoint_health(path, resp.status_code, time.monotonic() - started)
+    parsed = None
+    try:
+        parsed = resp.json()
+    except Exception:
+        pass
+    return {
+        "path": path,
+        "status_code": resp.status_code,
+        "ok": resp.status_code == 200,
+        "headers": dict(resp.headers),
+        "json_keys": list(parsed.keys()) if isinstance(parsed, dict) else None,
+        "body_snippet": resp.text[:400] if resp.text else "",
+    }
+
+
+async def probe_receipt_endpoints(access_token: str, device_id: str, deadline: Optional[float] = None,
+                                  account: str = "prober") -> list:
+    """Probe all receipt endpoint variants concurrently under one overall deadline.
+
+    Candidates still running when the deadline hits are cancelled and reported as timed out.
+    """
+    if deadline is None:
+        deadline = PROBE_DEADLINE
+    headers = _upstream_headers(access_token, device_id)
+    async with httpx.AsyncClient(timeout=deadline) as client:
+        tasks = {asyncio.create_task(_probe_once(client, path, headers, account)): path for path in RECEIPT_ENDPOINTS}
+        done, pending = await asyncio.wait(tasks.keys(), timeout=deadline)
+        for task in pending:
+            task.cancel()
+        results = []
+        for task, path in tasks.items():
+            if task in done and not task.cancelled() and task.exception() is None:
+                results.append(task.result())
+            else:
+                error = "timeout" if task in pending else repr(task.exception())
+                _record_endpoint_health(path, None, deadline, error=error)
+                results.append({"path": path, "status_code": None, "ok": False, "error": error})
+    return results
+
+
+def _prober_credentials() -> Optional[Dict[str, str]]:
+    # Only the dedicated token file: request credentials belong to their user and are
+    # never kept around for background work.
+    try:
+        tokens = json.loads(PROBE_TOKENS_PATH.read_text(encoding="utf-8"))
+    except Exception:
+        return None
+    if tokens.get("access_token") and not token_is_expired(tokens):
+        device_id = SHARED_STATE.get_or_create("device-id", "default", _initial_device_id)
+        return {"access_token": tokens["access_token"], "device_id": device_id}
+    return None
+
+
+async def _endpoint_prober_loop() -> None:
+    while True:
+        creds = _prober_credentials()
+        if creds:
+            try:
+                await probe_receipt_endpoints(creds["access_token"], creds["device_id"])
+            except Exception:
+                pass
+        await asyncio.sleep(PROBE_INTERVAL)
+
+
+@app.on_event("startup")
+async def start_endpoint_prober():
+    global _PROBE_TASK
+    if PROBE_INTERVAL > 0 and _PROBE_TASK is None:
+        _PROBE_TASK = asyncio.create_task(_endpoint_prober_loop())
+
+
+@app.on_event("shutdown")
+async def stop_endpoint_prober():
+    global _PROBE_TASK
+    if _PROBE_TASK is not None:
+        _PROBE_TASK.cancel()
+        _PROBE_TASK = None
+
+
+# ----------------------------
+# Receipts list (served from the local store)
+# ----------------------------
+
+# The upstream list is refetched in the background once it is older than this (seconds).
+RECEIPTS_TTL = float(os.environ.get("AH_RECEIPTS_TTL", "60"))
+RECEIPTS_PAGE_MAX = 200
+# In-flight background refreshes in this worker. The time of the last successful upstream
+# fetch ("receipts-fetched") and the refresh lease are shared by all workers.
+_RECEIPTS_REFRESHING: Dict[str, asyncio.Task] = {}
+
+
+async def fetch_receipts_list(request: Request):
+    """Fetch the receipts list upstream and write it through to the store.
+
+    Returns (response, attempts) so callers can report upstream errors.
+    """
     # Gather detailed attempts (primary + fallback) for structured diagnostics.
     attempts_meta = []
-    path_primary = "/mobile-services/v1/receipts"
+    # Start with whichever variant the health table last saw working (v1 by default).
+    with span("cache.endpoint_health") as s:
+        path_primary = preferred_receipts_path()
+        s.set(preferred=path_primary)
     resp = await ah_get(path_primary, request=request)
     attempts_meta.append({"path": path_primary, "status_code": resp.status_code})
     # If primary yielded 503 and we auto-fallback to v2 inside ah_get, we already returned alt resp; record alt if different.
     if path_primary == "/mobile-services/v1/receipts" and resp.status_code == 503:
         # Run explicit second attempt to collect meta (even if ah_get already tried internally)
         alt_path = "/mobile-services/v2/receipts"
-        alt_resp = await ah_get(alt_path, request=request)
+        with span("receipts.fallback", path=alt_path, from_path=path_primary) as s:
+            alt_resp = await ah_get(alt_path, request=request)
+            s.set(status_code=alt_resp.status_code)
         attempts_meta.append({"path": alt_path, "status_code": alt_resp.status_code})
         resp = alt_resp
 
     if resp.status_code == 200:
         data = resp.json()
-        return JSONResponse({"ok": True, "attempts": attempts_meta, "receipts": data})
+        if isinstance(data, list):
+            account = account_key(request)
+            with span("store.upsert_summaries", receipts=len(data)):
+                RECEIPT_STORE.upsert_summaries(account, data)
+            SHARED_STATE.put("receipts-fetched", account, time.time())
+    return resp, attempts_meta
+
+
+def _refresh_receipts_in_background(request: Request, account: str) -> None:
+    if account in _RECEIPTS_REFRESHING:
+        return
+    # One refresh per account across workers; the lease lapses if its worker dies.
+    lease, owner = f"receipts-refresh:{account}", new_owner()
+    if not SHARED_STATE.acquire(lease, owner, REQUEST_BUDGET + 5):
+        return
+    # The refresh outlives the request it was started from; give it a budget of its own.
+    request = detached_request(request)
+    started_by = current_span().trace_id
+
+    async def run():
+        # A trace of its own: the request's trace is exported as soon as the response is sent.
+        try:
+            with TRACER.trace("receipts.background_refresh", started_by=started_by):
+                await fetch_receipts_list(request)
+        except Exception:
+            pass
+        finally:
+            _RECEIPTS_REFRESHING.pop(account, None)
+            SHARED_STATE.release(lease, owner)
+    _RECEIPTS_REFRESHING[account] = asyncio.create_task(run())
+
+
+def _encode_cursor(key) -> Optional[str]:
+    if key is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: Optional[str]):
+    if not cursor:
+        return None
+    try:
+        moment, transaction_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return str(moment), str(transaction_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    # If-None-Match uses weak comparison, so a W/ prefix on the client's copy still matches.
+    candidates = [c.strip().removeprefix("W/") for c in header.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+def json_with_etag(request: Request, body: Dict, status_code: int = 200):
+    """JSONResponse with a strong ETag over its exact bytes; 304 when the client has them."""
+    content = json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    etag = '"' + hashlib.sha256(content).hexdigest()[:32] + '"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if status_code == 200 and _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=content, status_code=status_code, media_type="application/json", headers=headers)
+
 
+@app.get("/api/receipts")
+async def api_receipts(request: Request, limit: Optional[int] = None, cursor: Optional[str] = None,
+                       refresh: bool = False):
+    """Receipts list, newest first, served from the local store.
+
+    The upstream list is fetched synchronously only when nothing is stored yet for this
+    account (or `refresh=1`); otherwise it is refreshed in the background once older than
+    AH_RECEIPTS_TTL. Supports `limit` + `cursor` paging (`nextCursor` in the response),
+    `from` / `to` date filters, and `If-None-Match` against the response ETag.
+    """
+    if not load_tokens(request):
+        raise HTTPException(status_code=401, detail="Not logged in (no tokens)")
+    account = account_key(request)
+    after = _decode_cursor(cursor)
+    if limit is not None:
+        limit = max(1, min(limit, RECEIPTS_PAGE_MAX))
+    start, end = _iso_range(request)
+
+    body: Dict = {"ok": True}
+    fetched = SHARED_STATE.get("receipts-fetched", account)
+    with span("cache.receipts_list") as s:
+        stored = fetched is not None or RECEIPT_STORE.has_summaries(account)
+        stale = fetched is None or time.time() - fetched > RECEIPTS_TTL
+        s.set(hit=stored and not refresh, stale=stale)
+    if refresh or not stored:
+        resp, attempts_meta = await fetch_receipts_list(request)
+        if resp.status_code != 200:
+            return _receipts_error(resp, attempts_meta)
+        body["attempts"] = attempts_meta
+    elif stale:
+        _refresh_receipts_in_background(request, account)
+
+    with span("store.list_summaries", limit=limit) as s:
+        receipts, next_key, total = RECEIPT_STORE.list_summaries(account, limit, after, start, end)
+        s.set(returned=len(receipts), total=total)
+    body.update(receipts=receipts, nextCursor=_encode_cursor(next_key), total=total)
+    return json_with_etag(request, body)
+
+
+def _receipts_error(resp: httpx.Response, attempts_meta):
     # Parse upstream body for error details.
     upstream_body = resp.text
     parsed = None
@@ -507,64 +1072,1010 @@ async def api_receipts(request: Request):
         return JSONResponse(structured, status_code=503)
     return JSONResponse(structured, status_code=400)
 
+
 @app.get("/api/receipts/debug")
-async def api_receipts_debug(request: Request):
-    """Attempt multiple possible receipt endpoints and return a diagnostic report.
+async def api_receipts_debug(request: Request, refresh: bool = False):
+    """Probe the possible receipt endpoints and return a diagnostic report.
     Helps troubleshoot upstream 503 service_unreachable by showing each attempt's status and truncated body.
+
+    All candidates are probed concurrently under one deadline (AH_PROBE_DEADLINE). When the
+    health table is fresh (e.g. kept warm by the background prober) it is returned instantly
+    instead; pass ?refresh=1 to force a live probe.
     """
-    candidates = [
-        "/mobile-services/v1/receipts",
-        "/mobile-services/v2/receipts",
-        "/mobile-services/receipts/v1/receipts",  # speculative legacy
-    ]
-    results = []
-    for path in candidates:
-        resp = await ah_get(path, request=request)
-        body_snippet = resp.text[:400] if resp.text else ""
-        # Try JSON parse
-        parsed = None
-        try:
-            parsed = resp.json()
-        except Exception:
-            pass
-        results.append({
-            "path": path,
-            "status_code": resp.status_code,
-            "ok": resp.status_code == 200,
-            "headers": dict(resp.headers),
-            "json_keys": list(parsed.keys()) if isinstance(parsed, dict) else None,
-            "body_snippet": body_snippet,
+    if not refresh and all(_health_is_fresh(path) for path in RECEIPT_ENDPOINTS):
+        return JSONResponse({
+            "cached": True,
+            "preferred": preferred_receipts_path(),
+            "health": ENDPOINT_HEALTH,
         })
-        # Stop early if one succeeded
-        if resp.status_code == 200:
-            break
-    return JSONResponse({"diagnostics": results})
+    access_token = await refresh_token_if_needed(request)
+    results = await probe_receipt_endpoints(access_token, _determine_device_id(request), account=limiter_key(request))
+    return JSONResponse({
+        "cached": False,
+        "preferred": preferred_receipts_path(),
+        "diagnostics": results,
+        "health": ENDPOINT_HEALTH,
+    })
 
 
-@app.get("/api/receipts/{transaction_id}")
-async def api_receipt_detail(transaction_id: str, request: Request):
+async def fetch_receipt_detail(request: Request, transaction_id: str) -> Dict:
+    """Fetch one receipt detail upstream and record it into the local stores."""
     resp = await ah_get(f"/mobile-services/v2/receipts/{transaction_id}", request=request)
     if resp.status_code != 200:
         raise HTTPException(
             status_code=400,
             detail=f"Receipt detail fetch failed: {resp.status_code} {resp.text}",
         )
-    return JSONResponse(resp.json())
+    data = resp.json()
+    account = account_key(request)
+    PRICE_HISTORY.record_receipt(data, transaction_id, account)
+    with span("store.receipt_detail", transaction_id=transaction_id) as s:
+        lines = RECEIPT_STORE.store_detail(account, transaction_id, data)
+        s.set(lines=len(lines) if lines else 0)
+    if lines:
+        HISTORY_INDEX.add_lines(account, lines)
+        SUGGESTIONS.add_lines(account, lines)
+        lines_stored(account)
+    return data
 
 
-@app.get("/api/products/search")
-async def api_products_search(query: str, request: Request):
+@app.get("/api/receipts/{transaction_id}")
+async def api_receipt_detail(transaction_id: str, request: Request):
+    return JSONResponse(await fetch_receipt_detail(request, transaction_id))
+
+
+async def search_products(request: Request, query: str) -> Dict:
     resp = await ah_get(
         "/mobile-services/product/search/v2",
         params={"query": query, "sortOn": "RELEVANCE"},
         request=request,
     )
+    if resp.status_code == 429:
+        raise HTTPException(status_code=429, detail="Product search rate limited upstream",
+                            headers={"Retry-After": resp.headers.get("Retry-After", "1")})
     if resp.status_code != 200:
         raise HTTPException(
-            status_code=400,
+            status_code=502 if resp.status_code >= 500 else 400,
             detail=f"Product search failed: {resp.status_code} {resp.text}",
         )
-    return JSONResponse(resp.json())
+    data = resp.json()
+    PRICE_HISTORY.record_search(data.get("products") or [])
+    with span("store.catalog_upsert", products=len(data.get("products") or [])) as s:
+        s.set(changed=CATALOG.upsert(data.get("products") or []))
+    return data
+
+
+@app.get("/api/products/search")
+async def api_products_search(query: str, request: Request, source: Optional[str] = None):
+    """Upstream product search; `source=local` searches the local catalog instead.
+
+    When upstream can't be reached (server errors, connection errors, out of budget) the local
+    catalog answers if it has matches, marked with `"source": "catalog"`. Auth errors (401) and
+    rate limiting (429) are passed on, so the client still logs in again or backs off.
+    """
+    if source == "local":
+        return JSONResponse(local_product_search(query))
+    try:
+        return JSONResponse(await search_products(request, query))
+    except (HTTPException, httpx.HTTPError) as exc:
+        if isinstance(exc, HTTPException) and exc.status_code < 500:
+            raise
+        body = local_product_search(query)
+        if not body["products"]:
+            raise
+        return JSONResponse(body)
+
+
+# ----------------------------
+# Price history
+# ----------------------------
+
+PRICE_HISTORY = PriceHistory(DATA_DIR / "price_history")
+HISTORY_BUCKETS = {"hour": 3600, "day": 86400, "week": 7 * 86400, "month": 30 * 86400}
+
+
+@app.on_event("startup")
+async def start_price_history_writer():
+    PRICE_HISTORY.start()
+
+
+@app.on_event("shutdown")
+async def stop_price_history_writer():
+    await PRICE_HISTORY.stop()
+
+
+def _parse_time_param(value: Optional[str], name: str) -> Optional[int]:
+    """Accept epoch seconds or an ISO date/datetime; return epoch seconds."""
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    moment = parse_moment(value if "T" in value else value + "T00:00:00Z")
+    if moment is None:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}: {value}")
+    return int(moment.timestamp())
+
+
+@app.get("/api/products/{webshop_id}/price-history")
+async def api_price_history(webshop_id: int, request: Request, bucket: Optional[str] = None):
+    """Observed prices for one product, oldest first.
+
+    Query params: `from` / `to` (ISO date or epoch seconds) and `bucket`
+    (hour/day/week/month or seconds) to downsample into min/max/avg/last per bucket.
+    Prices from search results are public; prices paid on receipts are only included for
+    the logged-in account that paid them.
+    """
+    start = _parse_time_param(request.query_params.get("from"), "from")
+    end = _parse_time_param(request.query_params.get("to"), "to")
+    if bucket is not None:
+        seconds = HISTORY_BUCKETS.get(bucket) or (int(bucket) if bucket.isdigit() else 0)
+        if seconds <= 0:
+            raise HTTPException(status_code=400, detail=f"Invalid bucket: {bucket}")
+    else:
+        seconds = None
+    keys = [product_key(webshop_id)]
+    if load_tokens(request):
+        # Receipt prices are recorded per account and description; add the caller's own
+        # descriptions matched to this product.
+        account = account_key(request)
+        keys += [description_key(account, d) for d in MATCH_MEMO.descriptions_for(webshop_id, account)]
+    points = PRICE_HISTORY.query(keys, start, end, seconds)
+    return {"webshopId": webshop_id, "bucket": seconds, "points": points}
+
+
+# ----------------------------
+# Product catalog
+# ----------------------------
+
+CATALOG = ProductCatalog(DATA_DIR / "catalog.sqlite")
+# Catalog entries not seen in a search for this long are refreshed in the background (seconds).
+CATALOG_TTL = float(os.environ.get("AH_CATALOG_TTL", str(24 * 3600)))
+CATALOG_SEARCH_MAX = 100
+# In-flight background refreshes in this worker; the refresh lease is shared by all workers.
+_PRODUCTS_REFRESHING: Dict[int, asyncio.Task] = {}
+
+
+def local_product_search(query: str, limit: int = 30) -> Dict:
+    """Catalog search in the shape of an upstream search response."""
+    with span("cache.catalog_search") as s:
+        entries = CATALOG.search(query, limit=limit, full=True)
+        s.set(returned=len(entries))
+    return {"products": [e["product"] for e in entries], "source": "catalog"}
+
+
+async def refresh_catalog_product(request: Request, entry: Dict) -> bool:
+    """Search upstream for a stored product's title; True when the product came back.
+
+    The API has no product detail endpoint, so a search is the only way to refresh an
+    entry. Everything else the search returns is stored as well. A product the search
+    no longer returns is marked as checked, so it isn't searched again within the ttl, but
+    keeps its `last_seen` and stays stale.
+    """
+    data = await search_products(request, entry["title"])
+    found = any(str(p.get("webshopId")) == str(entry["webshopId"]) for p in data.get("products") or [])
+    if not found:
+        CATALOG.touch(entry["webshopId"])
+    return found
+
+
+def _refresh_product_in_background(request: Request, entry: Dict) -> None:
+    webshop_id = entry["webshopId"]
+    if webshop_id in _PRODUCTS_REFRESHING:
+        return
+    lease, owner = f"catalog-refresh:{webshop_id}", new_owner()
+    if not SHARED_STATE.acquire(lease, owner, REQUEST_BUDGET + 5):
+        return
+    # The refresh outlives the request it was started from; give it a budget of its own.
+    request = detached_request(request)
+    started_by = current_span().trace_id
+
+    async def run():
+        try:
+            with TRACER.trace("catalog.background_refresh", webshop_id=webshop_id, started_by=started_by):
+                await refresh_catalog_product(request, entry)
+        except Exception:
+            pass
+        finally:
+            _PRODUCTS_REFRESHING.pop(webshop_id, None)
+            SHARED_STATE.release(lease, owner)
+    _PRODUCTS_REFRESHING[webshop_id] = asyncio.create_task(run())
+
+
+@app.get("/api/catalog/search")
+async def api_catalog_search(q: str = "", hqId: Optional[int] = None, limit: int = 20):
+    """Offline search over every product seen so far (title words, prefix match) or by hqId."""
+    limit = max(1, min(limit, CATALOG_SEARCH_MAX))
+    if hqId is not None:
+        entries = CATALOG.by_hq_id(hqId)[:limit]
+    else:
+        entries = CATALOG.search(q, limit=limit, full=True)
+    return {"query": q, "products": [e.pop("product") for e in entries], "entries": entries}
+
+
+@app.get("/api/catalog/stats")
+async def api_catalog_stats():
+    return {**CATALOG.stats(), "ttl": CATALOG_TTL, "refreshing": len(_PRODUCTS_REFRESHING)}
+
+
+@app.get("/api/products/{webshop_id}")
+async def api_product(webshop_id: int, request: Request, refresh: bool = False):
+    """One product from the local catalog.
+
+    Entries not seen in a search for AH_CATALOG_TTL are returned as they are (`stale: true`)
+    and refreshed in the background when logged in, at most once per AH_CATALOG_TTL;
+    `refresh=1` refreshes synchronously. Products never seen in a search are 404.
+    """
+    with span("cache.catalog", webshop_id=webshop_id) as s:
+        entry = CATALOG.get(webshop_id)
+        now = time.time()
+        stale = entry is not None and now - entry["lastSeen"] > CATALOG_TTL
+        due = stale and now - entry["checkedAt"] > CATALOG_TTL
+        s.set(hit=entry is not None, stale=stale)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Product not in the local catalog")
+    if (refresh or due) and load_tokens(request):
+        if refresh:
+            await refresh_catalog_product(request, entry)
+            entry = CATALOG.get(webshop_id)
+            stale = time.time() - entry["lastSeen"] > CATALOG_TTL
+        else:
+            _refresh_product_in_background(request, entry)
+    entry["stale"] = stale
+    return json_with_etag(request, entry)
+
+
+
+
+# ----------------------------
+# Stored purchase history & export
+# ----------------------------
+
+RECEIPT_STORE = ReceiptStore(DATA_DIR / "receipts.sqlite")
+EXPORT_FIELDS = ["date", "transactionId", "description", "quantity", "amount", "discount", "bonus",
+                 "webshopId", "product"]
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+# Key for signing account ids; set APPIE_SECRET_KEY to keep it out of the data directory.
+ACCOUNT_SECRET = (os.environ.get("APPIE_SECRET_KEY")
+                  or SHARED_STATE.get_or_create("secrets", "account-key", lambda: secrets.token_hex(32))).encode()
+# Account of requests authenticated only by the local dev token file (no cookies).
+LOCAL_ACCOUNT = "local"
+
+
+def _sign_account(account: str) -> str:
+    signature = hmac.new(ACCOUNT_SECRET, account.encode(), hashlib.sha256).hexdigest()
+    return f"{account}.{signature}"
+
+
+def _verify_account(value: Optional[str]) -> Optional[str]:
+    account, _, signature = (value or "").rpartition(".")
+    if account and hmac.compare_digest(_sign_account(account), value):
+        return account
+    return None
+
+
+def account_key(request: Request) -> str:
+    """The account that stored data (receipts, history, jobs) belongs to.
+
+    AH offers no user id, so the server issues a random account id, signed, in the
+    ACCOUNT_COOKIE the first time a browser needs one (see `issue_account_cookie`).
+    Clients can't choose or guess another user's id; the device id they can set is only
+    sent upstream.
+    """
+    account = getattr(request.state, "account", None)
+    if account:
+        return account
+    account = _verify_account(request.cookies.get(ACCOUNT_COOKIE))
+    if account is None:
+        if "ah_tokens" not in request.cookies and TOKENS_PATH.exists():
+            account = LOCAL_ACCOUNT
+        else:
+            account = f"acct-{secrets.token_hex(16)}"
+            request.state.account_issued = True
+    request.state.account = account
+    return account
+
+
+def _set_account_cookie(response: Response, account: str) -> None:
+    response.set_cookie(key=ACCOUNT_COOKIE, value=_sign_account(account), max_age=60*60*24*365,
+                        httponly=True, secure=True, samesite="lax")
+
+
+@app.middleware("http")
+async def issue_account_cookie(request: Request, call_next):
+    response = await call_next(request)
+    if getattr(request.state, "account_issued", False):
+        _set_account_cookie(response, request.state.account)
+    return response
+
+
+def _iso_range(request: Request):
+    """`from`/`to` query params as ISO bounds for the store; a bare `to` date is inclusive."""
+    start = _parse_time_param(request.query_params.get("from"), "from")
+    end_param = request.query_params.get("to")
+    end = _parse_time_param(end_param, "to")
+    if end is not None and end_param and len(end_param) == 10:
+        end += 86400
+
+    def iso(ts):
+        return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(ts)) if ts is not None else None
+    return iso(start), iso(end)
+
+
+def _export_rows(lines, product_for=None):
+    for line in lines:
+        match = product_for(line["description"]) if product_for else None
+        yield {
+            "date": line["moment"],
+            "transactionId": line["transaction_id"],
+            "description": line["description"],
+            "quantity": line["quantity"],
+            "amount": round((line["amount_cents"] - line["discount_cents"]) / 100, 2),
+            "discount": round(line["discount_cents"] / 100, 2),
+            "bonus": bool(line["bonus"]),
+            "webshopId": match.get("webshopId") if match else None,
+            "product": match.get("title") if match else None,
+        }
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return f"{value:.2f}"
+    return value
+
+
+def _export_chunks(rows, fmt: str, compress: bool):
+    """Serialize rows into ~64 KB chunks, gzip-compressing on the fly when asked."""
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31 -> gzip container
+    buf = io.StringIO()
+    writer = csv.writer(buf) if fmt == "csv" else None
+    if writer:
+        writer.writerow(EXPORT_FIELDS)
+
+    def take() -> bytes:
+        data = buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+        return compressor.compress(data) if compressor else data
+
+    for row in rows:
+        if writer:
+            writer.writerow([_csv_value(row[f]) for f in EXPORT_FIELDS])
+        else:
+            buf.write(json.dumps(row, ensure_ascii=False) + "\n")
+        if buf.tell() >= EXPORT_CHUNK_SIZE:
+            chunk = take()
+            if chunk:
+                yield chunk
+    tail = take()
+    if compressor:
+        tail += compressor.flush()
+    if tail:
+        yield tail
+
+
+@app.get("/api/export")
+async def api_export(request: Request, format: str = "csv", gzip: bool = False):
+    """Stream every stored receipt line as CSV or NDJSON.
+
+    Reads the local history in batches, so memory use stays flat however long it is.
+    Optional `from` / `to` (ISO date or epoch seconds) and `gzip=1`.
+    """
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be csv or ndjson")
+    if not load_tokens(request):
+        raise HTTPException(status_code=401, detail="Not logged in (no tokens)")
+    start, end = _iso_range(request)
+    account = account_key(request)
+    lines = RECEIPT_STORE.iter_lines(account, start, end)
+    filename = f"ah-purchases.{format}" + (".gz" if gzip else "")
+    media_type = "application/gzip" if gzip else ("text/csv" if format == "csv" else "application/x-ndjson")
+    return StreamingResponse(
+        # Descriptions repeat across receipts; resolve each one against the memo once per export.
+        _export_chunks(_export_rows(lines, functools.lru_cache(maxsize=4096)(functools.partial(MATCH_MEMO.peek, account=account))), format, gzip),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+# ----------------------------
+# Purchase history search
+# ----------------------------
+
+HISTORY_INDEX = HistoryIndex(RECEIPT_STORE)
+# account -> version of the stored lines this worker's in-memory indexes reflect.
+_LINES_SEEN: Dict[str, int] = {}
+
+
+def lines_stored(account: str) -> None:
+    """Bump the shared lines version after this worker stored (and indexed) a receipt."""
+    version = SHARED_STATE.incr("lines-version", account)
+    if version != _LINES_SEEN.get(account, 0) + 1:
+        # Another worker stored receipts since; rebuild from the store on next use.
+        _forget_line_caches(account)
+    _LINES_SEEN[account] = version
+
+
+def sync_line_caches(account: str) -> None:
+    """Drop this worker's indexes for `account` if another worker stored receipts since."""
+    version = SHARED_STATE.get("lines-version", account, 0)
+    if version != _LINES_SEEN.get(account, 0):
+        _forget_line_caches(account)
+        _LINES_SEEN[account] = version
+
+
+def _forget_line_caches(account: str) -> None:
+    HISTORY_INDEX.forget(account)
+    SUGGESTIONS.forget(account)
+
+
+@app.get("/api/history/search")
+async def api_history_search(request: Request, q: str, limit: int = 20):
+    """Find stored receipt lines by description ("when did I last buy X").
+
+    Matches whole words, prefixes ("halfv" -> HALFVOLLE) and near-misses by trigram
+    similarity ("yogurt" -> YOGHURT); every query word must match. Each result lists the
+    purchases of one description, newest first.
+    """
+    if not load_tokens(request):
+        raise HTTPException(status_code=401, detail="Not logged in (no tokens)")
+    account = account_key(request)
+    sync_line_caches(account)
+    # The first search reads the whole stored history; keep that off the event loop.
+    await asyncio.to_thread(HISTORY_INDEX.build, account)
+    results = HISTORY_INDEX.search(account, q, limit=max(1, min(limit, 100)))
+    return {"query": q, "results": results, "index": HISTORY_INDEX.stats(account)}
+
+
+# ----------------------------
+# Purchase suggestions
+# ----------------------------
+
+SUGGESTIONS = SuggestionModel(RECEIPT_STORE, alpha=float(os.environ.get("AH_SUGGEST_ALPHA", "0.3")))
+
+
+@app.get("/api/suggestions")
+async def api_suggestions(request: Request, days: int = 3, limit: int = 20):
+    """Products this account is due to buy within `days` days, most overdue first.
+
+    Each product's typical interval between purchases is a recency-weighted average over
+    the stored receipts; `dueInDays` is negative when it is overdue. Only receipts whose
+    details are stored count, so run a backfill job ("Sync full history") first.
+    """
+    if not load_tokens(request):
+        raise HTTPException(status_code=401, detail="Not logged in (no tokens)")
+    account = account_key(request)
+    sync_line_caches(account)
+    await asyncio.to_thread(SUGGESTIONS.build, account)
+    with span("cache.suggestions") as s:
+        s.set(hit=SUGGESTIONS.cached(account))
+        results = SUGGESTIONS.suggestions(account, horizon=max(0, days), limit=max(1, min(limit, 100)))
+    return {"suggestions": results, "model": SUGGESTIONS.stats(account)}
+
+
+# ----------------------------
+# Receipt line -> product match memo
+# ----------------------------
+
+MATCH_MEMO = MatchMemo(
+    DATA_DIR / "match_memo.sqlite",
+    min_margin=float(os.environ.get("AH_MEMO_MIN_MARGIN", "20")),
+    max_drift=float(os.environ.get("AH_MEMO_MAX_DRIFT", "0.15")),
+)
+
+
+def _price_cents(value) -> Optional[int]:
+    try:
+        return int(round(float(value) * 100)) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+@app.post("/api/matches/lookup")
+async def api_matches_lookup(request: Request):
+    """Resolve receipt lines against the memo in one call.
+
+    Body: {"lines": [{"description": "AH HALFVOLLE MELK", "price": 1.19}, ...]} where price is
+    the receipt unit price. Confident hits carry the remembered product; misses carry a reason.
+    """
+    try:
+        payload = await request.json()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    lines = [
+        {"description": str(line.get("description") or ""), "price_cents": _price_cents(line.get("price"))}
+        for line in (payload or {}).get("lines") or [] if isinstance(line, dict)
+    ]
+    with span("cache.match_memo", lines=len(lines)) as s:
+        results = MATCH_MEMO.lookup(lines, account_key(request))
+        s.set(hits=sum(1 for r in results if r.get("hit")))
+    return {"results": results}
+
+
+@app.post("/api/matches")
+async def api_matches_record(request: Request):
+    """Report the product the frontend chose for a receipt description.
+
+    Body: description, price (receipt unit price), webshopId (the frontend's pick). The memo is
+    shared by all accounts, so the client's pick and scores are never stored: the server
+    searches and scores the line itself and remembers its own result. `agreed` tells whether
+    both picked the same product.
+    """
+    if not load_tokens(request):
+        raise HTTPException(status_code=401, detail="Not logged in (no tokens)")
+    try:
+        payload = await request.json()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="Expected a JSON object")
+    description = payload.get("description")
+    if not isinstance(description, str) or not description.strip():
+        raise HTTPException(status_code=400, detail="description is required")
+    price_cents = _price_cents(payload.get("price"))
+    try:
+        webshop_id = None if payload.get("webshopId") is None else int(payload["webshopId"])
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="webshopId must be an integer")
+    if price_cents is None or price_cents <= 0:
+        raise HTTPException(status_code=400, detail="price must be a positive number")
+    with span("matcher.rescore"):
+        matched = await match_description(request, {"description": description, "quantity": 1,
+                                                    "amount_cents": price_cents})
+    if matched is None:
+        return {"status": "no_match", "agreed": False}
+    product, score, margin = matched
+    return {
+        "status": "ok",
+        "match": {"webshopId": int(product["webshopId"]), "score": score, "margin": margin},
+        "agreed": webshop_id == int(product["webshopId"]),
+    }
+
+
+@app.delete("/api/matches")
+async def api_matches_forget(description: str, request: Request):
+    # The user rejected the remembered product; their next enrichment searches again.
+    if not load_tokens(request):
+        raise HTTPException(status_code=401, detail="Not logged in (no tokens)")
+    return {"status": "ok", "removed": MATCH_MEMO.forget(description, account_key(request))}
+
+
+@app.get("/api/matches/stats")
+async def api_matches_stats():
+    return MATCH_MEMO.metrics()
+
+
+async def match_description(request: Request, line: Dict):
+    """Search products for a stored receipt line and pick the best with the batch matcher.
+
+    The choice is remembered in the memo. Returns (product, score, margin) or None when
+    the search found nothing.
+    """
+    description = line["description"]
+    data = await search_products(request, search_query(description))
+    candidates = [p for p in data.get("products") or [] if p.get("title") and p.get("webshopId") is not None]
+    if not candidates:
+        return None
+    ranked = BatchMatcher(candidates).rank([{
+        "description": description,
+        "quantity": str(line["quantity"]),
+        "amount": f"{line['amount_cents'] / 100:.2f}",
+    }], top=2)[0]
+    best = ranked[0]
+    margin = best["score"] - (ranked[1]["score"] if len(ranked) > 1 else 0)
+    product = best["product"]
+    MATCH_MEMO.record(description, int(product["webshopId"]), title=product.get("title"),
+                      score=best["score"], margin=margin,
+                      price_cents=int(round(line["amount_cents"] / line["quantity"])), product=product)
+    return product, best["score"], margin
+
+
+# ----------------------------
+# Background jobs
+# ----------------------------
+
+JOBS = JobQueue(
+    DATA_DIR / "jobs.sqlite",
+    concurrency=int(os.environ.get("AH_JOB_WORKERS", "2")),
+    max_attempts=int(os.environ.get("AH_JOB_MAX_ATTEMPTS", "4")),
+)
+# Upstream calls one job keeps in flight (the rate limiter still applies on top).
+JOB_FANOUT = int(os.environ.get("AH_JOB_FANOUT", "4"))
+# Cookies a job needs to act on behalf of the user who submitted it.
+JOB_COOKIES = ("ah_tokens", DEVICE_ID_COOKIE)
+
+
+def job_request(job: Job) -> Request:
+    """A synthetic request carrying the submitter's cookies, so jobs can reuse ah_get.
+
+    Each call gets a fresh request and with it a fresh latency budget.
+    """
+    cookies = job.context.get("cookies") or {}
+    header = "; ".join(f"{name}={value}" for name, value in cookies.items())
+    return Request({
+        "type": "http",
+        "method": "GET",
+        "path": f"/jobs/{job.id}",
+        "headers": [(b"cookie", header.encode("latin-1"))] if header else [],
+        "query_string": b"",
+        "state": {"account": job.account},
+    })
+
+
+async def _fan_out(items, fn, job: Job, total: Optional[int] = None):
+    """Run fn over items with at most JOB_FANOUT at a time, reporting progress as they finish."""
+    semaphore = asyncio.Semaphore(JOB_FANOUT)
+    done = 0
+    total = len(items) if total is None else total
+
+    async def one(item):
+        nonlocal done
+        async with semaphore:
+            try:
+                return await fn(item)
+            finally:
+                done += 1
+                job.progress(done, total)
+    return await asyncio.gather(*(one(item) for item in items), return_exceptions=True)
+
+
+async def run_backfill_job(job: Job):
+    """Fetch every receipt detail that isn't stored yet (params: limit)."""
+    if job.params.get("refresh", True):
+        resp, _ = await fetch_receipts_list(job_request(job))
+        if resp.status_code != 200:
+            raise RuntimeError(f"Receipts list fetch failed: {resp.status_code}")
+    missing = RECEIPT_STORE.missing_details(job.account)
+    if job.params.get("limit"):
+        missing = missing[:int(job.params["limit"])]
+    job.progress(0, len(missing))
+    outcomes = await _fan_out(missing, lambda txid: fetch_receipt_detail(job_request(job), txid), job)
+    failed = [{"transactionId": txid, "error": str(getattr(o, "detail", None) or o)}
+              for txid, o in zip(missing, outcomes) if isinstance(o, Exception)]
+    if missing and len(failed) == len(missing):
+        # Nothing got through (e.g. upstream down); let the queue retry later.
+        raise RuntimeError(failed[0]["error"])
+    return {
+        "fetched": len(missing) - len(failed),
+        "failed": failed,
+        "remaining": len(RECEIPT_STORE.missing_details(job.account)),
+    }
+
+
+async def run_enrich_job(job: Job):
+    """Match stored receipt lines to products and remember them in the match memo.
+
+    params: transactionId (one receipt; default all stored lines), limit (distinct
+    descriptions, default 200), force (re-match descriptions the memo already knows).
+    """
+    transaction_id = job.params.get("transactionId")
+    if transaction_id:
+        detail = RECEIPT_STORE.get_detail(job.account, transaction_id) or \
+            await fetch_receipt_detail(job_request(job), transaction_id)
+        lines = parse_receipt_lines(detail)
+    else:
+        lines = RECEIPT_STORE.iter_lines(job.account)
+    pending: Dict[str, Dict] = {}
+    for line in lines:
+        description = line["description"]
+        query = search_query(description)
+        if description in pending or len(query) < 3 or re.search(r"pinnen|statiegeld", query, re.I):
+            continue
+        if not job.params.get("force") and MATCH_MEMO.peek(description, job.account):
+            continue
+        pending[description] = line
+    descriptions = list(pending)[:int(job.params.get("limit") or 200)]
+    job.progress(0, len(descriptions))
+
+    async def match(description: str):
+        found = await match_description(job_request(job), pending[description])
+        if found is None:
+            return None
+        product, score, margin = found
+        return {"description": description, "webshopId": product["webshopId"], "title": product.get("title"),
+                "score": score, "margin": margin}
+
+    outcomes = await _fan_out(descriptions, match, job)
+    matches = [o for o in outcomes if isinstance(o, dict)]
+    failed = [{"description": d, "error": str(getattr(o, "detail", None) or o)}
+              for d, o in zip(descriptions, outcomes) if isinstance(o, Exception)]
+    if descriptions and len(failed) == len(descriptions):
+        raise RuntimeError(failed[0]["error"])
+    return {"matched": len(matches), "unmatched": len(descriptions) - len(matches) - len(failed),
+            "failed": failed, "matches": matches}
+
+
+def traced_job(handler):
+    """Run each attempt of a job under a trace of its own."""
+    @functools.wraps(handler)
+    async def run(job: Job):
+        with TRACER.trace(f"job {job.kind}", job_id=job.id, attempt=job.attempt):
+            return await handler(job)
+    return run
+
+
+JOBS.register("backfill", traced_job(run_backfill_job))
+JOBS.register("enrich", traced_job(run_enrich_job))
+
+
+@app.on_event("startup")
+async def start_job_workers():
+    JOBS.start()
+
+
+@app.on_event("startup")
+async def purge_shared_state():
+    SHARED_STATE.purge()
+
+
+@app.on_event("shutdown")
+async def stop_job_workers():
+    await JOBS.stop()
+
+
+@app.post("/api/jobs")
+async def api_jobs_submit(request: Request):
+    """Queue a background job and return it straight away (202).
+
+    Body: {"kind": "backfill" | "enrich", "params": {...}, "idempotencyKey": "..."}; the key
+    may also be sent as an Idempotency-Key header. Resubmitting a key returns the first job,
+    unless it failed.
+    """
+    if not load_tokens(request):
+        raise HTTPException(status_code=401, detail="Not logged in (no tokens)")
+    try:
+        payload = await request.json()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    payload = payload or {}
+    idempotency_key = request.headers.get("idempotency-key") or payload.get("idempotencyKey")
+    cookies = {name: request.cookies[name] for name in JOB_COOKIES if name in request.cookies}
+    if DEVICE_ID_COOKIE not in cookies:
+        cookies[DEVICE_ID_COOKIE] = _determine_device_id(request)
+    try:
+        job = JOBS.submit(str(payload.get("kind")), account_key(request), params=payload.get("params") or {},
+                          context={"cookies": cookies}, idempotency_key=idempotency_key)
+    except UnknownJobKind:
+        raise HTTPException(status_code=400, detail=f"Unknown job kind; expected one of {JOBS.kinds}")
+    return JSONResponse(job, status_code=202, headers={"Location": f"/api/jobs/{job['id']}"})
+
+
+@app.get("/api/jobs")
+async def api_jobs_list(request: Request):
+    return {"jobs": JOBS.list(account_key(request)), "kinds": JOBS.kinds}
+
+
+def _job_or_404(request: Request, job_id: str) -> Dict:
+    job = JOBS.get(job_id, account_key(request))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/api/jobs/{job_id}")
+async def api_job_status(job_id: str, request: Request):
+    return _job_or_404(request, job_id)
+
+
+@app.get("/api/jobs/{job_id}/result")
+async def api_job_result(job_id: str, request: Request):
+    """The job's result once it succeeded; 202 while it is still queued or running."""
+    job = _job_or_404(request, job_id)
+    if job["status"] == "failed":
+        return JSONResponse({"ok": False, "job": job}, status_code=409)
+    if job["status"] != "succeeded":
+        return JSONResponse({"ok": False, "job": job}, status_code=202)
+    return {"ok": True, "job": job, "result": JOBS.result(job_id, account_key(request))}
+
+
+@app.get("/api/jobs/{job_id}/events")
+async def api_job_events(job_id: str, request: Request):
+    """Server-sent events with the job state on every change, ending when it finishes."""
+    account = account_key(request)
+    _job_or_404(request, job_id)
+
+    async def events():
+        async for job in JOBS.watch(job_id, account):
+            event = "done" if job["status"] in ("succeeded", "failed") else "progress"
+            yield f"event: {event}\ndata: {json.dumps(job)}\n\n"
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# ----------------------------
+# Basket re-pricing
+# ----------------------------
+
+REPRICE_MAX_RECEIPTS = 50
+# Product lookups one re-pricing request keeps in flight.
+REPRICE_CONCURRENCY = int(os.environ.get("AH_REPRICE_CONCURRENCY", "4"))
+
+
+def _euros(cents: Optional[int]) -> Optional[float]:
+    return round(cents / 100, 2) if cents is not None else None
+
+
+def _price_key(line: Dict, account: str):
+    """Lookup key for a line: the remembered product when there is one, else the description."""
+    memo = MATCH_MEMO.peek(line["description"], account)
+    if memo and memo.get("webshopId") is not None:
+        return ("product", int(memo["webshopId"])), memo
+    return ("description", memo_key(line["description"])), None
+
+
+async def _lookup_current_product(request: Request, line: Dict, memo: Optional[Dict]):
+    """Today's product for a receipt line: (product, how it was matched) or (None, None)."""
+    if memo is not None:
+        data = await search_products(request, memo.get("title") or search_query(line["description"]))
+        for product in data.get("products") or []:
+            if product.get("webshopId") == memo["webshopId"]:
+                return product, "memo"
+    found = await match_description(request, line)
+    return (found[0], "search") if found else (None, None)
+
+
+async def _lookup_prices(request: Request, lines: list):
+    """Look up each distinct product once, concurrently; returns {key: (product, matched_by)}.
+
+    A product whose lookup fails or runs out of budget comes back as (None, "error") or
+    (None, "timeout"), so the receipts are still priced with the products that were found.
+    """
+    keys: Dict = {}
+    account = account_key(request)
+    with span("cache.match_memo", lines=len(lines)) as s:
+        for line in lines:
+            key, memo = _price_key(line, account)
+            line["_price_key"] = key
+            keys.setdefault(key, (line, memo))
+        s.set(distinct=len(keys), hits=sum(1 for key in keys if key[0] == "product"))
+    semaphore = asyncio.Semaphore(REPRICE_CONCURRENCY)
+
+    async def lookup(key):
+        line, memo = keys[key]
+        async with semaphore:
+            try:
+                return key, await _lookup_current_product(request, line, memo)
+            except RateLimitExceeded:
+                return key, (None, "timeout")
+            except HTTPException as exc:
+                if exc.status_code == 401:
+                    raise
+                return key, (None, "timeout" if exc.status_code == 504 else "error")
+    return dict(await asyncio.gather(*(lookup(key) for key in keys)))
+
+
+def _reprice_receipt(transaction_id: str, detail: Dict, lines: list, prices: Dict,
+                     summary: Optional[Dict]) -> Dict:
+    priced = {"original": 0, "today": 0, "today_regular": 0}
+    out_lines = []
+    for line in lines:
+        product, matched_by = prices.get(line["_price_key"], (None, None))
+        paid = line["amount_cents"] - line["discount_cents"]
+        entry = {
+            "description": line["description"],
+            "quantity": line["quantity"],
+            "paid": _euros(paid),
+            "discount": _euros(line["discount_cents"]),
+            "bonus": line["bonus"],
+            "matchedBy": matched_by,
+            "product": None,
+            "today": None,
+            "difference": None,
+            "bonusToday": None,
+        }
+        current = _price_cents(product.get("currentPrice")) if product else None
+        regular = _price_cents(product.get("priceBeforeBonus")) if product else None
+        unit = current if current is not None else regular
+        if product:
+            entry["product"] = {"webshopId": product.get("webshopId"), "title": product.get("title"),
+                                "currentPrice": product.get("currentPrice"),
+                                "priceBeforeBonus": product.get("priceBeforeBonus")}
+        if unit is not None:
+            today = unit * line["quantity"]
+            today_regular = (regular if regular is not None else unit) * line["quantity"]
+            entry.update(today=_euros(today), difference=_euros(today - paid),
+                         bonusToday=_euros(max(0, today_regular - today)))
+            priced["original"] += paid
+            priced["today"] += today
+            priced["today_regular"] += today_regular
+        out_lines.append(entry)
+
+    line_discounts = sum(line["discount_cents"] for line in lines)
+    total_discount = _price_cents(((summary or {}).get("totalDiscount") or {}).get("amount"))
+    original_discount = total_discount if total_discount is not None else line_discounts
+    today_bonus = max(0, priced["today_regular"] - priced["today"])
+    priced_count = sum(1 for entry in out_lines if entry["today"] is not None)
+    return {
+        "transactionId": transaction_id,
+        "transactionMoment": detail.get("transactionMoment"),
+        "lines": out_lines,
+        "totals": {
+            "original": _euros(sum(line["amount_cents"] - line["discount_cents"] for line in lines)),
+            "originalPriced": _euros(priced["original"]),
+            "today": _euros(priced["today"]),
+            "difference": _euros(priced["today"] - priced["original"]),
+            "originalBonusSavings": _euros(original_discount),
+            "todayBonusSavings": _euros(today_bonus),
+            "bonusSavingsDifference": _euros(today_bonus - original_discount),
+            "pricedLines": priced_count,
+            "unpricedLines": len(out_lines) - priced_count,
+        },
+    }
+
+
+async def reprice_receipts(request: Request, transaction_ids: list) -> Dict:
+    account = account_key(request)
+    receipts, unavailable = [], []
+    for transaction_id in transaction_ids:
+        with span("cache.receipt_detail", transaction_id=transaction_id) as s:
+            detail = RECEIPT_STORE.get_detail(account, transaction_id)
+            s.set(hit=detail is not None)
+        if detail is None:
+            try:
+                detail = await fetch_receipt_detail(request, transaction_id)
+            except HTTPException as exc:
+                # In a batch, receipts that can't be fetched within the budget are skipped.
+                if exc.status_code != 504 or len(transaction_ids) == 1:
+                    raise
+                unavailable.append(transaction_id)
+                continue
+        receipts.append((transaction_id, detail, parse_receipt_lines(detail)))
+    all_lines = [line for _txid, _detail, lines in receipts for line in lines]
+    # One shared lookup set: a product bought on several receipts is looked up once.
+    prices = await _lookup_prices(request, all_lines)
+    results = [
+        _reprice_receipt(txid, detail, lines, prices, RECEIPT_STORE.get_summary(account, txid))
+        for txid, detail, lines in receipts
+    ]
+    return {
+        "receipts": results,
+        "unavailable": unavailable,
+        "lookups": {
+            "lines": len(all_lines),
+            "distinct": len(prices),
+            "failed": sum(1 for _product, how in prices.values() if how == "error"),
+            "timedOut": sum(1 for _product, how in prices.values() if how == "timeout"),
+        },
+    }
+
+
+@app.get("/api/receipts/{transaction_id}/reprice")
+async def api_receipt_reprice(transaction_id: str, request: Request):
+    """Price a past receipt's products at today's prices, line by line and in total.
+
+    Each distinct product is looked up once (by its remembered match, else by description).
+    Bonus savings today are compared with the receipt's original totalDiscount.
+    """
+    result = await reprice_receipts(request, [transaction_id])
+    return {**result["receipts"][0], "lookups": result["lookups"]}
+
+
+@app.post("/api/receipts/reprice")
+async def api_receipts_reprice(request: Request):
+    """Re-price several receipts with one shared, deduplicated set of product lookups.
+
+    Body: {"transactionIds": ["...", ...]} (at most 50).
+    """
+    try:
+        payload = await request.json()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    transaction_ids = [str(t) for t in (payload or {}).get("transactionIds") or []]
+    if not transaction_ids:
+        raise HTTPException(status_code=400, detail="transactionIds is required")
+    if len(transaction_ids) > REPRICE_MAX_RECEIPTS:
+        raise HTTPException(status_code=400, detail=f"At most {REPRICE_MAX_RECEIPTS} receipts per request")
+    result = await reprice_receipts(request, list(dict.fromkeys(transaction_ids)))
+    receipts = result["receipts"]
+    result["totals"] = {
+        name: _euros(sum(int(round((r["totals"][name] or 0) * 100)) for r in receipts))
+        for name in ("original", "originalPriced", "today", "difference", "originalBonusSavings",
+                     "todayBonusSavings", "bonusSavingsDifference")
+    }
+    return result
 
 
 # Root route: serve index.html if present, otherwise a simple health message.
@@ -676,27 +2187,59 @@ async def api_debug_headers(request: Request):
         pass
     device_id = request.cookies.get(DEVICE_ID_COOKIE) or _determine_device_id(request)
     headers = {
-        "User-Agent": f"{AH_USER_AGENT} (Android; 14; Sandbox)",
-        "Authorization": f"Bearer {access_token or '…'}",
-        "Accept": "application/json",
-        "Accept-Language": "nl-NL,nl;q=0.8,en-US;q=0.6,en;q=0.4",
-        "Accept-Encoding": "gzip, deflate",
-        "X-App-Version": AH_USER_AGENT.split("/")[-1],
-        "X-App-Build": AH_USER_AGENT.split("/")[-1].replace(".", ""),
-        "X-App-Name": "ah",
-        "X-Channel": "mobile",
-        "X-Client-Id": AH_CLIENT_ID,
-        "X-Device-Platform": "android",
-        "X-Device-Type": "phone",
-        "X-OS-Version": "14",
-        "X-Device-Id": device_id,
-        "X-Device-Model": "Pixel 7 Sandbox",
-        "X-Network-Type": "wifi",
-        "X-Platform": "android",
+        **_upstream_headers(access_token or '…', device_id),
         "X-Correlation-ID": str(uuid.uuid4()),
     }
     return {"headers": headers}
 
+@app.get("/api/debug/ratelimit")
+async def api_debug_ratelimit():
+    # Upstream limiter counters and queue wait percentiles.
+    return UPSTREAM_GOVERNOR.metrics()
+
+@app.get("/api/debug/latency")
+async def api_debug_latency():
+    # Observed upstream latencies per path plus hedging counters.
+    paths = {}
+    for path, samples in _LATENCY_SAMPLES.items():
+        paths[path] = {
+            "samples": len(samples),
+            "p50_ms": int(latency_percentile(path, 0.50) * 1000),
+            "p95_ms": int(latency_percentile(path, 0.95) * 1000),
+            "hedge_delay_ms": int(_hedge_delay(path) * 1000) if _hedge_delay(path) is not None else None,
+        }
+    return {
+        "request_budget_s": REQUEST_BUDGET,
+        "attempt_timeout_s": ATTEMPT_TIMEOUT,
+        "hedging": {"enabled": HEDGE_ENABLED, **HEDGE_STATS},
+        "paths": paths,
+    }
+
+# Traces show request paths and receipt ids, so they are only served when explicitly enabled.
+DEBUG_TRACES = os.environ.get("APPIE_DEBUG_TRACES", "0") in ("1", "true", "yes")
+
+
+def _require_debug_traces() -> None:
+    if not DEBUG_TRACES:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+
+@app.get("/api/debug/traces")
+async def api_debug_traces(limit: int = 20, name: Optional[str] = None, min_ms: float = 0):
+    # Most recent finished traces, newest first; e.g. ?name=/api/receipts&min_ms=1000 for slow list calls.
+    _require_debug_traces()
+    traces = TRACER.recent(max(1, min(limit, 200)), name, min_ms)
+    return {"enabled": TRACER.enabled, "file": str(TRACER.path) if TRACER.path else None, "traces": traces}
+
+@app.get("/api/debug/traces/{trace_id}")
+async def api_debug_trace(trace_id: str):
+    # One trace with its spans nested under their parents.
+    _require_debug_traces()
+    record = TRACER.get(trace_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Unknown trace (it may have left the ring buffer)")
+    return {**record, "spans": span_tree(record)}
+
 
 # Optional: mount static files (CSS/JS/images) if you want direct access without the root handler.
 # Commented out for now to avoid shadowing API routes.
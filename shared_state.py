@@ -0,0 +1,257 @@
+"""State shared between server processes (`uvicorn server:app --workers N`).
+
+Everything lives in one SQLite database in WAL mode, so each write is a transaction that
+either lands completely or not at all, even when a worker is killed in the middle of it.
+It holds:
+
+- entries: JSON values per (namespace, key), optionally expiring (tokens, device ids,
+  cache entries, counters, rate-limit token buckets);
+- leases: named cross-process locks with an expiry, so a lock held by a crashed worker
+  frees itself after its ttl instead of blocking everyone.
+
+`single_flight` combines the two: of all processes asking for the same missing value at
+once, one computes it under a lease and the others wait for the stored result (used for
+token refresh, so N workers holding the same expired token refresh it once).
+
+Files that must stay readable on their own (the dev token file) are written with
+`atomic_write_text`: a temporary file in the same directory, fsynced, then renamed over
+the target, so readers see the old or the new content and never a torn write.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, closing
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Optional, Union
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+class LeaseTimeout(Exception):
+    """Raised when a lease (or the result of whoever holds it) doesn't arrive in time."""
+
+
+def atomic_write_text(path: Union[str, Path], text: str) -> None:
+    """Replace `path` with `text` in one rename; a crash leaves the old file intact."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=f".{path.name}.", dir=str(path.parent))
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def new_owner() -> str:
+    return f"{os.getpid()}:{uuid.uuid4().hex[:12]}"
+
+
+class SharedState:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._local = threading.local()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path), timeout=10, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _thread_connection(self) -> sqlite3.Connection:
+        """This thread's own long-lived connection, for calls made often from worker threads."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    # -- entries ----------------------------------------------------------
+
+    def get(self, namespace: str, key: str, default: Any = None) -> Any:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT value, expires_at FROM entries WHERE namespace = ? AND key = ?",
+                               (namespace, key)).fetchone()
+        if row is None or (row["expires_at"] is not None and row["expires_at"] <= time.time()):
+            return default
+        return json.loads(row["value"])
+
+    def put(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (namespace, key, value, expires_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (namespace, key, json.dumps(value), now + ttl if ttl is not None else None, now))
+
+    def delete(self, namespace: str, key: str) -> None:
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def get_or_create(self, namespace: str, key: str, factory: Callable[[], Any]) -> Any:
+        """The stored value, or `factory()` stored atomically; every process gets the same one."""
+        value = self.get(namespace, key)
+        if value is not None:
+            return value
+        candidate = json.dumps(factory())
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM entries WHERE namespace = ? AND key = ? AND expires_at <= ?",
+                             (namespace, key, now))
+                conn.execute("INSERT OR IGNORE INTO entries (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)",
+                             (namespace, key, candidate, now))
+                row = conn.execute("SELECT value FROM entries WHERE namespace = ? AND key = ?",
+                                   (namespace, key)).fetchone()
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return json.loads(row["value"])
+
+    def incr(self, namespace: str, key: str, amount: int = 1) -> int:
+        """Atomically add to an integer entry (missing counts as 0); returns the new value."""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT value FROM entries WHERE namespace = ? AND key = ?",
+                                   (namespace, key)).fetchone()
+                value = (json.loads(row["value"]) if row else 0) + amount
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (namespace, key, value, expires_at, updated_at)"
+                    " VALUES (?, ?, ?, NULL, ?)", (namespace, key, json.dumps(value), now))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return value
+
+    def take_token(self, name: str, rate: float, burst: float) -> float:
+        """Take one token from the shared bucket `name`; 0 when taken, else seconds until one is due.
+
+        Blocks on the database lock, so call it from a worker thread (`SharedTokenBucket` does).
+        """
+        conn = self._thread_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        try:
+            row = conn.execute("SELECT value FROM entries WHERE namespace = 'token-buckets' AND key = ?",
+                               (name,)).fetchone()
+            tokens, updated = json.loads(row["value"]) if row else (burst, now)
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (namespace, key, value, expires_at, updated_at)"
+                " VALUES ('token-buckets', ?, ?, NULL, ?)", (name, json.dumps([tokens, now]), now))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def purge(self) -> int:
+        """Drop expired entries and leases; returns how many entries went."""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            removed = conn.execute("DELETE FROM entries WHERE expires_at <= ?", (now,)).rowcount
+            conn.execute("DELETE FROM leases WHERE expires_at <= ?", (now,))
+        return removed
+
+    # -- leases -----------------------------------------------------------
+
+    def acquire(self, name: str, owner: str, ttl: float) -> bool:
+        """Take (or extend) the lease `name` for `ttl` seconds unless someone else holds it."""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)"
+                " ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at"
+                " WHERE leases.owner = excluded.owner OR leases.expires_at <= ?",
+                (name, owner, now + ttl, now))
+            return cursor.rowcount == 1
+
+    def release(self, name: str, owner: str) -> None:
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def holder(self, name: str) -> Optional[str]:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT owner FROM leases WHERE name = ? AND expires_at > ?",
+                               (name, time.time())).fetchone()
+        return row["owner"] if row else None
+
+    @asynccontextmanager
+    async def lease(self, name: str, ttl: float, wait: float = 0.0, poll: float = 0.05):
+        """Hold the lease `name` for the block; LeaseTimeout if it isn't free within `wait`."""
+        owner = new_owner()
+        deadline = time.monotonic() + wait
+        while not self.acquire(name, owner, ttl):
+            if time.monotonic() >= deadline:
+                raise LeaseTimeout(name)
+            await asyncio.sleep(poll)
+        try:
+            yield owner
+        finally:
+            self.release(name, owner)
+
+    async def single_flight(self, namespace: str, key: str, compute: Callable[[], Awaitable[Any]],
+                            ttl: Optional[float] = None, lease_ttl: float = 30.0, wait: float = 10.0,
+                            poll: float = 0.05) -> Any:
+        """The stored value for (namespace, key), computing it in at most one process at a time.
+
+        Callers that find another process computing wait for its result (up to `wait`
+        seconds, then LeaseTimeout). If that process dies, its lease expires after
+        `lease_ttl` and the next caller computes instead.
+        """
+        value = self.get(namespace, key)
+        if value is not None:
+            return value
+        name, owner = f"{namespace}:{key}", new_owner()
+        deadline = time.monotonic() + wait
+        while not self.acquire(name, owner, lease_ttl):
+            if time.monotonic() >= deadline:
+                raise LeaseTimeout(name)
+            await asyncio.sleep(poll)
+            value = self.get(namespace, key)
+            if value is not None:
+                return value
+        try:
+            # Someone may have finished between our first look and taking the lease.
+            value = self.get(namespace, key)
+            if value is None:
+                value = await compute()
+                self.put(namespace, key, value, ttl)
+            return value
+        finally:
+            self.release(name, owner)
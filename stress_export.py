@@ -0,0 +1,115 @@
+"""Concurrent stress test for /api/export.
+
+Fills a temporary receipt store with one account's history, large enough that every export
+spans many ~64 KB chunks and many ReceiptStore batches, then streams it from several
+clients at once. Starlette advances a streaming body from its threadpool, so each client's
+batches run on whichever worker thread is free. Every export must finish, return every
+line exactly once in (date, transaction id) order, and give the same bytes as the others.
+
+    python stress_export.py                                # 4 clients, 300 receipts x 60 lines
+    python stress_export.py --clients 8 --receipts 500 --format csv --gzip
+
+Runs in a temporary directory and exits non-zero when a check fails.
+"""
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+ACCOUNT = "acct-stress"
+
+
+def _receipt(n, lines):
+    day = 1 + n % 28
+    return {
+        "transactionMoment": f"2024-{1 + n // 28 % 12:02d}-{day:02d}T10:{n % 60:02d}:00Z",
+        "receiptUiItems": [
+            {"type": "product", "quantity": "1", "description": f"PRODUCT {n} {i}", "amount": "1,25", "indicator": ""}
+            for i in range(lines)
+        ] + [{"type": "subtotal"}],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--receipts", type=int, default=300)
+    parser.add_argument("--lines", type=int, default=60, help="product lines per receipt")
+    parser.add_argument("--format", choices=("ndjson", "csv"), default="ndjson")
+    parser.add_argument("--gzip", action="store_true")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="appie-export-")
+    os.environ["APPIE_DATA_DIR"] = os.path.join(workdir, "data")
+    sys.path.insert(0, REPO)
+    failures = []
+
+    def check(ok, message):
+        print(("  ok    " if ok else "  FAIL  ") + message)
+        if not ok:
+            failures.append(message)
+
+    try:
+        import server
+        from fastapi.testclient import TestClient
+
+        for n in range(args.receipts):
+            server.RECEIPT_STORE.store_detail(ACCOUNT, f"T{n:05d}", _receipt(n, args.lines))
+        expected = args.receipts * args.lines
+        tokens = json.dumps({"access_token": "a" * 30, "refresh_token": "r" * 30, "expires_in": 3600,
+                             "created_at": time.time()})
+        url = f"/api/export?format={args.format}" + ("&gzip=1" if args.gzip else "")
+        print(f"{args.clients} clients exporting {expected} lines ({args.format}{', gzip' if args.gzip else ''})")
+
+        bodies, errors = [None] * args.clients, []
+        with TestClient(server.app) as client:
+            client.cookies.set("ah_tokens", tokens)
+            client.cookies.set(server.ACCOUNT_COOKIE, server._sign_account(ACCOUNT))
+
+            def export(i):
+                try:
+                    with client.stream("GET", url) as response:
+                        if response.status_code != 200:
+                            raise RuntimeError(f"HTTP {response.status_code}")
+                        data = b"".join(response.iter_raw())
+                    bodies[i] = gzip.decompress(data) if args.gzip else data
+                except Exception as exc:
+                    errors.append(f"{type(exc).__name__}: {exc}")
+
+            threads = [threading.Thread(target=export, args=(i,)) for i in range(args.clients)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join(300)
+
+        check(not errors, f"every export finished ({len(errors)} failed) {errors[:1]}")
+        done = [b for b in bodies if b is not None]
+        if done:
+            body = done[0]
+            text = body.decode("utf-8")
+            if args.format == "csv":
+                rows = text.splitlines()[1:]
+                keys = [tuple(r.split(",")[:3]) for r in rows]
+            else:
+                rows = [json.loads(r) for r in text.splitlines()]
+                keys = [(r["date"], r["transactionId"], r["description"]) for r in rows]
+            chunks = len(body) // server.EXPORT_CHUNK_SIZE + 1
+            check(chunks > 1, f"export spans {chunks} chunks of {server.EXPORT_CHUNK_SIZE // 1024} KB")
+            check(len(rows) == expected, f"{len(rows)} lines exported (want {expected})")
+            check(len(set(keys)) == len(keys), "every line exported once")
+            check([k[:2] for k in keys] == sorted(k[:2] for k in keys), "lines in date order")
+            check(all(b == body for b in done), "all clients got the same export")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print("FAILED" if failures else "all checks passed")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+"""Multi-process stress test for the state shared between server workers.
+
+Starts a fake AH token endpoint that behaves like rotating refresh tokens (a refresh token
+works once; reusing it is an error), then runs server.py's own token code in many worker
+processes that share one APPIE_DATA_DIR, all holding the same stale cookie:
+
+1. device ids: every process asks for the shared device id at once, and all must get the same one;
+2. refresh rounds: every process fires concurrent requests with the expired cookie; each
+   round must refresh upstream exactly once (no reuse errors, no duplicate refreshes) and
+   all requests must end up with the same access token;
+3. crash: a worker is SIGKILLed while it holds the refresh lease mid-refresh; the others
+   must take over once the lease expires;
+4. torn writes: processes rewrite the dev token file in a loop while others parse it, and
+   some writers are SIGKILLed; the file must always parse;
+5. price history: processes record search prices and receipts and flush at the same time;
+   every process must agree on the key ids, and each receipt must be recorded once;
+6. global rate limit: processes take upstream slots as fast as they can; together they
+   must stay within one AH_RATE_GLOBAL bucket, not one per process, and still get at least
+   half of it.
+
+    python stress_shared_state.py                      # 8 processes x 25 requests, 3 rounds
+    python stress_shared_state.py --processes 16 --requests 50 --rounds 5
+
+Runs in a temporary directory (the real appie!/ah_tokens.json is not touched) and exits
+non-zero when a check fails.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+# Tokens from the fake endpoint stay valid for this many seconds (token_is_expired uses a 60 s skew).
+TOKEN_LIFETIME = 2
+EXPIRES_IN = 60 + TOKEN_LIFETIME
+
+
+class FakeTokenEndpoint(BaseHTTPRequestHandler):
+    lock = threading.Lock()
+    spent = set()
+    refreshes = []  # refresh tokens exchanged successfully
+    reused = []  # refresh tokens presented again after being spent
+    hang = threading.Event()  # when set, the next refresh hangs (and is not spent)
+    hanging = threading.Event()  # set once a request is hanging
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        refresh_token = body.get("refreshToken")
+        if self.hang.is_set():
+            self.hang.clear()
+            self.hanging.set()
+            time.sleep(30)
+            return
+        time.sleep(0.2)  # widen the race window
+        with self.lock:
+            if refresh_token in self.spent:
+                self.reused.append(refresh_token)
+                return self._reply(400, {"error": "invalid_grant"})
+            self.spent.add(refresh_token)
+            self.refreshes.append(refresh_token)
+        self._reply(200, {"access_token": f"a-{uuid.uuid4().hex}", "refresh_token": f"r-{uuid.uuid4().hex}",
+                          "expires_in": EXPIRES_IN})
+
+    def _reply(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+# Global upstream rate for check 6 (per-account limits are set out of the way).
+GLOBAL_RATE = 20
+GLOBAL_BURST = 5
+
+
+def _import_server(workdir, data_dir, base):
+    os.chdir(workdir)
+    os.environ["APPIE_DATA_DIR"] = data_dir
+    os.environ["AH_ATTEMPT_TIMEOUT"] = "2"  # refresh lease = attempt timeout + 5 s
+    os.environ.update(AH_RATE_GLOBAL=str(GLOBAL_RATE), AH_RATE_GLOBAL_BURST=str(GLOBAL_BURST),
+                      AH_RATE_ACCOUNT="100000", AH_RATE_ACCOUNT_BURST="100000")
+    sys.path.insert(0, REPO)
+    import server
+    server.AH_BASE = base
+    return server
+
+
+def _request(server, cookie=None):
+    from starlette.requests import Request
+    headers = [(b"cookie", f"ah_tokens={cookie}".encode("latin-1"))] if cookie else []
+    return Request({"type": "http", "method": "GET", "path": "/stress", "headers": headers, "query_string": b""})
+
+
+def refresh_worker(workdir, data_dir, base, cookie, requests, start_at, results):
+    server = _import_server(workdir, data_dir, base)
+    device_id = server._determine_device_id(_request(server))
+
+    async def one():
+        try:
+            return await server.refresh_token_if_needed(_request(server, cookie))
+        except Exception as exc:
+            return f"error: {getattr(exc, 'detail', None) or exc!r}"
+
+    async def main():
+        import asyncio
+        await asyncio.sleep(max(0.0, start_at - time.time()))
+        return await asyncio.gather(*(one() for _ in range(requests)))
+
+    import asyncio
+    results.put({"pid": os.getpid(), "device_id": device_id, "tokens": asyncio.run(main())})
+
+
+def file_worker(workdir, data_dir, base, role, seconds, results):
+    server = _import_server(workdir, data_dir, base)
+    errors, writes, reads = 0, 0, 0
+    until = time.time() + seconds
+    while time.time() < until:
+        if role == "writer":
+            server.save_tokens({"access_token": "x" * 2000, "refresh_token": uuid.uuid4().hex, "expires_in": 3600})
+            writes += 1
+        else:
+            try:
+                json.loads(server.TOKENS_PATH.read_text(encoding="utf-8"))
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                errors += 1
+            reads += 1
+    results.put({"role": role, "errors": errors, "writes": writes, "reads": reads})
+
+
+def _price(key):
+    return sum(key.encode()) % 1000 / 100
+
+
+def price_worker(workdir, data_dir, base, seed, results):
+    server = _import_server(workdir, data_dir, base)
+    history = server.PRICE_HISTORY
+
+    async def main():
+        for r in range(20):
+            ids = [(seed * 7 + r * 13 + i) % 300 for i in range(10)]
+            history.record_search([{"webshopId": i, "currentPrice": _price(f"w:{i}")} for i in ids],
+                                  ts=1000 + r * 100000 + seed)
+            history.record_receipt({"transactionMoment": "2024-05-01T10:00:00Z", "receiptUiItems": [
+                {"type": "product", "quantity": "1", "description": f"STRESS {r}", "amount": "1,00"}]}, f"T{r}", "acct-stress")
+            await history.flush()
+
+    import asyncio
+    asyncio.run(main())
+    results.put({"pid": os.getpid()})
+
+
+def rate_worker(workdir, data_dir, base, seconds, barrier, results):
+    server = _import_server(workdir, data_dir, base)
+    # Start together once every process has imported the server, however long that took.
+    barrier.wait()
+    start_at = time.time()
+
+    async def main():
+        import asyncio
+        granted, until = 0, start_at + seconds
+        while time.time() < until:
+            slot = server.UPSTREAM_GOVERNOR.try_slot(f"stress-{os.getpid()}")
+            if slot is None:
+                await asyncio.sleep(0.002)
+                continue
+            granted += 1
+            await slot.__aexit__(None, None, None)
+        return granted
+
+    import asyncio
+    results.put({"granted": asyncio.run(main())})
+
+
+def _collect(procs, results, count, timeout):
+    out = [results.get(timeout=timeout) for _ in range(count)]
+    for p in procs:
+        p.join(timeout)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=25, help="concurrent requests per process and round")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--file-seconds", type=float, default=3.0)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FakeTokenEndpoint)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{httpd.server_address[1]}"
+    workdir = tempfile.mkdtemp(prefix="appie-stress-")
+    data_dir = os.path.join(workdir, "data")
+    failures = []
+
+    def check(ok, message):
+        print(("  ok    " if ok else "  FAIL  ") + message)
+        if not ok:
+            failures.append(message)
+
+    # The stale cookie every client keeps sending: expired long ago, never updated.
+    cookie = json.dumps({"access_token": "a-0", "refresh_token": "r-0", "expires_in": 3600, "created_at": 0},
+                        separators=(",", ":"))
+    try:
+        print(f"{args.processes} processes x {args.requests} concurrent requests, {args.rounds} rounds")
+        device_ids, access_tokens = set(), []
+        for round_no in range(1, args.rounds + 1):
+            if round_no > 1:
+                time.sleep(TOKEN_LIFETIME + 0.5)  # let the previous round's tokens expire
+            results = ctx.Queue()
+            start_at = time.time() + 3  # imports finish before anyone starts
+            procs = [ctx.Process(target=refresh_worker,
+                                 args=(workdir, data_dir, base, cookie, args.requests, start_at, results))
+                     for _ in range(args.processes)]
+            for p in procs:
+                p.start()
+            out = _collect(procs, results, len(procs), 60)
+            tokens = [t for r in out for t in r["tokens"]]
+            device_ids.update(r["device_id"] for r in out)
+            errors = [t for t in tokens if t.startswith("error")]
+            check(not errors, f"round {round_no}: {len(tokens)} requests, {len(errors)} errors {errors[:1]}")
+            check(len(set(tokens)) == 1, f"round {round_no}: one access token for all requests ({len(set(tokens))})")
+            access_tokens.append(tokens[0])
+            check(len(FakeTokenEndpoint.refreshes) == round_no,
+                  f"round {round_no}: upstream refreshes so far {len(FakeTokenEndpoint.refreshes)} (want {round_no})")
+        check(len(device_ids) == 1, f"device id shared by all processes ({len(device_ids)} distinct)")
+        check(not FakeTokenEndpoint.reused, f"no refresh token reused ({len(FakeTokenEndpoint.reused)})")
+
+        print("crash while holding the refresh lease")
+        time.sleep(TOKEN_LIFETIME + 0.5)
+        FakeTokenEndpoint.hang.set()
+        results = ctx.Queue()
+        victim = ctx.Process(target=refresh_worker, args=(workdir, data_dir, base, cookie, 1, 0, results))
+        victim.start()
+        FakeTokenEndpoint.hanging.wait(30)
+        os.kill(victim.pid, signal.SIGKILL)
+        victim.join()
+        started = time.time()
+        procs = [ctx.Process(target=refresh_worker, args=(workdir, data_dir, base, cookie, 5, 0, results))
+                 for _ in range(max(2, args.processes // 2))]
+        for p in procs:
+            p.start()
+        out = _collect(procs, results, len(procs), 60)
+        tokens = [t for r in out for t in r["tokens"]]
+        errors = [t for t in tokens if t.startswith("error")]
+        check(not errors and len(set(tokens)) == 1,
+              f"others took over after {time.time() - started:.1f}s: {len(tokens)} requests, {len(errors)} errors")
+        check(len(FakeTokenEndpoint.refreshes) == args.rounds + 1 and not FakeTokenEndpoint.reused,
+              f"one refresh after the crash ({len(FakeTokenEndpoint.refreshes) - args.rounds})")
+
+        print("token file under concurrent writers, readers and kills")
+        results = ctx.Queue()
+        roles = ["writer"] * 4 + ["reader"] * 4
+        procs = [ctx.Process(target=file_worker, args=(workdir, data_dir, base, role, args.file_seconds, results))
+                 for role in roles]
+        for p in procs:
+            p.start()
+        time.sleep(2 + args.file_seconds / 2)
+        for p in procs[:2]:
+            os.kill(p.pid, signal.SIGKILL)
+        out = _collect(procs[2:], results, len(procs) - 2, 60)
+        reads = sum(r["reads"] for r in out)
+        errors = sum(r["errors"] for r in out)
+        check(errors == 0, f"{reads} reads during {sum(r['writes'] for r in out)}+ writes, {errors} torn")
+        with open(os.path.join(workdir, "appie!", "ah_tokens.json"), encoding="utf-8") as f:
+            json.load(f)
+        check(True, "token file parses after writers were killed")
+
+        print("price history recorded by many processes")
+        results = ctx.Queue()
+        procs = [ctx.Process(target=price_worker, args=(workdir, data_dir, base, seed, results))
+                 for seed in range(args.processes)]
+        for p in procs:
+            p.start()
+        _collect(procs, results, len(procs), 120)
+        sys.path.insert(0, REPO)
+        from price_history import PriceHistory, description_key
+        history = PriceHistory(os.path.join(data_dir, "price_history"))
+        keys = [k for k in history._keys if k.startswith("w:")]
+        wrong = sum(1 for k in keys for point in history.query([k]) if point["price"] != _price(k))
+        check(len(history._keys) == len(set(history._keys)), f"{len(history._keys)} key ids, all distinct")
+        check(wrong == 0, f"every observation under the right key ({wrong} wrong)")
+        check(all(len(history.query([description_key("acct-stress", f"STRESS {r}")])) == 1 for r in range(20)), "each receipt recorded once")
+
+        seconds = 3.0
+        print(f"global rate limit ({GLOBAL_RATE}/s, burst {GLOBAL_BURST}) across processes")
+        results, barrier = ctx.Queue(), ctx.Barrier(args.processes)
+        procs = [ctx.Process(target=rate_worker, args=(workdir, data_dir, base, seconds, barrier, results))
+                 for _ in range(args.processes)]
+        for p in procs:
+            p.start()
+        granted = sum(r["granted"] for r in _collect(procs, results, len(procs), 60))
+        # Each process may hold one reserved token on top of the bucket.
+        limit = GLOBAL_BURST + GLOBAL_RATE * seconds + args.processes
+        check(granted <= limit, f"{granted} upstream slots granted in {seconds:.0f}s (limit {limit:.0f})")
+        # Tokens are reserved in worker threads; the processes must still get most of the rate.
+        check(granted >= GLOBAL_RATE * seconds / 2, f"at least half the rate granted ({granted})")
+    finally:
+        httpd.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+    print("FAILED" if failures else "all checks passed")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""Purchase suggestions ("what am I due to buy") from the stored receipt lines.
+
+Per account and description, purchases are reduced to distinct purchase days and modeled
+by the interval between them: an exponentially weighted moving average (recent intervals
+count more), the weighted mean absolute deviation of that average (how regular the habit
+is) and a weighted average quantity. A product is due once the days since its last
+purchase reach its average interval; one not bought for several intervals is treated as
+no longer bought.
+
+Like the history index, an account's model is built from the ReceiptStore on first use
+(`build`, run in a worker thread by the server) and then updated by `add_lines` as receipt
+details are stored. A receipt on a new, later day updates a product's averages in constant
+time. An earlier day (backfills fetch newest first) or a second receipt on the same day
+only marks that product for a refit, which happens once when the list is next ranked, so a
+backfill of many receipts costs one refit per product rather than one per receipt. The
+ranked list is cached per account and day and dropped whenever the account's lines change,
+so a request only slices a precomputed list.
+"""
+import bisect
+import datetime
+import threading
+from typing import Dict, List, Optional, Set
+
+from receipt_lines import parse_moment
+from receipt_store import ReceiptStore
+
+# Weight of the newest interval in the moving averages.
+ALPHA = 0.3
+# Purchase days a product needs before it is suggested (two intervals).
+MIN_PURCHASES = 3
+# Not bought for this many average intervals: no longer suggested.
+LAPSE_FACTOR = 3.0
+# Intervals after which a regular habit is trusted fully.
+CONFIDENT_INTERVALS = 5
+
+
+class _Product:
+    __slots__ = ("days", "quantities", "interval", "deviation", "quantity", "stale")
+
+    def __init__(self):
+        self.days: List[int] = []  # distinct purchase days (date ordinals), ascending
+        self.quantities: List[int] = []  # quantity bought per day
+        self.interval: Optional[float] = None
+        self.deviation = 0.0
+        self.quantity = 0.0
+        self.stale = False  # averages need a refit (a day was inserted or merged)
+
+    def add(self, day: int, quantity: int, alpha: float) -> None:
+        if not self.days or day > self.days[-1]:
+            self.days.append(day)
+            self.quantities.append(quantity)
+            if not self.stale:
+                self._step(len(self.days) - 1, alpha)
+            return
+        i = bisect.bisect_left(self.days, day)
+        if i < len(self.days) and self.days[i] == day:
+            self.quantities[i] += quantity
+        else:
+            self.days.insert(i, day)
+            self.quantities.insert(i, quantity)
+        self.stale = True
+
+    def refit(self, alpha: float) -> None:
+        if not self.stale:
+            return
+        self.interval, self.deviation, self.quantity = None, 0.0, 0.0
+        for j in range(len(self.days)):
+            self._step(j, alpha)
+        self.stale = False
+
+    def _step(self, i: int, alpha: float) -> None:
+        quantity = self.quantities[i]
+        self.quantity = quantity if i == 0 else alpha * quantity + (1 - alpha) * self.quantity
+        if i == 0:
+            return
+        interval = self.days[i] - self.days[i - 1]
+        if self.interval is None:
+            self.interval = float(interval)
+            return
+        self.deviation = alpha * abs(interval - self.interval) + (1 - alpha) * self.deviation
+        self.interval = alpha * interval + (1 - alpha) * self.interval
+
+
+class _AccountModel:
+    def __init__(self):
+        self.products: Dict[str, _Product] = {}
+        self.transactions: Set[str] = set()
+
+    def add(self, line: Dict, alpha: float) -> None:
+        moment = parse_moment(line.get("moment"))
+        if moment is None:
+            return
+        product = self.products.get(line["description"])
+        if product is None:
+            product = self.products[line["description"]] = _Product()
+        product.add(moment.date().toordinal(), line["quantity"], alpha)
+
+
+class SuggestionModel:
+    def __init__(self, store: ReceiptStore, alpha: float = ALPHA, min_purchases: int = MIN_PURCHASES,
+                 lapse_factor: float = LAPSE_FACTOR):
+        self.store = store
+        self.alpha = alpha
+        self.min_purchases = min_purchases
+        self.lapse_factor = lapse_factor
+        self._accounts: Dict[str, _AccountModel] = {}
+        # account -> (day, ranked suggestions, their dueInDays for bisecting)
+        self._ranked: Dict[str, tuple] = {}
+        # account -> receipts (line lists) stored while its model is being built
+        self._backlog: Dict[str, List[List[Dict]]] = {}
+        self._lock = threading.Lock()
+        self._build_locks: Dict[str, threading.Lock] = {}
+
+    def build(self, account: str) -> None:
+        """Build the account's model from the store unless it is built already (blocking)."""
+        with self._lock:
+            if account in self._accounts:
+                return
+            build_lock = self._build_locks.setdefault(account, threading.Lock())
+        with build_lock:
+            with self._lock:
+                if account in self._accounts:
+                    return
+                backlog = self._backlog[account] = []
+            model = _AccountModel()
+            # Oldest first, so the build takes the constant-time path for every day.
+            for line in self.store.iter_lines(account):
+                model.transactions.add(line["transaction_id"])
+                model.add(line, self.alpha)
+            with self._lock:
+                if self._backlog.get(account) is not backlog:
+                    return  # forgotten while building; the next call builds again
+                del self._backlog[account]
+                for lines in backlog:
+                    self._add_receipt(model, lines)
+                self._accounts[account] = model
+                self._ranked.pop(account, None)
+
+    def _model(self, account: str) -> _AccountModel:
+        model = self._accounts.get(account)
+        while model is None:
+            self.build(account)
+            model = self._accounts.get(account)
+        return model
+
+    def _add_receipt(self, model: _AccountModel, lines: List[Dict]) -> None:
+        transaction_id = lines[0].get("transaction_id")
+        if transaction_id in model.transactions:
+            return
+        model.transactions.add(transaction_id)
+        for line in lines:
+            model.add(line, self.alpha)
+
+    def add_lines(self, account: str, lines: List[Dict]) -> None:
+        """Fold the lines of a newly stored receipt into the model (no-op until first used)."""
+        if not lines:
+            return
+        with self._lock:
+            model = self._accounts.get(account)
+            if model is None:
+                if account in self._backlog:
+                    self._backlog[account].append(lines)
+                return
+            self._add_receipt(model, lines)
+        self.invalidate(account)
+
+    def forget(self, account: str) -> None:
+        """Forget the account's model and ranking (e.g. another process stored receipts)."""
+        with self._lock:
+            self._accounts.pop(account, None)
+            self._backlog.pop(account, None)
+        self._ranked.pop(account, None)
+
+    def invalidate(self, account: str) -> None:
+        self._ranked.pop(account, None)
+
+    def cached(self, account: str, today: Optional[datetime.date] = None) -> bool:
+        entry = self._ranked.get(account)
+        return entry is not None and entry[0] == (today or datetime.date.today()).toordinal()
+
+    def suggestions(self, account: str, horizon: int = 3, limit: int = 20,
+                    today: Optional[datetime.date] = None) -> List[Dict]:
+        """Products due within `horizon` days (overdue ones first), at most `limit`."""
+        day = (today or datetime.date.today()).toordinal()
+        entry = self._ranked.get(account)
+        if entry is None or entry[0] != day:
+            entry = self._ranked[account] = self._rank(self._model(account), day)
+        _day, ranked, due_keys = entry
+        return ranked[:min(limit, bisect.bisect_right(due_keys, horizon))]
+
+    def _rank(self, model: _AccountModel, day: int) -> tuple:
+        ranked = []
+        for description, product in model.products.items():
+            if len(product.days) < self.min_purchases:
+                continue
+            product.refit(self.alpha)
+            if not product.interval:
+                continue
+            elapsed = day - product.days[-1]
+            if elapsed > self.lapse_factor * product.interval:
+                continue
+            due_in = product.interval - elapsed
+            intervals = len(product.days) - 1
+            regularity = 1 / (1 + product.deviation / product.interval)
+            ranked.append({
+                "description": description,
+                "dueInDays": round(due_in, 1) + 0.0,  # no "-0.0"
+                "dueDate": datetime.date.fromordinal(product.days[-1] + round(product.interval)).isoformat(),
+                "lastBought": datetime.date.fromordinal(product.days[-1]).isoformat(),
+                "intervalDays": round(product.interval, 1),
+                "deviationDays": round(product.deviation, 1),
+                "purchases": len(product.days),
+                "quantity": max(1, round(product.quantity)),
+                "confidence": round(regularity * min(1.0, intervals / CONFIDENT_INTERVALS), 2),
+            })
+        ranked.sort(key=lambda s: (s["dueInDays"], -s["confidence"]))
+        return day, ranked, [s["dueInDays"] for s in ranked]
+
+    def stats(self, account: str) -> Dict:
+        model = self._accounts.get(account)
+        if model is None:
+            return {"built": False}
+        return {"built": True, "products": len(model.products), "receipts": len(model.transactions),
+                "cached": self.cached(account)}
@@ -0,0 +1,207 @@
+"""Lightweight request tracing.
+
+A trace is a tree of spans: the root span covers one incoming request (or one
+background task), child spans cover the work done on its behalf, such as token refresh,
+each upstream attempt, backoff sleeps, fallbacks and cache lookups. The current span lives
+in a contextvar, so `with span(...)` nests correctly across awaits and inside tasks
+created from the request.
+
+Finished traces go to an in-memory ring buffer (for /api/debug/traces) and, when a file
+path is configured, are appended to it as JSON lines.
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# Spans kept per trace; long-running traces (e.g. a backfill job) stop recording beyond this.
+MAX_SPANS_PER_TRACE = 1000
+
+_current: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "start", "started", "duration_ms",
+                 "attributes", "status", "_token")
+
+    def __init__(self, trace: "_Trace", name: str, parent: Optional["Span"], attributes: Dict):
+        self.trace = trace
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.duration_ms: Optional[float] = None
+        self.attributes = attributes
+        self.status = "ok"
+        self._token = None
+
+    @property
+    def trace_id(self) -> str:
+        return self.trace.trace_id
+
+    def set(self, **attributes) -> "Span":
+        self.attributes.update(attributes)
+        return self
+
+    def fail(self, error) -> None:
+        self.status = "error"
+        self.attributes["error"] = str(getattr(error, "detail", None) or error) or type(error).__name__
+
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc is not None and self.status == "ok":
+            self.fail(exc)
+        _current.reset(self._token)
+        self.finish()
+
+    def finish(self) -> None:
+        if self.duration_ms is None:
+            self.duration_ms = round((time.perf_counter() - self.started) * 1000, 3)
+            self.trace.finished(self)
+
+    def to_dict(self) -> Dict:
+        return {
+            "spanId": self.span_id,
+            "parentId": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "durationMs": self.duration_ms,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class _Trace:
+    def __init__(self, tracer: "Tracer", trace_id: str):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.spans: List[Span] = []
+        self.dropped = 0
+        self.root: Optional[Span] = None
+
+    def finished(self, span: Span) -> None:
+        if span is self.root:
+            self.tracer._export(self)
+        elif len(self.spans) < MAX_SPANS_PER_TRACE:
+            self.spans.append(span)
+        else:
+            self.dropped += 1
+
+
+class _NoopSpan:
+    trace_id = None
+
+    def set(self, **attributes):
+        return self
+
+    def fail(self, error):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+NOOP = _NoopSpan()
+
+
+class Tracer:
+    def __init__(self, buffer_size: int = 200, path: Optional[Path] = None, enabled: bool = True):
+        self.enabled = enabled
+        self.path = Path(path) if path else None
+        self._buffer: deque = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+
+    def trace(self, name: str, **attributes):
+        """Start a new trace (root span), regardless of any span currently active."""
+        if not self.enabled:
+            return NOOP
+        trace = _Trace(self, uuid.uuid4().hex)
+        trace.root = Span(trace, name, None, attributes)
+        return trace.root
+
+    def span(self, name: str, **attributes):
+        """A child of the current span; a no-op outside of any trace."""
+        parent = _current.get()
+        if parent is None or not self.enabled:
+            return NOOP
+        return Span(parent.trace, name, parent, attributes)
+
+    def _export(self, trace: _Trace) -> None:
+        record = _trace_record(trace)
+        with self._lock:
+            self._buffer.append(record)
+            if self.path is not None:
+                try:
+                    self.path.parent.mkdir(parents=True, exist_ok=True)
+                    with self.path.open("a", encoding="utf-8") as f:
+                        f.write(json.dumps(record, default=str) + "\n")
+                except OSError:
+                    pass
+
+    def recent(self, limit: int = 20, name: Optional[str] = None, min_ms: float = 0) -> List[Dict]:
+        with self._lock:
+            records = list(self._buffer)
+        records = [r for r in reversed(records)
+                   if (name is None or name in r["name"]) and r["durationMs"] >= min_ms]
+        return records[:limit]
+
+    def get(self, trace_id: str) -> Optional[Dict]:
+        with self._lock:
+            return next((r for r in self._buffer if r["traceId"] == trace_id), None)
+
+
+def _trace_record(trace: _Trace) -> Dict:
+    root = trace.root
+    spans = sorted(trace.spans, key=lambda s: s.started)
+    # Time per span name, e.g. how much of a slow request was backoff vs. upstream time.
+    breakdown: Dict[str, Dict] = {}
+    for s in spans:
+        entry = breakdown.setdefault(s.name, {"count": 0, "totalMs": 0.0})
+        entry["count"] += 1
+        entry["totalMs"] = round(entry["totalMs"] + (s.duration_ms or 0), 3)
+    return {
+        "traceId": trace.trace_id,
+        "name": root.name,
+        "start": root.start,
+        "durationMs": root.duration_ms,
+        "status": root.status,
+        "attributes": root.attributes,
+        "breakdown": breakdown,
+        "spans": [s.to_dict() for s in spans],
+        "droppedSpans": trace.dropped,
+    }
+
+
+def span_tree(record: Dict) -> List[Dict]:
+    """The trace's spans nested under their parents (`children`), for reading by eye."""
+    nodes = {s["spanId"]: {**s, "children": []} for s in record["spans"]}
+    roots = []
+    for node in nodes.values():
+        parent = nodes.get(node["parentId"])
+        (parent["children"] if parent else roots).append(node)
+    return roots
+
+
+def current_span():
+    return _current.get() or NOOP
+
+
+TRACER = Tracer(
+    buffer_size=int(os.environ.get("APPIE_TRACE_BUFFER", "200")),
+    path=os.environ.get("APPIE_TRACE_FILE") or None,
+    enabled=os.environ.get("APPIE_TRACING", "1") not in ("0", "false", "no"),
+)
+span = TRACER.span
+trace = TRACER.trace